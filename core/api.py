@@ -0,0 +1,209 @@
+import gzip
+import json
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+from .caching import PAGE_CACHE_TIMEOUT, catalog_version, request_hash
+from .models import Item
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Public field name -> lookup passed to values()
+ITEM_FIELDS = {
+    'id': 'id',
+    'slug': 'slug',
+    'title': 'title',
+    'price': 'price',
+    'discount_price': 'discount_price',
+    'label': 'label',
+    'description': 'description',
+    'category': 'category__title',
+    'category_id': 'category_id',
+    'image': 'image',
+}
+DEFAULT_LIST_FIELDS = ('id', 'slug', 'title', 'price', 'discount_price', 'label', 'category', 'image')
+DEFAULT_DETAIL_FIELDS = tuple(ITEM_FIELDS)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_LENGTH = 200
+API_MAX_AGE = 60
+
+
+class APIError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_default(value):
+    # Prices are Decimals, sent as strings like DjangoJSONEncoder does
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=encode_default)
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding(request):
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        try:
+            q = float(params.strip()[2:]) if params.strip().startswith('q=') else 1.0
+        except ValueError:
+            q = 0.0
+        accepted[coding.strip().lower()] = q
+    candidates = [
+        coding for coding in available_encodings()
+        if accepted.get(coding, accepted.get('*', 0)) > 0
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda coding: accepted.get(coding, accepted.get('*', 0)))
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    # mtime=0 keeps the output identical across requests
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def select_fields(request, default):
+    requested = request.GET.get('fields')
+    if not requested:
+        return list(default)
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in ITEM_FIELDS]
+    if unknown:
+        raise APIError(f'Unknown fields: {", ".join(unknown)}')
+    return list(dict.fromkeys(fields))
+
+
+def item_rows(queryset, fields):
+    # Plain dicts straight from values(), no model instances
+    lookups = [ITEM_FIELDS[field] for field in fields]
+    rows = []
+    for values in queryset.values_list(*lookups):
+        row = dict(zip(fields, values))
+        if 'image' in row:
+            row['image'] = default_storage.url(row['image']) if row['image'] else None
+        rows.append(row)
+    return rows
+
+
+def int_param(request, name):
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise APIError(f'{name} must be an integer')
+
+
+def item_list(request):
+    fields = select_fields(request, DEFAULT_LIST_FIELDS)
+    limit = int_param(request, 'limit')
+    if limit is None:
+        limit = DEFAULT_LIMIT
+    elif limit < 1:
+        raise APIError('limit must be at least 1')
+    # Larger pages are cut to MAX_LIMIT, the cursor gives the rest
+    limit = min(limit, MAX_LIMIT)
+    after = int_param(request, 'after')
+    category = int_param(request, 'category')
+
+    queryset = Item.objects.order_by('id')
+    if category is not None:
+        queryset = queryset.filter(category_id=category)
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    # The cursor needs the id even when the client did not ask for it
+    rows = item_rows(queryset[:limit + 1], fields if 'id' in fields else ['id'] + fields)
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = rows[-1]['id'] if has_next else None
+    if 'id' not in fields:
+        for row in rows:
+            del row['id']
+    return {'results': rows, 'next': next_cursor}
+
+
+def item_detail(request, slug):
+    fields = select_fields(request, DEFAULT_DETAIL_FIELDS)
+    rows = item_rows(Item.objects.filter(slug=slug), fields)
+    if not rows:
+        raise APIError('Not found', status=404)
+    return rows[0]
+
+
+def catalog_api(build):
+    # JSON body keyed on the catalog version, so it is cached, revalidated
+    # and compressed once per catalog change rather than once per request
+    @require_safe
+    def view(request, *args, **kwargs):
+        state = catalog_version()
+        path_hash = request_hash(request)
+        encoding = negotiate_encoding(request)
+        # Weak, since the compressed and plain bodies are equivalent
+        etag = 'W/' + quote_etag(f'{state["version"]}-{path_hash}')
+        last_modified = int(state['last_modified'].timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            key = f'core:api:{state["version"]}:{path_hash}:{encoding}'
+            cached = cache.get(key)
+            if cached is None:
+                try:
+                    body = dumps(build(request, *args, **kwargs))
+                except APIError as e:
+                    response = HttpResponse(dumps({'error': str(e)}), status=e.status, content_type='application/json')
+                    patch_vary_headers(response, ['Accept-Encoding'])
+                    return response
+                if encoding is not None and len(body) >= MIN_COMPRESS_LENGTH:
+                    cached = (compress(body, encoding), encoding)
+                else:
+                    cached = (body, None)
+                cache.set(key, cached, PAGE_CACHE_TIMEOUT)
+            body, used_encoding = cached
+            response = HttpResponse(body, content_type='application/json')
+            if used_encoding is not None:
+                response['Content-Encoding'] = used_encoding
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True, max_age=API_MAX_AGE)
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+    return view
+
+
+items_api = catalog_api(item_list)
+item_detail_api = catalog_api(item_detail)
@@ -0,0 +1,103 @@
+import functools
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponseNotAllowed
+
+from . import cart, payments
+from .db import retry_on_lock
+from .inventory import OutOfStock
+from .models import Payment
+from .views import (
+    cart_added_response,
+    cart_decreased_response,
+    cart_removed_response,
+    order_summary_response,
+    out_of_stock_response,
+    payment_page_response,
+    payment_started_response,
+    payment_status_response,
+)
+
+# Async versions of the cart and checkout views, served when ASYNC_VIEWS is
+# on (ecommerce/asgi.py turns it on). Django 3.2 has no async ORM, so
+# queries and template rendering go through sync_to_async. Gateway calls are
+# awaited on the event loop instead of holding a thread.
+
+async def is_authenticated(request):
+    # Loading the user hits the session and user tables
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+def async_login_required(view):
+    # login_required does not know about coroutines in Django 3.2
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await is_authenticated(request):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def order_summary(request):
+    return await sync_to_async(order_summary_response)(request)
+
+
+@async_login_required
+async def payment(request, payment_option):
+    if request.method == 'GET':
+        return await sync_to_async(payment_page_response)(request)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['GET', 'POST'])
+    try:
+        started = await sync_to_async(payments.start_payment)(
+            request.user, request.POST.get('stripeToken', ''), enqueue=False,
+        )
+    except OutOfStock:
+        return out_of_stock_response(request)
+    if started is not None:
+        await payments.schedule_payment(started.pk)
+    return payment_started_response(request, started)
+
+
+# The payment row is written concurrently by the task charging it
+@retry_on_lock
+def get_payment(pk, user):
+    try:
+        return Payment.objects.get(pk=pk, user=user)
+    except Payment.DoesNotExist:
+        raise Http404('No payment found')
+
+
+@async_login_required
+async def payment_status(request, pk):
+    # Answers at once, the page and API clients poll until the charge
+    # settles. Waiting here would hold the thread the sync middleware runs on.
+    found = await sync_to_async(get_payment)(pk, request.user)
+    return await sync_to_async(payment_status_response)(request, found)
+
+
+# Anonymous visitors get a cookie cart, see core.cart.AnonymousCart
+
+async def add_to_card(request, slug):
+    if await is_authenticated(request):
+        status = await sync_to_async(cart.add_item)(request.user, slug)
+    else:
+        status = await sync_to_async(request.anonymous_cart.add)(slug)
+    return cart_added_response(request, status, slug)
+
+
+async def remove_from_card(request, slug):
+    if await is_authenticated(request):
+        status = await sync_to_async(cart.remove_item)(request.user, slug)
+    else:
+        status = await sync_to_async(request.anonymous_cart.remove)(slug)
+    return cart_removed_response(request, status, slug)
+
+
+async def remove_single_item_from_card(request, slug):
+    if await is_authenticated(request):
+        status = await sync_to_async(cart.remove_single_item)(request.user, slug)
+    else:
+        status = await sync_to_async(request.anonymous_cart.remove_single)(slug)
+    return cart_decreased_response(request, status, slug)
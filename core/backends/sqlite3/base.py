@@ -0,0 +1,28 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    # Django's sqlite3 backend with two extra OPTIONS, neither of which
+    # Django 3.2 has:
+    #   'pragmas'           run on every new connection
+    #   'transaction_mode'  DEFERRED, IMMEDIATE or EXCLUSIVE, for BEGIN
+    # IMMEDIATE takes the write lock when the transaction starts, so it
+    # waits out the busy timeout instead of failing on its first write
+    # when another connection wrote in between.
+    EXTRA_OPTIONS = ('pragmas', 'transaction_mode')
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        for option in self.EXTRA_OPTIONS:
+            params.pop(option, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict['OPTIONS'].get('pragmas', {}).items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict['OPTIONS'].get('transaction_mode')
+        self.cursor().execute(f'BEGIN {mode}' if mode else 'BEGIN')
@@ -0,0 +1,175 @@
+import contextlib
+import json
+import os
+import platform
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+# Server processes for the load tests against a live server
+SERVERS = {
+    # A threaded WSGI worker: each request holds a thread, and charges go
+    # through the BACKGROUND_WORKERS pool
+    'wsgi': lambda port, threads: [
+        sys.executable, '-m', 'gunicorn', 'ecommerce.wsgi:application',
+        '--worker-class', 'gthread', '--workers', '1', '--threads', str(threads),
+        '--bind', f'127.0.0.1:{port}', '--log-level', 'warning',
+    ],
+    # One event loop running core.async_views
+    'asgi': lambda port, threads: [
+        sys.executable, '-m', 'uvicorn', 'ecommerce.asgi:application',
+        '--workers', '1', '--port', str(port), '--log-level', 'warning',
+    ],
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = round(pct / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    # Samples are in seconds, the summary in milliseconds
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'max_ms': max(samples) * 1000,
+    }
+
+
+def time_calls(func, calls):
+    samples = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def models_at(migration, *model_names, app_label='core'):
+    # Historical models, to benchmark the schema as it was before a migration
+    state = MigrationLoader(connection).project_state((app_label, migration))
+    return [state.apps.get_model(app_label, name) for name in model_names]
+
+
+def schema_sql(models):
+    if connection.vendor != 'sqlite':
+        raise CommandError('Benchmarks build scratch SQLite databases and need the sqlite3 backend.')
+    with connection.schema_editor(collect_sql=True, atomic=False) as editor:
+        for model in models:
+            editor.create_model(model)
+    return editor.collected_sql
+
+
+def compile_query(queryset):
+    # SQL and params of a queryset, in the qmark style of the sqlite3 module
+    sql, params = queryset.query.sql_with_params()
+    return sql.replace('%s', '?').replace('%%', '%'), params
+
+
+def create_scratch_db(path, models):
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    for statement in schema_sql(models):
+        db.execute(statement)
+    db.commit()
+    return db
+
+
+def insert_rows(db, table, columns, rows, batch_size=50000):
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        table,
+        ', '.join(f'"{column}"' for column in columns),
+        ', '.join('?' * len(columns)),
+    )
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.executemany(sql, batch)
+            batch = []
+    if batch:
+        db.executemany(sql, batch)
+    db.commit()
+
+
+def run_info():
+    # Recorded with the results, to tell which commit and environment they
+    # come from when comparing runs
+    def git(*args):
+        try:
+            return subprocess.run(
+                ['git', *args], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+    }
+
+
+def write_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def test_database(path=None):
+    # A migrated throwaway database behind the default connection, for
+    # benchmarks that go through views and the ORM. Give it a path to share
+    # it with server processes.
+    setup_test_environment(debug=False)
+    if path is not None:
+        connection.settings_dict['TEST']['NAME'] = path
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def login_session(user):
+    # The key of a logged in session, for HTTP clients of a live server
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def wait_for_port(port, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise CommandError(f'The server exited with status {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError('The server did not start')
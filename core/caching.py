@@ -0,0 +1,163 @@
+import functools
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .models import Category, Order
+
+CATEGORIES_CACHE_KEY = 'core:categories'
+CATEGORIES_CACHE_TIMEOUT = 60 * 60
+
+CART_COUNT_CACHE_TIMEOUT = 60 * 60 * 24
+
+CATALOG_VERSION_KEY = 'core:catalog-version'
+PAGE_CACHE_TIMEOUT = 60 * 15
+
+_cart_count_stats = {'hits': 0, 'misses': 0}
+_cart_count_stats_lock = threading.Lock()
+
+
+def get_categories():
+    categories = cache.get(CATEGORIES_CACHE_KEY)
+    if categories is None:
+        categories = list(Category.objects.order_by('id'))
+        cache.set(CATEGORIES_CACHE_KEY, categories, CATEGORIES_CACHE_TIMEOUT)
+    return categories
+
+
+def invalidate_categories():
+    cache.delete(CATEGORIES_CACHE_KEY)
+
+
+def catalog_version_timeout():
+    return getattr(settings, 'CATALOG_VERSION_TIMEOUT', None)
+
+
+def catalog_version():
+    # Changes whenever an Item or a Category changes. Catalog pages and
+    # fragments include it in their cache keys instead of being deleted.
+    state = cache.get(CATALOG_VERSION_KEY)
+    if state is None:
+        state = {'version': uuid.uuid4().hex, 'last_modified': timezone.now()}
+        if not cache.add(CATALOG_VERSION_KEY, state, catalog_version_timeout()):
+            state = cache.get(CATALOG_VERSION_KEY, state)
+    return state
+
+
+def bump_catalog_version():
+    state = {'version': uuid.uuid4().hex, 'last_modified': timezone.now()}
+    cache.set(CATALOG_VERSION_KEY, state, catalog_version_timeout())
+
+
+def _has_messages(request):
+    # len() does not mark the messages as used
+    return len(messages.get_messages(request)) > 0
+
+
+def request_hash(request):
+    query = sorted(request.GET.lists())
+    return hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+
+
+def cache_anonymous_page(view):
+    # Whole-page cache and conditional GET for anonymous visitors. Signed-in
+    # users get the personalized page, with per-item fragments cached in the
+    # templates.
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (
+            request.method not in ('GET', 'HEAD')
+            or request.user.is_authenticated
+            or _has_messages(request)
+        ):
+            return view(request, *args, **kwargs)
+
+        state = catalog_version()
+        path_hash = request_hash(request)
+        # The navbar shows the count of the anonymous cart, one copy of the
+        # page per count
+        anonymous_cart = getattr(request, 'anonymous_cart', None)
+        if anonymous_cart:
+            path_hash = f'{path_hash}-{anonymous_cart.count()}'
+        etag = quote_etag(f'{state["version"]}-{path_hash}')
+        last_modified = int(state['last_modified'].timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+
+        key = f'core:page:{state["version"]}:{path_hash}'
+        cached = cache.get(key)
+        if cached is None:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+            if response.status_code != 200 or _has_messages(request):
+                return response
+            cache.set(key, (response.content, response['Content-Type']), PAGE_CACHE_TIMEOUT)
+        else:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_vary_headers(response, ['Cookie'])
+        return response
+    return wrapper
+
+
+def cart_count_cache():
+    return caches[getattr(settings, 'CART_COUNT_CACHE_ALIAS', 'default')]
+
+
+def cart_count_key(user_id):
+    return f'core:cart-count:{user_id}'
+
+
+def get_cart_item_count(user):
+    key = cart_count_key(user.pk)
+    count = cart_count_cache().get(key)
+    _record_cart_count(hit=count is not None)
+    if count is None:
+        count = (
+            Order.objects
+            .filter(user=user, ordered=False)
+            .values_list('item_count', flat=True)
+            .first()
+        ) or 0
+        cart_count_cache().set(key, count, CART_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def invalidate_cart_item_count(user_id):
+    # Wait for the cart change to be committed, or a concurrent request
+    # could cache the old count again
+    transaction.on_commit(
+        lambda: cart_count_cache().delete(cart_count_key(user_id))
+    )
+
+
+def _record_cart_count(hit):
+    with _cart_count_stats_lock:
+        _cart_count_stats['hits' if hit else 'misses'] += 1
+
+
+def cart_count_stats():
+    with _cart_count_stats_lock:
+        stats = dict(_cart_count_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_cart_count_stats():
+    with _cart_count_stats_lock:
+        _cart_count_stats.update(hits=0, misses=0)
@@ -0,0 +1,373 @@
+import asyncio
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+
+from .caching import invalidate_cart_item_count
+from . import inventory
+from .db import retry_on_lock, update_rows
+from .models import Item, Order, OrderItem, Payment, Reservation, order_totals_aggregates
+from .money import ZERO, to_decimal
+
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOT_IN_CART = 'not-in-cart'
+NO_ORDER = 'no-order'
+OUT_OF_STOCK = 'out-of-stock'
+CART_FULL = 'cart-full'
+PAYMENT_IN_PROGRESS = 'payment-in-progress'
+
+# Carts of visitors who are not logged in live in a signed cookie, as
+# item id:quantity pairs, and are merged into an Order when they log in
+ANONYMOUS_CART_COOKIE = 'cart'
+ANONYMOUS_CART_SALT = 'core.cart'
+ANONYMOUS_CART_MAX_AGE = 60 * 60 * 24 * 30
+# Keeps the cookie well under the browsers' 4KB limit
+MAX_ANONYMOUS_CART_LINES = 50
+
+
+def _get_item_for_cart(slug):
+    # on_hand is None for items whose stock is not tracked
+    return get_object_or_404(
+        Item.objects.values_list('id', 'price', 'discount_price', 'stock__on_hand'),
+        slug=slug,
+    )
+
+
+def _get_item_id(slug):
+    item_id, _, _, on_hand = _get_item_for_cart(slug)
+    return item_id, on_hand is not None
+
+
+def _lock_open_order(user, create=False):
+    # paying: a charge for the order is in flight. Its amount was fixed
+    # from the cart, which must not change until the charge settles.
+    orders = (
+        Order.objects.select_for_update()
+        .filter(user=user, ordered=False)
+        .annotate(paying=Exists(
+            Payment.objects.filter(order=OuterRef('pk'), status__in=(Payment.PENDING, Payment.PROCESSING))
+        ))
+    )
+    if create:
+        order, _ = orders.get_or_create(
+            user=user,
+            ordered=False,
+            defaults={'ordered_date': timezone.now()},
+        )
+        return order
+    return orders.first()
+
+
+def _cart_changed(order):
+    order.update_totals()
+    invalidate_cart_item_count(order.user_id)
+
+
+@retry_on_lock
+@transaction.atomic
+def add_item(user, slug):
+    item_id, price, discount_price, on_hand = _get_item_for_cart(slug)
+    tracked = on_hand is not None
+    order = _lock_open_order(user)
+    if order is not None and order.paying:
+        return PAYMENT_IN_PROGRESS
+    if tracked and not inventory.reserve(item_id, 1):
+        return OUT_OF_STOCK
+    if order is None:
+        order = _lock_open_order(user, create=True)
+    lines = OrderItem.objects.filter(order=order, item_id=item_id)
+    if lines.update(quantity=F('quantity') + 1):
+        status = UPDATED
+        order_item_id = lines.values_list('id', flat=True).first() if tracked else None
+    else:
+        # The line keeps the price the item had when it was first added
+        order_item = OrderItem(user=user, item_id=item_id)
+        order_item.capture_prices(price, discount_price)
+        order_item.save()
+        Order.items.through.objects.create(order=order, orderitem=order_item)
+        status = ADDED
+        order_item_id = order_item.pk
+    if tracked:
+        inventory.record_hold(order_item_id, item_id, 1)
+    _cart_changed(order)
+    return status
+
+
+@retry_on_lock
+@transaction.atomic
+def remove_single_item(user, slug):
+    item_id, tracked = _get_item_id(slug)
+    order = _lock_open_order(user)
+    if order is None:
+        return NO_ORDER
+    if order.paying:
+        return PAYMENT_IN_PROGRESS
+    order_items = OrderItem.objects.filter(order=order, item_id=item_id)
+    if tracked:
+        inventory.release_one(order_items)
+    if order_items.filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+        status = UPDATED
+    elif order_items.delete()[0]:
+        status = REMOVED
+    else:
+        return NOT_IN_CART
+    _cart_changed(order)
+    return status
+
+
+@retry_on_lock
+@transaction.atomic
+def remove_item(user, slug):
+    item_id, tracked = _get_item_id(slug)
+    order = _lock_open_order(user)
+    if order is None:
+        return NO_ORDER
+    if order.paying:
+        return PAYMENT_IN_PROGRESS
+    order_items = OrderItem.objects.filter(order=order, item_id=item_id)
+    if tracked:
+        inventory.release(Reservation.objects.filter(order_item__in=order_items))
+    if not order_items.delete()[0]:
+        return NOT_IN_CART
+    _cart_changed(order)
+    return REMOVED
+
+
+class ChargeMismatch(Exception):
+    # The lines of the order do not add up to what the payment charged
+
+    def __init__(self, order_id, charged, total):
+        super().__init__(f'Order {order_id} totals {total} but {charged} was charged')
+        self.order_id = order_id
+        self.charged = charged
+        self.total = total
+
+
+def finalize_order(order_id, payment_id):
+    # Places a paid order. Runs inside the transaction that records the
+    # payment, with the same number of queries whatever the cart size.
+    # Raises ChargeMismatch, placing nothing, when the lines do not add up
+    # to the amount charged.
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError('finalize_order() must run inside a transaction')
+    if not Order.objects.select_for_update().filter(pk=order_id, ordered=False).exists():
+        return False
+    totals = OrderItem.objects.filter(order=order_id).aggregate(**order_totals_aggregates())
+    total = to_decimal((totals['subtotal'] or ZERO) - (totals['discount_total'] or ZERO))
+    charged = Payment.objects.values_list('amount', flat=True).get(pk=payment_id)
+    if total != charged:
+        raise ChargeMismatch(order_id, charged, total)
+    placed = Order.objects.filter(pk=order_id, ordered=False).update(
+        ordered=True,
+        payment_id=payment_id,
+        ordered_date=timezone.now(),
+    )
+    if not placed:
+        return False
+    # The lines already carry the prices they were added at, and the
+    # payment was taken for the totals computed from them
+    OrderItem.objects.filter(order=order_id, ordered=False).update(ordered=True)
+    inventory.consume(order_id)
+    return True
+
+
+@retry_on_lock
+@transaction.atomic
+def merge_lines(user, quantities):
+    # Adds the lines of an anonymous cart, {item id: quantity}, to the user's
+    # open order, in the same number of queries whatever the cart size. The
+    # lines get today's prices. Stock is not held here: refresh_holds takes
+    # the holds of tracked items before the payment. Returns None, merging
+    # nothing, while a payment for the order is in flight.
+    items = {
+        item_id: (price, discount_price)
+        for item_id, price, discount_price in
+        Item.objects.filter(id__in=quantities).values_list('id', 'price', 'discount_price')
+    }
+    if not items:
+        return 0
+    order = _lock_open_order(user, create=True)
+    # A new order has no payments, nor the annotation
+    if getattr(order, 'paying', False):
+        return None
+    existing = list(OrderItem.objects.filter(order=order, item_id__in=items).only('id', 'item_id', 'quantity'))
+    for line in existing:
+        line.quantity += quantities[line.item_id]
+    update_rows(OrderItem, existing, ['quantity'])
+
+    merged = {line.item_id for line in existing}
+    new = []
+    for item_id, (price, discount_price) in items.items():
+        if item_id not in merged:
+            line = OrderItem(user=user, item_id=item_id, quantity=quantities[item_id])
+            line.capture_prices(price, discount_price)
+            new.append(line)
+    OrderItem.objects.bulk_create(new)
+    if new and new[0].pk is None:
+        # Backends that do not return the ids of bulk inserted rows
+        ids = dict(
+            OrderItem.objects
+            .filter(user=user, ordered=False, order__isnull=True, item_id__in=[line.item_id for line in new])
+            .order_by('id')
+            .values_list('item_id', 'id')
+        )
+        for line in new:
+            line.pk = ids[line.item_id]
+    Order.items.through.objects.bulk_create([
+        Order.items.through(order=order, orderitem=line) for line in new
+    ])
+    _cart_changed(order)
+    return len(items)
+
+
+class AnonymousCart:
+    # The cart of a visitor who is not logged in. Changing it writes nothing
+    # to the database, AnonymousCartMiddleware sends the new cookie.
+
+    def __init__(self, lines=None):
+        # Item id -> quantity, in the order they were added
+        self.lines = dict(lines or {})
+        self.changed = False
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(
+            ANONYMOUS_CART_COOKIE, None, salt=ANONYMOUS_CART_SALT, max_age=ANONYMOUS_CART_MAX_AGE,
+        )
+        lines = {}
+        for pair in (value or '').split(','):
+            item_id, _, quantity = pair.partition(':')
+            if item_id.isdigit() and quantity.isdigit() and int(quantity) > 0:
+                lines[int(item_id)] = int(quantity)
+        return cls(list(lines.items())[:MAX_ANONYMOUS_CART_LINES])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def count(self):
+        # Lines, like the Order.item_count of the cart badge
+        return len(self.lines)
+
+    def add(self, slug):
+        item_id, on_hand, reserved = get_object_or_404(
+            Item.objects.values_list('id', 'stock__on_hand', 'stock__reserved'),
+            slug=slug,
+        )
+        quantity = self.lines.get(item_id, 0) + 1
+        # Nothing is held for anonymous carts, but what is already sold out
+        # or held by others cannot be added
+        if on_hand is not None and on_hand - reserved < quantity:
+            return OUT_OF_STOCK
+        if quantity == 1 and len(self.lines) >= MAX_ANONYMOUS_CART_LINES:
+            return CART_FULL
+        self.lines[item_id] = quantity
+        self.changed = True
+        return ADDED if quantity == 1 else UPDATED
+
+    def remove_single(self, slug):
+        item_id = self._get_item_id(slug)
+        if not self.lines:
+            return NO_ORDER
+        if item_id not in self.lines:
+            return NOT_IN_CART
+        self.changed = True
+        if self.lines[item_id] > 1:
+            self.lines[item_id] -= 1
+            return UPDATED
+        del self.lines[item_id]
+        return REMOVED
+
+    def remove(self, slug):
+        item_id = self._get_item_id(slug)
+        if not self.lines:
+            return NO_ORDER
+        if self.lines.pop(item_id, None) is None:
+            return NOT_IN_CART
+        self.changed = True
+        return REMOVED
+
+    def clear(self):
+        self.changed = self.changed or bool(self.lines)
+        self.lines = {}
+
+    def _get_item_id(self, slug):
+        return get_object_or_404(Item.objects.values_list('id', flat=True), slug=slug)
+
+    def as_order(self):
+        # Stands in for the Order in order_summary.html, priced from the
+        # items in one query
+        items = Item.objects.only('title', 'slug', 'price', 'discount_price').in_bulk(self.lines)
+        lines = []
+        for item_id, quantity in self.lines.items():
+            item = items.get(item_id)
+            if item is not None:
+                line = OrderItem(item=item, quantity=quantity)
+                line.capture_prices(item.price, item.discount_price)
+                lines.append(line)
+        return AnonymousOrder(lines)
+
+    def save(self, response):
+        if not self.changed:
+            return
+        if not self.lines:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE, samesite='Lax')
+            return
+        response.set_signed_cookie(
+            ANONYMOUS_CART_COOKIE,
+            ','.join(f'{item_id}:{quantity}' for item_id, quantity in self.lines.items()),
+            salt=ANONYMOUS_CART_SALT,
+            max_age=ANONYMOUS_CART_MAX_AGE,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite='Lax',
+        )
+
+
+class AnonymousOrder:
+
+    class Lines(list):
+        # For the templates' order.items.all
+        def all(self):
+            return self
+
+    def __init__(self, lines):
+        self.items = self.Lines(lines)
+        self.item_count = len(lines)
+
+    def get_total(self):
+        return sum((line.get_final_price() for line in self.items), ZERO)
+
+
+class AnonymousCartMiddleware:
+    # request.anonymous_cart, saved to the response when a view changed it.
+    # core.signals merges it into the order of the user who logs in. Async
+    # capable, so that the async views are not run through async_to_sync;
+    # the cart is read from and saved to a cookie, without queries.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks __call__ as a coroutine function for Django, like
+            # MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        request.anonymous_cart = AnonymousCart.from_request(request)
+        response = self.get_response(request)
+        request.anonymous_cart.save(response)
+        return response
+
+    async def __acall__(self, request):
+        request.anonymous_cart = AnonymousCart.from_request(request)
+        response = await self.get_response(request)
+        request.anonymous_cart.save(response)
+        return response
@@ -0,0 +1,209 @@
+import csv
+import decimal
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import transaction
+
+from .db import retry_on_lock, update_rows
+from .models import LABEL_CHOICES, Category, ImageJob, Item
+from .money import to_decimal
+from .search import get_backend as get_search_backend
+
+# Bulk catalog import and export, see the import_catalog and export_catalog
+# commands. Rows are streamed and written in batches, so memory does not
+# grow with the size of the file. Items are keyed by slug, categories by
+# title.
+FIELDS = ['slug', 'title', 'category', 'price', 'discount_price', 'label', 'description', 'image']
+UPDATE_FIELDS = ['title', 'category_id', 'price', 'discount_price', 'label', 'description', 'image', 'image_hash']
+FORMATS = ('csv', 'jsonl')
+LABELS = {value for value, _ in LABEL_CHOICES}
+
+
+def guess_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(f, format):
+    # (line number, dict) for each record
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError as exc:
+                    raise ValidationError(f'Invalid JSON: {exc}')
+                yield number, row
+
+
+def write_rows(f, format, rows):
+    if format == 'csv':
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def parse_row(row):
+    # Cleaned values of an import row, raises ValidationError
+    def text(name, max_length=None, required=True):
+        value = row.get(name)
+        value = '' if value is None else str(value).strip()
+        if required and not value:
+            raise ValidationError(f'{name} is required')
+        if max_length is not None and len(value) > max_length:
+            raise ValidationError(f'{name} is longer than {max_length} characters')
+        return value
+
+    def price(name, required=True):
+        value = text(name, required=required)
+        if not value:
+            return None
+        field = Item._meta.get_field(name)
+        try:
+            cleaned = to_decimal(field.to_python(value))
+        except (ValidationError, decimal.InvalidOperation):
+            cleaned = None
+        # inf and nan parse, but cannot be stored
+        if cleaned is None or not cleaned.is_finite() or len(cleaned.as_tuple().digits) > field.max_digits:
+            raise ValidationError(f'{name} is not a valid price: {value!r}')
+        return cleaned
+
+    if not isinstance(row, dict):
+        # e.g. a JSON line holding a list or a string
+        raise ValidationError(f'Expected an object, got {type(row).__name__}')
+    slug = text('slug', Item._meta.get_field('slug').max_length)
+    validate_slug(slug)
+    label = text('label', required=False) or 'P'
+    if label not in LABELS:
+        raise ValidationError(f'label must be one of {", ".join(sorted(LABELS))}')
+    return {
+        'slug': slug,
+        'title': text('title', Item._meta.get_field('title').max_length),
+        'category': text('category', Category._meta.get_field('title').max_length),
+        'price': price('price'),
+        'discount_price': price('discount_price', required=False),
+        'label': label,
+        'description': text('description', required=False),
+        'image': text('image', Item._meta.get_field('image').max_length, required=False),
+    }
+
+
+class CatalogImporter:
+    # Upserts batches of parsed rows. Bulk writes skip Item.save and the
+    # signals in core.signals, so this does their work once per batch:
+    # search index, image jobs, and the catalog version at the end.
+
+    def __init__(self):
+        # Category title -> id, filled as categories are seen
+        self.categories = {}
+        self.created = self.updated = self.unchanged = 0
+        self.image_jobs = 0
+        self.new_categories = False
+
+    def category_ids(self, titles):
+        ids = {title: self.categories[title] for title in titles if title in self.categories}
+        missing = set(titles) - ids.keys()
+        if missing:
+            found = dict(Category.objects.filter(title__in=missing).values_list('title', 'id'))
+            new = missing - found.keys()
+            if new:
+                Category.objects.bulk_create([Category(title=title) for title in sorted(new)])
+                self.new_categories = True
+                found.update(Category.objects.filter(title__in=new).values_list('title', 'id'))
+            ids.update(found)
+            # Remembered once committed, a retried batch looks them up again
+            transaction.on_commit(lambda: self.categories.update(found))
+        return ids
+
+    @retry_on_lock
+    @transaction.atomic
+    def import_batch(self, rows):
+        # Last row wins when a slug repeats in the batch
+        rows = {row['slug']: row for row in rows}
+        category_ids = self.category_ids({row['category'] for row in rows.values()})
+        existing = {
+            item.slug: item
+            for item in Item.objects.filter(slug__in=rows).only('slug', *UPDATE_FIELDS)
+        }
+        new, changed, images = [], [], []
+        for slug, row in rows.items():
+            values = {
+                'title': row['title'],
+                'category_id': category_ids[row['category']],
+                'price': row['price'],
+                'discount_price': row['discount_price'],
+                'label': row['label'],
+                'description': row['description'],
+                'image': row['image'] or None,
+            }
+            item = existing.get(slug)
+            if item is None:
+                new.append(Item(slug=slug, **values))
+                continue
+            old_image = item.image.name or None
+            if all(getattr(item, field) == value for field, value in values.items() if field != 'image') \
+                    and old_image == values['image']:
+                continue
+            for field, value in values.items():
+                setattr(item, field, value)
+            if old_image != values['image']:
+                item.image_hash = ''
+                if values['image']:
+                    images.append(item.pk)
+            changed.append(item)
+
+        # ignore_conflicts: a slug created concurrently since the lookup is
+        # left to the next import instead of failing the batch
+        Item.objects.bulk_create(new, ignore_conflicts=True)
+        update_rows(Item, changed, UPDATE_FIELDS)
+        new_ids = dict(Item.objects.filter(slug__in=[item.slug for item in new]).values_list('slug', 'id'))
+        images.extend(new_ids[item.slug] for item in new if item.image and item.slug in new_ids)
+
+        get_search_backend().index_items([*new_ids.values(), *(item.pk for item in changed)])
+        self.enqueue_images(images)
+        self.created += len(new_ids)
+        self.updated += len(changed)
+        self.unchanged += len(rows) - len(new) - len(changed)
+
+    def enqueue_images(self, item_ids):
+        # One pending job per item, like core.images.enqueue_image_processing.
+        # They are left to process_image_jobs rather than the web workers'
+        # background pool.
+        pending = set(
+            ImageJob.objects.filter(item_id__in=item_ids, status=ImageJob.PENDING).values_list('item_id', flat=True)
+        )
+        jobs = [ImageJob(item_id=item_id) for item_id in item_ids if item_id not in pending]
+        ImageJob.objects.bulk_create(jobs)
+        self.image_jobs += len(jobs)
+
+
+def export_rows(batch_size=2000):
+    # Keyset pagination over the items, for constant memory on any size
+    queryset = Item.objects.order_by('id').values_list(
+        'id', 'slug', 'title', 'category__title', 'price', 'discount_price', 'label', 'description', 'image',
+    )
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        for item_id, slug, title, category, price, discount_price, label, description, image in batch:
+            yield {
+                'slug': slug,
+                'title': title,
+                'category': category,
+                'price': str(price),
+                'discount_price': '' if discount_price is None else str(discount_price),
+                'label': label,
+                'description': description,
+                'image': image or '',
+            }
+        last_id = batch[-1][0]
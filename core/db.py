@@ -0,0 +1,52 @@
+import functools
+import random
+import time
+
+from django.db import OperationalError, connection
+
+LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def is_lock_error(exc):
+    return isinstance(exc, OperationalError) and str(exc).startswith(LOCK_ERRORS)
+
+
+# Runs `func` again when SQLite reports that another connection holds the
+# write lock (SQLITE_BUSY), with jittered exponential backoff so that the
+# losers do not all come back at once. `func` must own its transaction, so
+# nothing is retried when it is called inside an atomic block.
+def retry_on_lock(func=None, *, attempts=8, delay=0.01):
+    if func is None:
+        return functools.partial(retry_on_lock, attempts=attempts, delay=delay)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                retryable = is_lock_error(exc) and not connection.in_atomic_block
+                if not retryable or attempt == attempts - 1:
+                    raise
+                time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+def update_rows(model, objs, fields):
+    # bulk_update() without its CASE WHEN expressions, which Django builds in
+    # Python per row and field and which dominate large updates. This is one
+    # parameterized UPDATE by primary key, run with executemany.
+    columns = [model._meta.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(model._meta.db_table),
+        ', '.join(f'{quote(field.column)} = %s' for field in columns),
+        quote(model._meta.pk.column),
+    )
+    rows = [
+        [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in columns] + [obj.pk]
+        for obj in objs
+    ]
+    if rows:
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
@@ -0,0 +1,92 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+DECLINED_SOURCE = 'tok_chargeDeclined'
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # Just enough of POST /v1/charges and /v1/refunds for load tests:
+    # configurable latency and failures, and responses replayed per
+    # Idempotency-Key like Stripe
+
+    def do_POST(self):
+        server = self.server
+        if self.path.rstrip('/') not in ('/v1/charges', '/v1/refunds'):
+            return self.respond(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path'}})
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        key = self.headers.get('Idempotency-Key')
+
+        if server.latency:
+            time.sleep(server.latency)
+        if key is not None:
+            with server.lock:
+                replay = server.responses.get(key)
+            if replay is not None:
+                return self.respond(*replay)
+
+        if server.rnd.random() < server.error_rate:
+            # Not remembered, a retry with the same key goes through again
+            return self.respond(500, {'error': {'type': 'api_error', 'message': 'Simulated outage'}})
+        if self.path.rstrip('/') == '/v1/refunds':
+            status, body = 200, {
+                'id': f're_{uuid.uuid4().hex[:24]}',
+                'object': 'refund',
+                'charge': params.get('charge', ''),
+                'status': 'succeeded',
+            }
+        elif params.get('source') == DECLINED_SOURCE or server.rnd.random() < server.decline_rate:
+            status, body = 402, {'error': {
+                'type': 'card_error', 'code': 'card_declined', 'message': 'Your card was declined.',
+            }}
+        else:
+            status, body = 200, {
+                'id': f'ch_{uuid.uuid4().hex[:24]}',
+                'object': 'charge',
+                'amount': int(params.get('amount', 0)),
+                'currency': params.get('currency', 'usd'),
+                'paid': True,
+                'status': 'succeeded',
+            }
+        with server.lock:
+            server.charges += status == 200 and body['object'] == 'charge'
+            if key is not None:
+                status, body = server.responses.setdefault(key, (status, body))
+        self.respond(status, body)
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, decline_rate=0.0, seed=None, verbose=False):
+    server = ThreadingHTTPServer((host, port), FakeStripeHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.decline_rate = decline_rate
+    server.rnd = random.Random(seed)
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.responses = {}
+    server.charges = 0
+    return server
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
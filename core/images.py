@@ -0,0 +1,176 @@
+import hashlib
+import logging
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .caching import bump_catalog_version
+from .models import ImageJob, Item
+from .tasks import submit_on_commit
+
+logger = logging.getLogger(__name__)
+
+# Longest side, in pixels, of each generated rendition
+RENDITIONS = {
+    'card': 400,
+    'product': 800,
+    'retina': 1600,
+}
+# Every rendition width is generated in every available format, so the
+# browser can pick from srcset
+WIDTHS = sorted(set(RENDITIONS.values()))
+JPEG_QUALITY = 70
+MAX_ATTEMPTS = 3
+# How long a complete set of renditions is trusted before storage is
+# checked again, and how often a page may queue a job for the same image
+RENDITIONS_TIMEOUT = 60 * 60 * 24
+REQUEUE_TIMEOUT = 5 * 60
+
+# extension, Pillow format, MIME type, save options; smallest output first
+OUTPUT_FORMATS = [
+    ('avif', 'AVIF', 'image/avif', {'quality': 50}),
+    ('webp', 'WEBP', 'image/webp', {'quality': 70, 'method': 4}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True}),
+]
+
+
+def rendition_name(image_hash, width, extension='jpg'):
+    # Content-addressed, so a rendition never has to be invalidated
+    return f'renditions/{image_hash[:2]}/{image_hash}-{width}w.{extension}'
+
+
+def available_formats():
+    # AVIF and WebP depend on how Pillow was built
+    Image.init()
+    return [output for output in OUTPUT_FORMATS if output[1] in Image.SAVE]
+
+
+def rendition_url(item, name='card', extension='jpg'):
+    if not item.image:
+        return ''
+    if not item.image_hash:
+        # Not processed yet, serve the original upload
+        return item.image.url
+    return default_storage.url(rendition_name(item.image_hash, RENDITIONS[name], extension))
+
+
+def srcset(item, extension='jpg'):
+    return ', '.join(
+        f'{default_storage.url(rendition_name(item.image_hash, width, extension))} {width}w'
+        for width in WIDTHS
+    )
+
+
+def file_hash(field_file):
+    digest = hashlib.sha256()
+    for chunk in field_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_image(field_file):
+    image = Image.open(field_file)
+    image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def save_rendition(image, width, name, **save_options):
+    rendition = image.copy()
+    rendition.thumbnail((width, width))
+    buffer = BytesIO()
+    rendition.save(buffer, **save_options)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_renditions(field_file, image_hash=None):
+    field_file.open('rb')
+    try:
+        if image_hash is None:
+            image_hash = file_hash(field_file)
+        missing = [
+            (width, rendition_name(image_hash, width, extension), pillow_format, options)
+            for extension, pillow_format, _, options in available_formats()
+            for width in WIDTHS
+            if not default_storage.exists(rendition_name(image_hash, width, extension))
+        ]
+        if missing:
+            field_file.seek(0)
+            image = open_image(field_file)
+            for width, name, pillow_format, options in missing:
+                save_rendition(image, width, name, format=pillow_format, **options)
+    finally:
+        field_file.close()
+    cache.set(renditions_key(image_hash), True, RENDITIONS_TIMEOUT)
+    return image_hash
+
+
+def renditions_key(image_hash):
+    extensions = ','.join(extension for extension, *_ in available_formats())
+    return f'core:renditions:{image_hash}:{extensions}'
+
+
+def renditions_ready(item):
+    # Pages never encode: until a job has confirmed the renditions, e.g.
+    # after a format was added or the rendition directory was cleared, the
+    # original is served and a job is queued to generate what is missing
+    if cache.get(renditions_key(item.image_hash)):
+        return True
+    if cache.add(f'core:renditions-queued:{item.image_hash}', True, REQUEUE_TIMEOUT):
+        enqueue_image_processing(item)
+    return False
+
+
+def enqueue_image_processing(item):
+    job, created = ImageJob.objects.get_or_create(item=item, status=ImageJob.PENDING)
+    if created:
+        submit_on_commit(process_image_job, job.pk)
+    return job
+
+
+def process_image_job(job_id):
+    claimed = ImageJob.objects.filter(pk=job_id, status=ImageJob.PENDING).update(
+        status=ImageJob.RUNNING,
+        attempts=F('attempts') + 1,
+        updated=timezone.now(),
+    )
+    if not claimed:
+        # Another worker got it first
+        return
+    job = ImageJob.objects.select_related('item').get(pk=job_id)
+    item = job.item
+    if not item.image:
+        job.status = ImageJob.DONE
+        job.save(update_fields=['status', 'updated'])
+        return
+    try:
+        image_hash = generate_renditions(item.image)
+    except Exception as exc:
+        logger.exception('Could not process the image of item %s', item.pk)
+        job.status = ImageJob.PENDING if job.attempts < MAX_ATTEMPTS else ImageJob.FAILED
+        job.error = str(exc)
+    else:
+        # Only record the hash if the image was not replaced in the meantime
+        if Item.objects.filter(pk=item.pk, image=item.image.name).update(image_hash=image_hash):
+            # Pages embed the rendition URLs
+            bump_catalog_version()
+        job.status = ImageJob.DONE
+        job.error = ''
+    job.save(update_fields=['status', 'error', 'updated'])
+
+
+def pending_job_ids(limit=None):
+    job_ids = (
+        ImageJob.objects
+        .filter(status=ImageJob.PENDING)
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    return list(job_ids[:limit] if limit else job_ids)
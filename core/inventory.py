@@ -0,0 +1,148 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .db import retry_on_lock
+from .models import OrderItem, Reservation, StockLevel
+
+logger = logging.getLogger(__name__)
+
+SWEEP_BATCH_SIZE = 500
+
+# Stock moves only through conditional UPDATEs, so concurrent carts cannot
+# take more than is on hand:
+#
+#   add to cart   reserved += n   WHERE on_hand >= reserved + n
+#   paid          on_hand -= n, reserved -= held
+#                                 WHERE on_hand >= reserved - held + n
+#   expired hold  reserved -= held
+#
+# Reservations record what each cart line holds, and until when.
+
+
+class OutOfStock(Exception):
+
+    def __init__(self, item_id):
+        super().__init__(f'Item {item_id} is out of stock')
+        self.item_id = item_id
+
+
+def hold_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+def reserve(item_id, quantity):
+    # False when fewer than `quantity` units are available
+    return bool(
+        StockLevel.objects
+        .filter(item_id=item_id, on_hand__gte=F('reserved') + quantity)
+        .update(reserved=F('reserved') + quantity)
+    )
+
+
+def record_hold(order_item_id, item_id, quantity, expires=None):
+    # Adds stock taken with reserve() to the line's reservation
+    expires = expires or hold_expiry()
+    extended = Reservation.objects.filter(order_item_id=order_item_id).update(
+        quantity=F('quantity') + quantity,
+        expires=expires,
+    )
+    if not extended:
+        Reservation.objects.create(order_item_id=order_item_id, item_id=item_id, quantity=quantity, expires=expires)
+
+
+def release_one(lines):
+    # One unit back from the holds of the given cart lines, when their
+    # quantity goes down
+    held = Reservation.objects.filter(order_item__in=lines, quantity__gt=0)
+    item_ids = list(held.values_list('item_id', flat=True))
+    if held.update(quantity=F('quantity') - 1):
+        StockLevel.objects.filter(item_id__in=item_ids).update(reserved=F('reserved') - 1)
+
+
+def release(reservations):
+    # Gives the held stock back and deletes the holds, in the same number of
+    # queries however many there are. Must run in a transaction.
+    reservation_ids = list(reservations.select_for_update().values_list('id', flat=True))
+    if not reservation_ids:
+        return 0
+    held = (
+        Reservation.objects
+        .filter(id__in=reservation_ids, item_id=OuterRef('item_id'))
+        .values('item_id')
+        .annotate(total=Sum('quantity'))
+        .values('total')
+    )
+    StockLevel.objects.filter(
+        item_id__in=Reservation.objects.filter(id__in=reservation_ids).values('item_id'),
+    ).update(reserved=F('reserved') - Subquery(held))
+    Reservation.objects.filter(id__in=reservation_ids).delete()
+    return len(reservation_ids)
+
+
+@retry_on_lock
+@transaction.atomic
+def release_expired(batch_size=SWEEP_BATCH_SIZE):
+    # One batch of expired holds, so the sweeper never holds the write lock
+    # for long. Returns how many were released.
+    expired = Reservation.objects.filter(expires__lt=timezone.now()).order_by('expires', 'id')
+    return release(expired[:batch_size])
+
+
+def refresh_holds(order):
+    # Before charging: keeps the cart's holds alive while the payment is
+    # in flight, and reserves again for lines whose hold has expired.
+    # Raises OutOfStock, the caller's transaction undoes partial holds.
+    expires = hold_expiry()
+    Reservation.objects.filter(order_item__order=order).update(expires=expires)
+    short = (
+        OrderItem.objects
+        .filter(order=order, item__stock__isnull=False)
+        .annotate(held=Coalesce('reservation__quantity', 0))
+        .filter(held__lt=F('quantity'))
+        .values_list('id', 'item_id', 'quantity', 'held')
+    )
+    for order_item_id, item_id, quantity, held in short:
+        if not reserve(item_id, quantity - held):
+            raise OutOfStock(item_id)
+        record_hold(order_item_id, item_id, quantity - held, expires)
+
+
+def consume(order_id):
+    # Takes the paid quantities off the shelf and drops the order's holds.
+    # Same number of queries whatever the cart size; runs inside
+    # finalize_order's transaction.
+    def per_item(queryset, field):
+        return Subquery(
+            queryset.filter(item_id=OuterRef('item_id'))
+            .values('item_id')
+            .annotate(total=Sum(field))
+            .values('total')
+        )
+
+    lines = OrderItem.objects.filter(order=order_id)
+    holds = Reservation.objects.filter(order_item__order=order_id)
+    ordered = per_item(lines, 'quantity')
+    held = Coalesce(per_item(holds, 'quantity'), 0)
+    stock = StockLevel.objects.filter(item_id__in=lines.values('item_id'))
+    short = list(
+        stock.select_for_update()
+        .exclude(on_hand__gte=F('reserved') - held + ordered)
+        .values_list('item_id', flat=True)
+    )
+    taken = stock.exclude(item_id__in=short).update(
+        on_hand=F('on_hand') - ordered,
+        reserved=F('reserved') - held,
+    )
+    if short:
+        # Only possible when a hold expired while the charge was in flight.
+        # What the order still holds of those items goes back all the same.
+        stock.filter(item_id__in=short).update(reserved=F('reserved') - held)
+        logger.error('Order %s was paid with %s items out of stock', order_id, len(short))
+    holds.delete()
+    return taken
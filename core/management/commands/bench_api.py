@@ -0,0 +1,82 @@
+import time
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from core.bench import summarize, test_database, time_calls, write_results
+from core.caching import bump_catalog_version
+from core.models import Category, Item
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway database and compare the throughput of the JSON '
+        'catalog API with the HTML views serving the same items.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000)
+        parser.add_argument('--requests', type=int, default=300, help='Timed requests per endpoint and mode.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            start = time.perf_counter()
+            self.seed(options['items'])
+            self.stdout.write(f'Seeded {options["items"]} items in {time.perf_counter() - start:.1f}s')
+            results = self.run(options)
+
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, count):
+        categories = Category.objects.bulk_create([Category(title=f'Category {i}') for i in range(20)])
+        categories = list(Category.objects.order_by('id'))
+        Item.objects.bulk_create(
+            (
+                Item(
+                    title=f'Item {i}', price=10 + i % 90, discount_price=5 if i % 3 == 0 else None,
+                    category=categories[i % len(categories)], label='P',
+                    description='A plain product description ' * 8, slug=f'item-{i}',
+                )
+                for i in range(count)
+            ),
+            batch_size=5000,
+        )
+
+    def run(self, options):
+        client = Client()
+        # Few enough distinct pages to fit in the default LocMemCache
+        slugs = [f'item-{i % 50 * 37 % options["items"]}' for i in range(options['requests'])]
+        endpoints = {
+            'list html': lambda i: '/',
+            'list json': lambda i: '/api/items/?limit=10',
+            'detail html': lambda i: f'/product/{slugs[i]}/',
+            'detail json': lambda i: f'/api/items/{slugs[i]}/',
+        }
+        headers = {'HTTP_ACCEPT_ENCODING': 'gzip, br'}
+
+        def uncached(url):
+            # A new catalog version, so nothing is served from the cache
+            bump_catalog_version()
+            return client.get(url, **headers)
+
+        results = {'options': {k: options[k] for k in ('items', 'requests')}}
+        self.stdout.write(f'{"endpoint":<14}{"uncached req/s":>16}{"cached req/s":>14}{"bytes":>9}')
+        for name, url_for in endpoints.items():
+            for cache in caches.all():
+                cache.clear()
+            calls = [(url_for(i),) for i in range(options['requests'])]
+            uncached_stats = summarize(time_calls(uncached, calls))
+            # Warm the cache, then time the same URLs again
+            size = len(client.get(url_for(0), **headers).content)
+            for url, in calls:
+                client.get(url, **headers)
+            cached_stats = summarize(time_calls(lambda url: client.get(url, **headers), calls))
+            results[name] = {'uncached': uncached_stats, 'cached': cached_stats, 'bytes': size}
+            self.stdout.write(
+                f'{name:<14}{1000 / uncached_stats["mean_ms"]:>16.0f}'
+                f'{1000 / cached_stats["mean_ms"]:>14.0f}{size:>9}'
+            )
+        return results
@@ -0,0 +1,189 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+
+from core.bench import run_info, test_database, write_results
+from core.models import Category, Item, Order, OrderItem, Reservation, StockLevel
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+PASSWORD = 'shopper'
+MODES = {
+    # Before anonymous carts: the first add to cart sends the visitor to log
+    # in, and every later click writes the cart tables
+    'login': 'logged in DB cart',
+    # Cookie carts, merged into an order by the visitors who log in
+    'anonymous': 'anonymous cookie cart',
+}
+
+
+class WriteCounter:
+    # Statements by kind, and writes by table
+
+    def __init__(self):
+        self.queries = 0
+        self.writes = 0
+        self.tables = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        if sql.lstrip().upper().startswith(WRITES):
+            self.writes += 1
+            self.tables[table_of(sql)] += 1
+        return execute(sql, params, many, context)
+
+
+def table_of(sql):
+    # The quoted name after INSERT INTO, UPDATE or DELETE FROM
+    start = sql.find('"')
+    return sql[start + 1:sql.find('"', start + 1)] if start >= 0 else '?'
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay browse-heavy visits, many page views and a few cart clicks '
+        'each, with the cart of logged in users in the database and with '
+        'anonymous cookie carts merged at login. Reports the SQL writes per '
+        'request of each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--visitors', type=int, default=200)
+        parser.add_argument('--views', type=int, default=20, help='Home, category and product pages per visit.')
+        parser.add_argument('--adds', type=int, default=3, help='Cart clicks per visit that changes the cart.')
+        parser.add_argument(
+            '--cart-rate', type=float, default=0.3,
+            help='Share of the visitors who use the cart, the others only browse.',
+        )
+        parser.add_argument(
+            '--convert-rate', type=float, default=0.1,
+            help='Share of the visitors who log in and reach checkout.',
+        )
+        parser.add_argument('--items', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        keys = ('visitors', 'views', 'adds', 'cart_rate', 'convert_rate', 'items', 'seed')
+        results = {'run': run_info(), 'options': {k: options[k] for k in keys}}
+        path = os.path.join(options['dir'], 'bench_cart_writes.sqlite3')
+        media_root = tempfile.mkdtemp(prefix='bench_cart_writes_media_')
+        # Login is part of the flow, a fast hasher keeps it from dominating
+        fast_hasher = ['django.contrib.auth.hashers.MD5PasswordHasher']
+        try:
+            with override_settings(MEDIA_ROOT=media_root, PASSWORD_HASHERS=fast_hasher):
+                with test_database(path):
+                    call_command(
+                        'seed_storefront', categories=10, items=options['items'], users=options['visitors'],
+                        images=0, password=PASSWORD, seed=options['seed'], stdout=self.stdout,
+                    )
+                    catalog = {
+                        'slugs': list(Item.objects.order_by('id').values_list('slug', flat=True)),
+                        'category_ids': list(Category.objects.order_by('id').values_list('id', flat=True)),
+                        'usernames': list(get_user_model().objects.order_by('id').values_list('username', flat=True)),
+                    }
+                    for mode in MODES:
+                        self.reset()
+                        results[mode] = self.run(mode, catalog, options)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.report(results)
+        if options['output']:
+            write_results(options['output'], results)
+
+    def reset(self):
+        Order.objects.all().delete()
+        Reservation.objects.all().delete()
+        OrderItem.objects.all().delete()
+        StockLevel.objects.update(reserved=0)
+        get_user_model().objects.update(last_login=None)
+        for cache in caches.all():
+            cache.clear()
+
+    def run(self, mode, catalog, options):
+        counter = WriteCounter()
+        requests = 0
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            for index in range(options['visitors']):
+                requests += self.visit(mode, index, catalog, options)
+        elapsed = time.perf_counter() - start
+        return {
+            'requests': requests,
+            'queries': counter.queries,
+            'writes': counter.writes,
+            'writes_per_request': counter.writes / requests,
+            'queries_per_request': counter.queries / requests,
+            'tables': dict(counter.tables.most_common()),
+            'open_orders': Order.objects.filter(ordered=False).count(),
+            'elapsed_s': elapsed,
+        }
+
+    def visit(self, mode, index, catalog, options):
+        # The same visits in both modes
+        rnd = random.Random(f'{options["seed"]}:{index}')
+        uses_cart = rnd.random() < options['cart_rate']
+        converts = uses_cart and rnd.random() < options['convert_rate'] / options['cart_rate']
+        adds = set(rnd.sample(range(options['views']), min(options['adds'], options['views']))) if uses_cart else ()
+        client = Client()
+        logged_in = False
+        requests = 0
+
+        def get(url):
+            nonlocal requests
+            requests += 1
+            return client.get(url)
+
+        def login():
+            nonlocal requests, logged_in
+            requests += 1
+            response = client.post('/accounts/login/', {'login': catalog['usernames'][index], 'password': PASSWORD})
+            logged_in = response.status_code == 302
+
+        for view in range(options['views']):
+            kind = rnd.random()
+            if kind < 0.2:
+                get('/')
+            elif kind < 0.4:
+                get(f'/?category={rnd.choice(catalog["category_ids"])}')
+            else:
+                get(f'/product/{rnd.choice(catalog["slugs"])}/')
+            if view in adds:
+                if mode == 'login' and not logged_in:
+                    login()
+                get(f'/add-to-card/{rnd.choice(catalog["slugs"])}')
+                get('/order-summary/')
+        if converts:
+            if not logged_in:
+                login()
+            get('/order-summary/')
+            get('/checkout/')
+        return requests
+
+    def report(self, results):
+        self.stdout.write(
+            f'\n{"mode":<24}{"requests":>9}{"queries/req":>13}{"writes":>8}{"writes/req":>12}{"open orders":>13}'
+        )
+        for mode, description in MODES.items():
+            stats = results[mode]
+            self.stdout.write(
+                f'{description:<24}{stats["requests"]:>9}{stats["queries_per_request"]:>13.2f}'
+                f'{stats["writes"]:>8}{stats["writes_per_request"]:>12.3f}{stats["open_orders"]:>13}'
+            )
+        before, after = results['login']['writes'], results['anonymous']['writes']
+        if before:
+            self.stdout.write(f'\nWrites down {(before - after) / before * 100:.0f}% with anonymous carts')
+        for mode, description in MODES.items():
+            tables = ', '.join(f'{table} {count}' for table, count in results[mode]['tables'].items())
+            self.stdout.write(f'{description}: {tables or "no writes"}')
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import secrets
+import subprocess
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.bench import SERVERS, login_session, summarize, test_database, wait_for_port, write_results
+from core.fake_stripe import make_server, server_url
+from core.models import Category, Item, Order, OrderItem, Payment
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test checkouts (add to cart, pay, wait for the charge) against '
+        'one gunicorn WSGI process and one uvicorn ASGI process, charging a '
+        'local fake Stripe server.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Concurrent shoppers.')
+        parser.add_argument('--checkouts', type=int, default=4, help='Checkouts per shopper.')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of the WSGI worker and its charge pool.')
+        parser.add_argument('--latency', type=float, default=0.3, help='Seconds the fake gateway takes per charge.')
+        parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['wsgi', 'asgi'])
+        parser.add_argument('--port', type=int, default=8731)
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        if httpx is None:
+            raise CommandError('bench_checkout needs httpx.')
+        gateway = make_server(latency=options['latency'])
+        threading.Thread(target=gateway.serve_forever, daemon=True).start()
+
+        path = os.path.join(options['dir'], 'bench_checkout.sqlite3')
+        results = {'options': {k: options[k] for k in ('clients', 'checkouts', 'threads', 'latency')}}
+        try:
+            with test_database(path):
+                sessions = self.seed(options['clients'])
+                connection.close()
+                self.stdout.write(f'{"server":<8}{"checkouts/s":>13}{"p50":>10}{"p95":>10}{"failed":>8}')
+                for name in options['servers']:
+                    self.reset()
+                    results[name] = self.run(name, path, sessions, server_url(gateway), options)
+                    stats = results[name]
+                    self.stdout.write(
+                        f'{name:<8}{stats["checkouts_per_s"]:>13.1f}{stats["latency"]["p50_ms"]:>8.0f}ms'
+                        f'{stats["latency"]["p95_ms"]:>8.0f}ms{stats["failed"]:>8}'
+                    )
+        finally:
+            gateway.shutdown()
+            gateway.server_close()
+
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, clients):
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title=f'Item {i}', price=10 + i, category=category, label='P', slug=f'item-{i}')
+            for i in range(20)
+        ])
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'shopper-{i}') for i in range(clients)])
+        return [login_session(user) for user in User.objects.order_by('id')]
+
+    def reset(self):
+        Payment.objects.all().delete()
+        Order.objects.all().delete()
+        OrderItem.objects.all().delete()
+        connection.close()
+
+    def run(self, name, path, sessions, gateway_url, options):
+        port = options['port']
+        env = dict(
+            os.environ,
+            SQLITE_PATH=path,
+            SQLITE_WAL='1',
+            STRIPE_API_BASE=gateway_url,
+            ASYNC_VIEWS='1' if name == 'asgi' else '0',
+            BACKGROUND_WORKERS=str(options['threads']),
+        )
+        server = subprocess.Popen(SERVERS[name](port, options['threads']), env=env, cwd=settings.BASE_DIR)
+        try:
+            wait_for_port(port, server)
+            return asyncio.run(self.load(f'http://127.0.0.1:{port}', sessions, options))
+        finally:
+            server.terminate()
+            server.wait()
+
+    async def load(self, base_url, sessions, options):
+        latencies = []
+        failed = 0
+
+        async def shopper(index, session_key):
+            nonlocal failed
+            csrf_token = secrets.token_hex(16)
+            async with httpx.AsyncClient(
+                base_url=base_url,
+                cookies={settings.SESSION_COOKIE_NAME: session_key, settings.CSRF_COOKIE_NAME: csrf_token},
+                headers={'X-CSRFToken': csrf_token},
+                timeout=60,
+            ) as client:
+                for checkout in range(options['checkouts']):
+                    start = time.perf_counter()
+                    status = await self.checkout(client, f'item-{(index + checkout) % 20}')
+                    latencies.append(time.perf_counter() - start)
+                    failed += status != Payment.SUCCEEDED
+
+        start = time.perf_counter()
+        await asyncio.gather(*(shopper(i, key) for i, key in enumerate(sessions)))
+        elapsed = time.perf_counter() - start
+        return {
+            'elapsed_s': elapsed,
+            'checkouts_per_s': len(latencies) / elapsed,
+            'failed': failed,
+            'latency': summarize(latencies),
+        }
+
+    async def checkout(self, client, slug):
+        response = await client.get(f'/add-to-card/{slug}')
+        if response.status_code != 302 or '/order-summary/' not in response.headers['location']:
+            return Payment.FAILED
+        response = await client.post('/payment/stripe/', data={'stripeToken': 'tok_visa'})
+        if response.status_code != 302 or '/payment/status/' not in response.headers['location']:
+            return Payment.FAILED
+        status_url = response.headers['location']
+        while True:
+            response = await client.get(status_url, params={'format': 'json'})
+            status = response.json()['status']
+            if status in (Payment.SUCCEEDED, Payment.FAILED):
+                return status
+            await asyncio.sleep(0.25)
@@ -0,0 +1,105 @@
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.bench import create_scratch_db, insert_rows, models_at, summarize, time_calls, write_results
+
+MODELS = ('Category', 'Item', 'Order', 'OrderItem')
+
+LOOKUPS = {
+    'open order by user': (
+        'SELECT "id" FROM "core_order" WHERE "user_id" = ? AND NOT "ordered"',
+        lambda rnd, o: (rnd.randint(1, o['users']),),
+    ),
+    'cart line by user and item': (
+        'SELECT "id", "quantity" FROM "core_orderitem" '
+        'WHERE "item_id" = ? AND "user_id" = ? AND NOT "ordered"',
+        lambda rnd, o: (rnd.randint(1, o['items']), rnd.randint(1, o['users'])),
+    ),
+    'item by slug': (
+        'SELECT "id" FROM "core_item" WHERE "slug" = ?',
+        lambda rnd, o: (f'item-{rnd.randint(1, o["items"])}',),
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed scratch SQLite databases with the schema before and after the '
+        'lookup indexes (migration 0008) and compare the cart lookup latency.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Order items to seed.')
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--items', type=int, default=20000)
+        parser.add_argument('--lookups', type=int, default=2000, help='Lookups timed per query.')
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch databases.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        schemas = {
+            'before': models_at('0007_order_totals', *MODELS),
+            'after': models_at('0008_lookup_indexes', *MODELS),
+        }
+        results = {'options': {k: options[k] for k in ('rows', 'users', 'items', 'lookups')}}
+        for label, models in schemas.items():
+            path = os.path.join(options['dir'], f'bench_indexes_{label}.sqlite3')
+            db = create_scratch_db(path, models)
+            start = time.perf_counter()
+            self.seed(db, options)
+            self.stdout.write(f'Seeded {label} schema in {time.perf_counter() - start:.1f}s')
+            results[label] = self.measure(db, options)
+            db.close()
+            os.remove(path)
+
+        self.report(results)
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, db, options):
+        rnd = random.Random(options['seed'])
+        users, items = options['users'], options['items']
+        now = '2021-06-01 00:00:00'
+        insert_rows(db, 'core_category', ['id', 'title'], ((i, f'Category {i}') for i in range(1, 11)))
+        insert_rows(
+            db, 'core_item',
+            ['id', 'title', 'price', 'discount_price', 'label', 'description', 'slug', 'category_id'],
+            ((i, f'Item {i}', 10.0, None, 'P', '', f'item-{i}', i % 10 + 1) for i in range(1, items + 1)),
+        )
+        # Four paid orders and one open cart per user
+        insert_rows(
+            db, 'core_order',
+            ['start_date', 'ordered_date', 'ordered', 'user_id', 'subtotal', 'discount_total', 'item_count'],
+            ((now, now, n < 4, user, 0, 0, 0) for user in range(1, users + 1) for n in range(5)),
+        )
+        insert_rows(
+            db, 'core_orderitem',
+            ['ordered', 'quantity', 'item_id', 'user_id'],
+            (
+                (rnd.random() < 0.9, rnd.randint(1, 3), rnd.randint(1, items), rnd.randint(1, users))
+                for _ in range(options['rows'])
+            ),
+        )
+
+    def measure(self, db, options):
+        results = {}
+        for name, (sql, make_params) in LOOKUPS.items():
+            rnd = random.Random(options['seed'])
+            calls = [(sql, make_params(rnd, options)) for _ in range(options['lookups'])]
+            samples = time_calls(lambda sql, params: db.execute(sql, params).fetchall(), calls)
+            results[name] = summarize(samples)
+        return results
+
+    def report(self, results):
+        self.stdout.write(f'{"lookup":<28}{"before p50":>12}{"after p50":>12}{"before p95":>12}{"after p95":>12}')
+        for name in LOOKUPS:
+            before, after = results['before'][name], results['after'][name]
+            self.stdout.write(
+                f'{name:<28}{before["p50_ms"]:>10.3f}ms{after["p50_ms"]:>10.3f}ms'
+                f'{before["p95_ms"]:>10.3f}ms{after["p95_ms"]:>10.3f}ms'
+            )
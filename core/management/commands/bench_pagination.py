@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from core.bench import compile_query, create_scratch_db, insert_rows, summarize, time_calls, write_results
+from core.models import Category, Item
+from core.views import HomeView
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a scratch SQLite catalog and compare the OFFSET paging of '
+        'Django\'s Paginator with the keyset paging of HomeView at deep pages.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--per-page', type=int, default=HomeView.paginate_by)
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per page.')
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        path = os.path.join(options['dir'], 'bench_pagination.sqlite3')
+        db = create_scratch_db(path, [Category, Item])
+        start = time.perf_counter()
+        self.seed(db, options)
+        self.stdout.write(f'Seeded {options["items"]} items in {time.perf_counter() - start:.1f}s')
+
+        view = HomeView()
+        view.request = RequestFactory().get('/')
+        queryset = view.get_queryset()
+        per_page = options['per_page']
+        scopes = {
+            'all items': (queryset, options['items']),
+            'one category': (
+                queryset.filter(category_id=1),
+                options['items'] // options['categories'],
+            ),
+        }
+
+        results = {'options': {k: options[k] for k in ('items', 'categories', 'per_page', 'repeat')}}
+        self.stdout.write(f'{"scope":<14}{"page":>9}{"offset p50":>14}{"keyset p50":>14}')
+        for scope, (scoped, size) in scopes.items():
+            count_sql, count_params = self.count_sql(scoped)
+            results[scope] = {}
+            for page in self.depths(size // per_page):
+                offset = (page - 1) * per_page
+                # Item ids are contiguous and categories interleaved, so the
+                # last row of the previous page is easy to compute
+                cursor = offset if scope == 'all items' else offset * options['categories']
+                offset_sql = compile_query(scoped[offset:offset + per_page])
+                keyset_sql = compile_query(scoped.filter(pk__gt=cursor)[:per_page + 1])
+
+                def run_offset():
+                    db.execute(count_sql, count_params).fetchall()
+                    db.execute(*offset_sql).fetchall()
+
+                def run_keyset():
+                    db.execute(*keyset_sql).fetchall()
+
+                timings = {
+                    'offset': summarize(time_calls(run_offset, [()] * options['repeat'])),
+                    'keyset': summarize(time_calls(run_keyset, [()] * options['repeat'])),
+                }
+                results[scope][page] = timings
+                self.stdout.write(
+                    f'{scope:<14}{page:>9}{timings["offset"]["p50_ms"]:>12.3f}ms'
+                    f'{timings["keyset"]["p50_ms"]:>12.3f}ms'
+                )
+
+        db.close()
+        os.remove(path)
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, db, options):
+        categories = options['categories']
+        insert_rows(db, 'core_category', ['id', 'title'], ((i, f'Category {i}') for i in range(1, categories + 1)))
+        insert_rows(
+            db, 'core_item',
+            ['id', 'title', 'price', 'label', 'description', 'slug', 'category_id', 'image_hash'],
+            (
+                (i, f'Item {i}', 10.0, 'P', 'Description', f'item-{i}', (i - 1) % categories + 1, '')
+                for i in range(1, options['items'] + 1)
+            ),
+        )
+
+    def count_sql(self, queryset):
+        # The query Django's Paginator runs before every page
+        sql, params = compile_query(queryset.order_by().values('pk'))
+        return f'SELECT COUNT(*) FROM ({sql})', params
+
+    def depths(self, pages):
+        depth = 1
+        while depth < pages:
+            yield depth
+            depth *= 10
+        yield pages
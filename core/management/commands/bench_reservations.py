@@ -0,0 +1,141 @@
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+
+from core import cart
+from core.bench import summarize, test_database, write_results
+from core.models import Category, Item, OrderItem, Reservation, StockLevel
+
+
+class Command(BaseCommand):
+    help = (
+        'Hammer a few stocked items with concurrent add-to-cart and remove '
+        'calls, and report reservations per second on SQLite with and '
+        'without WAL. Fails if any item is oversold.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--calls', type=int, default=300, help='Cart calls per thread.')
+        parser.add_argument('--items', type=int, default=5, help='Stocked items, fewer means more contention.')
+        parser.add_argument('--stock', type=int, default=200, help='Units on hand per item.')
+        parser.add_argument('--journal', nargs='+', choices=('delete', 'wal'), default=['delete', 'wal'])
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_reservations measures SQLite journal modes and needs the sqlite3 backend.')
+        results = {'options': {k: options[k] for k in ('threads', 'calls', 'items', 'stock')}}
+        self.stdout.write(
+            f'{"journal":<9}{"reserved/s":>12}{"p50":>10}{"p95":>10}{"sold out":>10}{"errors":>8}'
+        )
+        # Every connection, including those of the worker threads, applies
+        # the configured pragmas (core.backends.sqlite3)
+        pragmas = connection.settings_dict['OPTIONS'].setdefault('pragmas', {})
+        configured = pragmas.get('journal_mode')
+        for journal in options['journal']:
+            path = os.path.join(options['dir'], f'bench_reservations_{journal}.sqlite3')
+            pragmas['journal_mode'] = journal
+            with test_database(path):
+                with connection.cursor() as cursor:
+                    cursor.execute(f'PRAGMA journal_mode={journal}')
+                self.seed(options)
+                connection.close()
+                stats = results[journal] = self.run(options)
+                self.check_stock()
+            self.stdout.write(
+                f'{journal:<9}{stats["reservations_per_s"]:>12.0f}{stats["latency"]["p50_ms"]:>8.1f}ms'
+                f'{stats["latency"]["p95_ms"]:>8.1f}ms{stats["sold_out"]:>10}{stats["errors"]:>8}'
+            )
+
+        if configured is None:
+            del pragmas['journal_mode']
+        else:
+            pragmas['journal_mode'] = configured
+
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, options):
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title=f'Item {i}', price=10, category=category, label='P', slug=f'item-{i}')
+            for i in range(options['items'])
+        ])
+        StockLevel.objects.bulk_create([
+            StockLevel(item=item, on_hand=options['stock']) for item in Item.objects.all()
+        ])
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'shopper-{i}') for i in range(options['threads'])])
+
+    def run(self, options):
+        users = list(get_user_model().objects.order_by('id'))
+        lock = threading.Lock()
+        latencies = []
+        counts = {'reserved': 0, 'sold_out': 0, 'errors': 0}
+
+        def shopper(index):
+            rnd = random.Random(options['seed'] + index)
+            user = users[index]
+            samples, reserved, sold_out, errors = [], 0, 0, 0
+            try:
+                for call in range(options['calls']):
+                    slug = f'item-{rnd.randrange(options["items"])}'
+                    start = time.perf_counter()
+                    try:
+                        # Mostly adds, with the odd emptied line to churn
+                        if call % 10 == 9:
+                            cart.remove_item(user, slug)
+                        else:
+                            status = cart.add_item(user, slug)
+                            reserved += status in (cart.ADDED, cart.UPDATED)
+                            sold_out += status == cart.OUT_OF_STOCK
+                    except Exception:
+                        # Lock errors that outlasted retry_on_lock
+                        errors += 1
+                    samples.append(time.perf_counter() - start)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(samples)
+                counts['reserved'] += reserved
+                counts['sold_out'] += sold_out
+                counts['errors'] += errors
+
+        workers = [threading.Thread(target=shopper, args=(i,)) for i in range(options['threads'])]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        return {
+            'elapsed_s': elapsed,
+            'reservations_per_s': counts['reserved'] / elapsed,
+            'calls_per_s': len(latencies) / elapsed,
+            'latency': summarize(latencies),
+            **counts,
+        }
+
+    def check_stock(self):
+        held = dict(
+            Reservation.objects.values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+        )
+        in_carts = dict(
+            OrderItem.objects.filter(ordered=False).values('item_id')
+            .annotate(total=Sum('quantity')).values_list('item_id', 'total')
+        )
+        for stock in StockLevel.objects.all():
+            if stock.reserved > stock.on_hand or stock.reserved != held.get(stock.item_id, 0):
+                raise CommandError(f'Item {stock.item_id} is oversold: {stock}')
+            if in_carts.get(stock.item_id, 0) != stock.reserved:
+                raise CommandError(f'Item {stock.item_id} has {in_carts.get(stock.item_id, 0)} in carts: {stock}')
@@ -0,0 +1,105 @@
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.bench import create_scratch_db, insert_rows, summarize, time_calls, write_results
+from core.models import Category, Item
+from core.search import FTS_CREATE_SQL, FTS_INSERT_SQL, FTS_SEARCH_SQL, match_query
+
+# Words found in a large share of the catalog
+COMMON_WORDS = (
+    'leather cotton linen wool silk denim canvas suede velvet nylon '
+    'boots sneakers sandals shirt jacket coat dress skirt scarf hat '
+    'black white red blue green grey brown navy olive beige '
+    'summer winter classic slim vintage light heavy soft waterproof running'
+).split()
+SYLLABLES = 'ba ko ri tu me sa lo ni da ve po zu ga hi fe'.split()
+
+
+class Command(BaseCommand):
+    help = 'Seed a scratch SQLite catalog with its FTS5 index and time ranked search and autocomplete queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=500, help='Timed queries per kind.')
+        parser.add_argument(
+            '--like', type=int, default=20, metavar='N',
+            help='Also time N unindexed LIKE searches, for comparison (0 to skip).',
+        )
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        path = os.path.join(options['dir'], 'bench_search.sqlite3')
+        db = create_scratch_db(path, [Category, Item])
+        rnd = random.Random(options['seed'])
+        # Brand and model names, each shared by a handful of items
+        names = sorted({
+            ''.join(rnd.choice(SYLLABLES) for _ in range(4))
+            for _ in range(max(options['items'] // 20, 100))
+        })
+
+        start = time.perf_counter()
+        self.seed(db, rnd, options['items'], names)
+        db.execute(FTS_CREATE_SQL)
+        db.execute(FTS_INSERT_SQL)
+        db.commit()
+        self.stdout.write(f'Seeded and indexed {options["items"]} items in {time.perf_counter() - start:.1f}s')
+
+        search_sql = FTS_SEARCH_SQL.replace('%s', '?')
+        kinds = {
+            'name': lambda: match_query(rnd.choice(names)),
+            'common word': lambda: match_query(rnd.choice(COMMON_WORDS)),
+            'two words': lambda: match_query(f'{rnd.choice(COMMON_WORDS)} {rnd.choice(names)}'),
+            'autocomplete': lambda: match_query(rnd.choice(names)[:4], column='title', prefix=True),
+        }
+        results = {'options': {k: options[k] for k in ('items', 'queries')}}
+        for kind, make_query in kinds.items():
+            calls = [(make_query(),) for _ in range(options['queries'])]
+            samples = time_calls(lambda query: db.execute(search_sql, [query, 40]).fetchall(), calls)
+            results[kind] = summarize(samples)
+
+        if options['like']:
+            like_sql = (
+                'SELECT id FROM core_item WHERE title LIKE ? OR description LIKE ? '
+                'ORDER BY id LIMIT 40'
+            )
+            calls = [(f'%{rnd.choice(names)}%',) for _ in range(options['like'])]
+            samples = time_calls(lambda pattern: db.execute(like_sql, [pattern, pattern]).fetchall(), calls)
+            results['LIKE name'] = summarize(samples)
+
+        self.stdout.write(f'{"query":<16}{"p50":>10}{"p95":>10}{"p99":>10}')
+        for kind, stats in results.items():
+            if kind != 'options':
+                self.stdout.write(
+                    f'{kind:<16}{stats["p50_ms"]:>8.2f}ms{stats["p95_ms"]:>8.2f}ms{stats["p99_ms"]:>8.2f}ms'
+                )
+
+        db.close()
+        os.remove(path)
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, db, rnd, count, names):
+        insert_rows(db, 'core_category', ['id', 'title'], ((i, COMMON_WORDS[i]) for i in range(1, 21)))
+        insert_rows(
+            db, 'core_item',
+            ['id', 'title', 'price', 'label', 'description', 'slug', 'category_id', 'image_hash'],
+            (
+                (
+                    i,
+                    f'{rnd.choice(names)} {" ".join(rnd.sample(COMMON_WORDS, 2))}',
+                    10.0,
+                    'P',
+                    f'{rnd.choice(names)} {" ".join(rnd.sample(COMMON_WORDS, 6))}',
+                    f'item-{i}',
+                    rnd.randint(1, 20),
+                    '',
+                )
+                for i in range(1, count + 1)
+            ),
+        )
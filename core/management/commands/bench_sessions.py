@@ -0,0 +1,144 @@
+import os
+import random
+import shutil
+import tempfile
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+
+from core.bench import run_info, test_database, write_results
+from core.models import Item, Order, OrderItem, Reservation, StockLevel
+
+# Session store and message storage of each profile
+PROFILES = {
+    # Django's defaults, as before
+    'db': ('django.contrib.sessions.backends.db', 'django.contrib.messages.storage.fallback.FallbackStorage'),
+    'cached_db': ('django.contrib.sessions.backends.cached_db', 'django.contrib.messages.storage.cookie.CookieStorage'),
+    'cache': ('django.contrib.sessions.backends.cache', 'django.contrib.messages.storage.cookie.CookieStorage'),
+}
+SESSION_TABLE = Session._meta.db_table
+
+
+class QueryCounter:
+    # Queries, and those on the session table, by step
+
+    def __init__(self):
+        self.step = None
+        self.queries = defaultdict(int)
+        self.session_queries = defaultdict(int)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries[self.step] += 1
+        if f'"{SESSION_TABLE}"' in sql:
+            self.session_queries[self.step] += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        'Count the queries per request of a signed-in cart flow with each '
+        'session store: db (Django\'s default, with the fallback message '
+        'storage), cached_db and cache (with cookie messages).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=list(PROFILES))
+        parser.add_argument('--iterations', type=int, default=20, help='Runs of the cart flow per profile.')
+        parser.add_argument('--items', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        results = {'run': run_info(), 'options': {k: options[k] for k in ('iterations', 'items', 'seed')}}
+        path = os.path.join(options['dir'], 'bench_sessions.sqlite3')
+        media_root = tempfile.mkdtemp(prefix='bench_sessions_media_')
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                with test_database(path):
+                    call_command(
+                        'seed_storefront', categories=5, items=options['items'], users=1, images=0,
+                        seed=options['seed'], stdout=self.stdout,
+                    )
+                    slugs = list(Item.objects.order_by('id').values_list('slug', flat=True))
+                    user = get_user_model().objects.get()
+                    for profile in options['profiles']:
+                        self.reset()
+                        engine, message_storage = PROFILES[profile]
+                        with override_settings(SESSION_ENGINE=engine, MESSAGE_STORAGE=message_storage):
+                            results[profile] = self.run(user, slugs, options)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.report(results, options['profiles'])
+        if options['output']:
+            write_results(options['output'], results)
+
+    def reset(self):
+        Order.objects.all().delete()
+        Reservation.objects.all().delete()
+        OrderItem.objects.all().delete()
+        StockLevel.objects.update(reserved=0)
+        Session.objects.all().delete()
+        for cache in caches.all():
+            cache.clear()
+
+    def run(self, user, slugs, options):
+        rnd = random.Random(options['seed'])
+        # A new client per profile, its middleware reads SESSION_ENGINE
+        client = Client()
+        client.force_login(user)
+        counter = QueryCounter()
+        requests = defaultdict(int)
+
+        def get(step, url):
+            counter.step = step
+            requests[step] += 1
+            client.get(url)
+
+        with connection.execute_wrapper(counter):
+            for _ in range(options['iterations']):
+                picked = rnd.sample(slugs, 3)
+                get('home', '/')
+                get('product', f'/product/{picked[0]}/')
+                for slug in picked:
+                    get('add to cart', f'/add-to-card/{slug}')
+                get('order summary', '/order-summary/')
+                get('decrease quantity', f'/remove-item-from-card/{picked[0]}')
+                get('checkout page', '/checkout/')
+                for slug in picked:
+                    get('remove from cart', f'/remove-from-card/{slug}')
+        total = sum(requests.values())
+        return {
+            'requests': total,
+            'queries_per_request': sum(counter.queries.values()) / total,
+            'session_queries_per_request': sum(counter.session_queries.values()) / total,
+            'steps': {
+                step: {
+                    'queries': counter.queries[step] / count,
+                    'session_queries': counter.session_queries[step] / count,
+                }
+                for step, count in requests.items()
+            },
+        }
+
+    def report(self, results, profiles):
+        self.stdout.write('\nQueries per request (of which on the session table)')
+        self.stdout.write(f'{"step":<20}' + ''.join(f'{profile:>16}' for profile in profiles))
+        for step in results[profiles[0]]['steps']:
+            cells = []
+            for profile in profiles:
+                stats = results[profile]['steps'][step]
+                cells.append(f'{stats["queries"]:>9.1f} ({stats["session_queries"]:.1f})')
+            self.stdout.write(f'{step:<20}' + ''.join(f'{cell:>16}' for cell in cells))
+        cells = [
+            f'{results[profile]["queries_per_request"]:>9.2f} ({results[profile]["session_queries_per_request"]:.1f})'
+            for profile in profiles
+        ]
+        self.stdout.write(f'{"all":<20}' + ''.join(f'{cell:>16}' for cell in cells))
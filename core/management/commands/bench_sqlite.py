@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import cart, payments
+from core.bench import summarize, test_database, write_results
+from core.models import Category, Item, StockLevel
+
+PROFILES = {
+    # Django's sqlite3 backend as configured before: rollback journal,
+    # deferred transactions, a 5 second busy timeout, a connection per call
+    'default': {'SQLITE_TUNING': '0'},
+    # ecommerce/settings.py with SQLITE_WAL: WAL, IMMEDIATE transactions,
+    # pragmas and persistent connections
+    'tuned': {'SQLITE_TUNING': '1', 'SQLITE_WAL': '1'},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Run cart and checkout writes from several processes against one '
+        'SQLite file, with Django\'s default SQLite settings and with the '
+        'tuned profile, and compare throughput and lock errors.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--calls', type=int, default=200, help='Cart calls per process.')
+        parser.add_argument('--items', type=int, default=20)
+        parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=['default', 'tuned'])
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        # Used by the processes this command starts
+        parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--start-at', type=float, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker'] is not None:
+            return self.work(options)
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_sqlite needs the sqlite3 backend.')
+
+        results = {'options': {k: options[k] for k in ('processes', 'calls', 'items')}}
+        self.stdout.write(f'{"profile":<9}{"calls/s":>10}{"p50":>10}{"p95":>10}{"p99":>10}{"errors":>8}')
+        for profile in options['profiles']:
+            path = os.path.join(options['dir'], f'bench_sqlite_{profile}.sqlite3')
+            with test_database(path):
+                self.seed(options)
+                # The journal mode is stored in the file, set it before the
+                # workers open it
+                with connection.cursor() as cursor:
+                    cursor.execute(f'PRAGMA journal_mode={"wal" if profile == "tuned" else "delete"}')
+                connection.close()
+                stats = results[profile] = self.run(path, profile, options)
+            self.stdout.write(
+                f'{profile:<9}{stats["calls_per_s"]:>10.0f}{stats["latency"]["p50_ms"]:>8.1f}ms'
+                f'{stats["latency"]["p95_ms"]:>8.1f}ms{stats["latency"]["p99_ms"]:>8.1f}ms{stats["errors"]:>8}'
+            )
+
+        if options['output']:
+            write_results(options['output'], results)
+
+    def seed(self, options):
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title=f'Item {i}', price=10 + i, category=category, label='P', slug=f'item-{i}')
+            for i in range(options['items'])
+        ])
+        # Half the items are stocked, so adds also go through core.inventory
+        StockLevel.objects.bulk_create([
+            StockLevel(item=item, on_hand=10 ** 6) for item in Item.objects.order_by('id')[::2]
+        ])
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'shopper-{i}') for i in range(options['processes'])])
+
+    def run(self, path, profile, options):
+        env = dict(os.environ, SQLITE_PATH=path, **PROFILES[profile])
+        # Every process starts its timed loop at the same moment, after
+        # Django has been set up everywhere
+        start_at = time.time() + 3
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable, 'manage.py', 'bench_sqlite',
+                    '--worker', str(i), '--start-at', str(start_at),
+                    '--calls', str(options['calls']), '--items', str(options['items']),
+                ],
+                env=env, cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+            )
+            for i in range(options['processes'])
+        ]
+        reports = []
+        for worker in workers:
+            out, _ = worker.communicate()
+            if worker.returncode:
+                raise CommandError(f'A worker exited with status {worker.returncode}')
+            reports.append(json.loads(out))
+        elapsed = max(report['finished_at'] for report in reports) - start_at
+        latencies = [sample for report in reports for sample in report['latencies']]
+        return {
+            'elapsed_s': elapsed,
+            'calls_per_s': len(latencies) / elapsed,
+            'latency': summarize(latencies),
+            'errors': sum(report['errors'] for report in reports),
+        }
+
+    def work(self, options):
+        rnd = random.Random(options['worker'])
+        user = get_user_model().objects.get(username=f'shopper-{options["worker"]}')
+        calls = [
+            (cart.add_item, f'item-{rnd.randrange(options["items"])}') if n % 10 < 7 else
+            (cart.remove_single_item, f'item-{rnd.randrange(options["items"])}') if n % 10 < 9 else
+            (self.checkout, None)
+            for n in range(options['calls'])
+        ]
+        latencies = []
+        errors = 0
+        time.sleep(max(options['start_at'] - time.time(), 0))
+        for func, slug in calls:
+            start = time.perf_counter()
+            try:
+                func(user, slug)
+            except Exception:
+                # Lock errors that outlasted the busy timeout and retries
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+        self.stdout.write(json.dumps({'latencies': latencies, 'errors': errors, 'finished_at': time.time()}))
+
+    def checkout(self, user, slug):
+        # The payment write path without a gateway: start, claim, succeed
+        payment = payments.start_payment(user, 'tok_visa', enqueue=False)
+        if payment is None:
+            return
+        claimed = payments.claim_payment(payment.pk)
+        if claimed is not None:
+            payments.settle_payment(claimed, charge_id=f'ch_bench_{payment.pk}')
@@ -0,0 +1,377 @@
+import json
+import os
+import random
+import re
+import secrets
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from core.bench import SERVERS, login_session, run_info, summarize, test_database, wait_for_port, write_results
+from core.models import Category, Item, Order, OrderItem, Payment, Reservation, StockLevel
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Queries per request, from the Server-Timing header of core.metrics
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+SEARCH_TERMS = ['jacket', 'boots', 'waterproof', 'cotton sweater', 'sport']
+CHECKOUT_FORM = {
+    'street_address': '1 Main Street',
+    'country': 'US',
+    'zip': '10001',
+    'payment_option': 'S',
+}
+SCENARIOS = ('browse', 'product', 'cart', 'checkout')
+# Scenarios of a logged in shopper, the others are anonymous
+LOGGED_IN = {'cart', 'checkout'}
+
+
+class Session:
+    # One shopper: times each request under its step name and reads the
+    # query count the server reports
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = 0
+
+    def get(self, step, url):
+        return self.call(step, 'get', url)
+
+    def post(self, step, url, data):
+        return self.call(step, 'post', url, data)
+
+    def call(self, step, method, url, data=None):
+        start = time.perf_counter()
+        response = self.send(method, url, data)
+        self.timings[step].append(time.perf_counter() - start)
+        match = QUERIES_RE.search(response.headers.get('Server-Timing', ''))
+        if match:
+            self.queries[step].append(int(match.group(1)))
+        if response.status_code >= 400:
+            self.errors += 1
+        return response
+
+
+class ClientSession(Session):
+    # In process, through the Django test client: no network or server
+    # overhead, so the numbers are the application's own
+
+    def __init__(self, user=None):
+        super().__init__()
+        self.client = Client()
+        if user is not None:
+            self.client.force_login(user)
+
+    def send(self, method, url, data):
+        return getattr(self.client, method)(url, data)
+
+    def close(self):
+        pass
+
+
+class LiveSession(Session):
+
+    def __init__(self, base_url, user=None):
+        super().__init__()
+        csrf_token = secrets.token_hex(16)
+        cookies = {settings.CSRF_COOKIE_NAME: csrf_token}
+        if user is not None:
+            cookies[settings.SESSION_COOKIE_NAME] = login_session(user)
+        self.client = httpx.Client(
+            base_url=base_url, cookies=cookies, headers={'X-CSRFToken': csrf_token}, timeout=60,
+        )
+
+    def send(self, method, url, data):
+        if method == 'post':
+            return self.client.post(url, data=data)
+        return self.client.get(url)
+
+    def close(self):
+        self.client.close()
+
+
+def location(response):
+    return response.headers.get('Location', '')
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway storefront and time scripted shopper journeys: '
+        'browsing, product pages, cart changes, and checkout with payment '
+        'through a stub gateway. Reports p50/p95/p99 latency and queries per '
+        'request, in process through the Django test client and against a '
+        'live local server, and compares with a previous results file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--images', type=int, default=10, help='Distinct item images, see seed_storefront.')
+        parser.add_argument('--iterations', type=int, default=50, help='Timed runs of each scenario per client.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed runs of each scenario first.')
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+        parser.add_argument(
+            '--modes', nargs='+', choices=['client', *sorted(SERVERS)], default=['client', 'wsgi'],
+            help='client runs in this process, wsgi and asgi against a local server.',
+        )
+        parser.add_argument('--clients', type=int, default=4, help='Concurrent shoppers against a live server.')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of the WSGI worker.')
+        parser.add_argument('--port', type=int, default=8732)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dir', default=tempfile.gettempdir(), help='Where to create the scratch database.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', metavar='RESULTS', help='A previous --output file to compare with.')
+        parser.add_argument(
+            '--max-regression', type=float, metavar='PERCENT',
+            help='With --compare, fail if a step\'s p95 grew by more than this, or its queries grew at all.',
+        )
+
+    def handle(self, *args, **options):
+        live_modes = [mode for mode in options['modes'] if mode != 'client']
+        if live_modes and httpx is None:
+            raise CommandError('Benchmarking a live server needs httpx.')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        path = os.path.join(options['dir'], 'bench_storefront.sqlite3')
+        media_root = tempfile.mkdtemp(prefix='bench_storefront_media_')
+        keys = ('categories', 'items', 'images', 'iterations', 'warmup', 'scenarios', 'clients', 'threads', 'seed')
+        results = {'run': run_info(), 'options': {k: options[k] for k in keys}}
+        # The stub gateway charges in process, in the server or here
+        try:
+            with override_settings(MEDIA_ROOT=media_root, PAYMENT_GATEWAY='core.payments.FakeGateway'):
+                with test_database(path):
+                    call_command(
+                        'seed_storefront', categories=options['categories'], items=options['items'],
+                        users=max(options['clients'], 1), images=options['images'], seed=options['seed'],
+                        stdout=self.stdout,
+                    )
+                    catalog = self.catalog()
+                    for mode in options['modes']:
+                        self.reset()
+                        if mode == 'client':
+                            results[mode] = self.run_client(catalog, options)
+                        else:
+                            results[mode] = self.run_live(mode, path, media_root, catalog, options)
+                        self.report(mode, results[mode])
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        if options['output']:
+            write_results(options['output'], results)
+        if baseline is not None:
+            self.compare(baseline, results, options['max_regression'])
+
+    def catalog(self):
+        return {
+            'slugs': list(Item.objects.order_by('id').values_list('slug', flat=True)),
+            'item_ids': list(Item.objects.order_by('id').values_list('id', flat=True)),
+            'category_ids': list(Category.objects.order_by('id').values_list('id', flat=True)),
+            'users': list(get_user_model().objects.order_by('id')),
+        }
+
+    def reset(self):
+        # Every mode starts from the seeded catalog, empty carts and cold caches
+        Payment.objects.all().delete()
+        Order.objects.all().delete()
+        Reservation.objects.all().delete()
+        OrderItem.objects.all().delete()
+        StockLevel.objects.update(reserved=0)
+        for cache in caches.all():
+            cache.clear()
+        connection.close()
+
+    # Scenarios: each is one visit, made of timed steps
+
+    def browse(self, session, rnd, catalog):
+        session.get('home', '/')
+        session.get('category', f'/?category={rnd.choice(catalog["category_ids"])}')
+        session.get('next page', f'/?after={rnd.choice(catalog["item_ids"])}')
+        session.get('search', f'/search/?q={rnd.choice(SEARCH_TERMS)}')
+
+    def product(self, session, rnd, catalog):
+        session.get('product', f'/product/{rnd.choice(catalog["slugs"])}/')
+
+    def cart(self, session, rnd, catalog):
+        slugs = rnd.sample(catalog['slugs'], 3)
+        for slug in slugs:
+            session.get('add to cart', f'/add-to-card/{slug}')
+        session.get('add to cart', f'/add-to-card/{slugs[0]}')
+        session.get('order summary', '/order-summary/')
+        session.get('decrease quantity', f'/remove-item-from-card/{slugs[0]}')
+        for slug in slugs:
+            session.get('remove from cart', f'/remove-from-card/{slug}')
+
+    def checkout(self, session, rnd, catalog):
+        for slug in rnd.sample(catalog['slugs'], 2):
+            session.get('add to cart', f'/add-to-card/{slug}')
+        session.get('checkout page', '/checkout/')
+        session.post('checkout submit', '/checkout/', CHECKOUT_FORM)
+        session.get('payment page', '/payment/stripe/')
+        response = session.post('pay', '/payment/stripe/', {'stripeToken': 'tok_visa'})
+        status_url = location(response)
+        if '/payment/status/' not in status_url:
+            session.errors += 1
+            return
+        # Both servers answer at once, poll until the charge settles
+        while True:
+            response = session.get('payment status', f'{status_url}?format=json')
+            status = json.loads(response.content)['status']
+            if status == Payment.FAILED:
+                session.errors += 1
+            if status in (Payment.SUCCEEDED, Payment.FAILED):
+                return
+            time.sleep(0.25)
+
+    def visit(self, session_for, index, catalog, options):
+        # Runs the scenarios for one shopper, returns their sessions
+        user = catalog['users'][index]
+        sessions = {}
+        for scenario in options['scenarios']:
+            # Seeded per scenario, so a run of some scenarios makes the same
+            # requests as a run of all of them
+            rnd = random.Random(f'{options["seed"]}:{index}:{scenario}')
+            session = sessions[scenario] = session_for(user if scenario in LOGGED_IN else None)
+            run = getattr(self, scenario)
+            for _ in range(options['warmup']):
+                run(session, rnd, catalog)
+            session.timings.clear()
+            session.queries.clear()
+            session.errors = 0
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                run(session, rnd, catalog)
+                session.timings['total'].append(time.perf_counter() - start)
+            session.close()
+        return sessions
+
+    def run_client(self, catalog, options):
+        start = time.perf_counter()
+        sessions = self.visit(ClientSession, 0, catalog, options)
+        return self.summarize([sessions], time.perf_counter() - start)
+
+    def run_live(self, mode, path, media_root, catalog, options):
+        port = options['port']
+        env = dict(
+            os.environ,
+            SQLITE_PATH=path,
+            SQLITE_WAL='1',
+            MEDIA_ROOT=media_root,
+            PAYMENT_GATEWAY='core.payments.FakeGateway',
+            ASYNC_VIEWS='1' if mode == 'asgi' else '0',
+            BACKGROUND_WORKERS=str(options['threads']),
+        )
+        server = subprocess.Popen(SERVERS[mode](port, options['threads']), env=env, cwd=settings.BASE_DIR)
+        try:
+            wait_for_port(port, server)
+            base_url = f'http://127.0.0.1:{port}'
+            shoppers = [None] * options['clients']
+
+            def shopper(index):
+                try:
+                    shoppers[index] = self.visit(
+                        lambda user: LiveSession(base_url, user), index, catalog, options,
+                    )
+                finally:
+                    connection.close()
+
+            workers = [threading.Thread(target=shopper, args=(i,)) for i in range(options['clients'])]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+        if None in shoppers:
+            raise CommandError(f'A {mode} shopper failed, see the traceback above')
+        return self.summarize(shoppers, elapsed)
+
+    def summarize(self, shoppers, elapsed):
+        results = {'elapsed_s': elapsed, 'requests': 0, 'errors': 0, 'scenarios': {}}
+        for scenario in shoppers[0]:
+            timings, queries = defaultdict(list), defaultdict(list)
+            for sessions in shoppers:
+                session = sessions[scenario]
+                results['errors'] += session.errors
+                for step, samples in session.timings.items():
+                    timings[step].extend(samples)
+                for step, counts in session.queries.items():
+                    queries[step].extend(counts)
+            steps = {}
+            for step, samples in timings.items():
+                steps[step] = {'latency': summarize(samples)}
+                if step != 'total':
+                    results['requests'] += len(samples)
+                if queries[step]:
+                    steps[step]['queries'] = {
+                        'mean': sum(queries[step]) / len(queries[step]),
+                        'max': max(queries[step]),
+                    }
+            results['scenarios'][scenario] = steps
+        results['requests_per_s'] = results['requests'] / elapsed
+        return results
+
+    def report(self, mode, results):
+        self.stdout.write(
+            f'\n{mode}: {results["requests"]} requests, {results["requests_per_s"]:.0f}/s, '
+            f'{results["errors"]} errors'
+        )
+        self.stdout.write(f'{"scenario":<10}{"step":<19}{"p50":>9}{"p95":>9}{"p99":>9}{"queries":>9}')
+        for scenario, steps in results['scenarios'].items():
+            for step, stats in steps.items():
+                latency = stats['latency']
+                queries = f'{stats["queries"]["mean"]:.1f}' if 'queries' in stats else '-'
+                self.stdout.write(
+                    f'{scenario:<10}{step:<19}{latency["p50_ms"]:>7.1f}ms{latency["p95_ms"]:>7.1f}ms'
+                    f'{latency["p99_ms"]:>7.1f}ms{queries:>9}'
+                )
+
+    def compare(self, baseline, results, max_regression):
+        commit = (baseline.get('run') or {}).get('commit') or 'unknown'
+        self.stdout.write(f'\nCompared with {commit[:12]}: p95 and queries per request')
+        regressions = []
+        for mode in ['client', *sorted(SERVERS)]:
+            if mode not in baseline or mode not in results:
+                continue
+            for scenario, steps in results[mode]['scenarios'].items():
+                for step, stats in steps.items():
+                    old = baseline[mode]['scenarios'].get(scenario, {}).get(step)
+                    if old is None:
+                        continue
+                    old_p95, new_p95 = old['latency']['p95_ms'], stats['latency']['p95_ms']
+                    change = (new_p95 - old_p95) / old_p95 * 100 if old_p95 else 0
+                    old_queries = old.get('queries', {}).get('mean')
+                    new_queries = stats.get('queries', {}).get('mean')
+                    queries = ''
+                    if old_queries is not None and new_queries is not None:
+                        queries = f'{old_queries:>6.1f} -> {new_queries:.1f}'
+                        if new_queries > old_queries:
+                            regressions.append(f'{mode} {scenario} {step}: queries {queries}')
+                    if max_regression is not None and change > max_regression:
+                        regressions.append(f'{mode} {scenario} {step}: p95 {change:+.0f}%')
+                    self.stdout.write(
+                        f'{mode:<7}{scenario:<10}{step:<19}{old_p95:>7.1f}ms -> {new_p95:>7.1f}ms'
+                        f'{change:>+6.0f}%  {queries}'
+                    )
+        if max_regression is not None and regressions:
+            raise CommandError('Regressions:\n' + '\n'.join(regressions))
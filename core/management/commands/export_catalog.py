@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.catalog import FORMATS, export_rows, guess_format, write_rows
+
+
+class Command(BaseCommand):
+    help = 'Write every item as CSV or JSON lines, in the format import_catalog reads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='The file to write, - for stdout.')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, csv for stdout.')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or guess_format(path)
+        start = time.perf_counter()
+        count = 0
+
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        if path == '-':
+            write_rows(self.stdout, format, counted(export_rows(options['batch_size'])))
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                write_rows(f, format, counted(export_rows(options['batch_size'])))
+        elapsed = time.perf_counter() - start
+        # On stderr, so stdout can be piped
+        self.stderr.write(f'Exported {count} items in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s)')
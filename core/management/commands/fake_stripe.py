@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from core.fake_stripe import make_server, server_url
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a local stand-in for the Stripe charges API, for load tests. '
+        'Point the app at it with the STRIPE_API_BASE environment variable.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.3, help='Seconds to wait before answering.')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with a 500.')
+        parser.add_argument('--decline-rate', type=float, default=0.0, help='Share of charges declined.')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--verbose', action='store_true', help='Log every request.')
+
+    def handle(self, *args, **options):
+        server = make_server(
+            options['host'], options['port'],
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            decline_rate=options['decline_rate'],
+            seed=options['seed'],
+            verbose=options['verbose'],
+        )
+        self.stdout.write(f'Fake Stripe listening on {server_url(server)}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'{server.charges} charges created.')
@@ -0,0 +1,84 @@
+import sys
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from core.caching import bump_catalog_version, invalidate_categories
+from core.catalog import FORMATS, CatalogImporter, guess_format, parse_row, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Create or update items, keyed by slug, and their categories, keyed '
+        'by title, from a CSV or JSON lines file in the export_catalog '
+        'format. The file is streamed and written in batches. Image '
+        'renditions are queued as image jobs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The file to import, - for stdin.')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, csv for stdin.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--image-workers', type=int, default=0,
+            help='Process the queued image jobs with this many threads after the import. '
+                 'By default they are left to process_image_jobs.',
+        )
+        parser.add_argument('--max-errors', type=int, default=100, help='Give up after this many invalid rows.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or guess_format(path)
+        importer = CatalogImporter()
+        errors = 0
+        start = time.perf_counter()
+        f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            batch = []
+            rows = read_rows(f, format)
+            while True:
+                try:
+                    line, row = next(rows)
+                except StopIteration:
+                    break
+                except ValidationError as exc:
+                    raise CommandError(exc.messages[0])
+                try:
+                    batch.append(parse_row(row))
+                except ValidationError as exc:
+                    errors += 1
+                    self.stderr.write(f'Line {line}: {"; ".join(exc.messages)}')
+                    if errors >= options['max_errors']:
+                        raise CommandError(f'Stopped after {errors} invalid rows')
+                    continue
+                if len(batch) >= options['batch_size']:
+                    self.write(importer, batch, start, options['verbosity'])
+                    batch = []
+            if batch:
+                self.write(importer, batch, start, options['verbosity'])
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            # Pages and search results of what was written are stale, even
+            # when the import stopped half way
+            if importer.new_categories:
+                invalidate_categories()
+            bump_catalog_version()
+
+        elapsed = time.perf_counter() - start
+        total = importer.created + importer.updated + importer.unchanged
+        self.stdout.write(
+            f'{total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s): {importer.created} created, '
+            f'{importer.updated} updated, {importer.unchanged} unchanged, {errors} invalid. '
+            f'{importer.image_jobs} image jobs queued.'
+        )
+        if importer.image_jobs and options['image_workers']:
+            call_command('process_image_jobs', workers=options['image_workers'], stdout=self.stdout)
+
+    def write(self, importer, batch, start, verbosity):
+        importer.import_batch(batch)
+        if verbosity >= 2:
+            total = importer.created + importer.updated + importer.unchanged
+            self.stdout.write(f'{total} rows, {total / (time.perf_counter() - start):.0f} rows/s')
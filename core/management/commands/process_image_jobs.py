@@ -0,0 +1,16 @@
+from core.images import pending_job_ids, process_image_job
+from core.models import ImageJob
+from core.worker import QueueCommand
+
+
+class Command(QueueCommand):
+    help = 'Generate the image renditions of pending jobs, outside of the web workers.'
+    model = ImageJob
+    pending, running = ImageJob.PENDING, ImageJob.RUNNING
+    noun = 'image jobs'
+
+    def pending_ids(self, limit):
+        return pending_job_ids(limit)
+
+    def process(self, job_id):
+        process_image_job(job_id)
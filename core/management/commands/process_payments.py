@@ -0,0 +1,32 @@
+from core.models import Payment
+from core.payments import pending_payment_ids, process_payment, refund_payment, unrefunded_payment_ids
+from core.worker import QueueCommand
+
+
+class Command(QueueCommand):
+    help = (
+        'Charge pending payments, outside of the web workers, and send '
+        'again the refunds that failed. Run it with --watch next to the web '
+        'workers: payments a restart interrupted are only charged here.'
+    )
+    # Safe to charge again, the idempotency key makes the gateway return
+    # the original charge if there was one
+    model = Payment
+    pending, running = Payment.PENDING, Payment.PROCESSING
+    noun = 'payments'
+    workers = 4
+    stale_after = 5
+
+    def run_once(self, **options):
+        super().run_once(**options)
+        refund_ids = unrefunded_payment_ids(options['limit'])
+        for payment_id in refund_ids:
+            refund_payment(payment_id)
+        if refund_ids:
+            self.stdout.write(f'Refunded {len(refund_ids)} payments.')
+
+    def pending_ids(self, limit):
+        return pending_payment_ids(limit)
+
+    def process(self, payment_id):
+        process_payment(payment_id)
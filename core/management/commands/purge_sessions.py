@@ -0,0 +1,63 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core.db import retry_on_lock
+
+BATCH_SIZE = 1000
+
+
+@retry_on_lock
+@transaction.atomic
+def delete_expired(model, now, batch_size):
+    # The oldest expired sessions, by the expire_date index, so that each
+    # transaction holds the write lock briefly. Returns how many were
+    # deleted.
+    keys = list(
+        model.objects.filter(expire_date__lt=now).order_by('expire_date').values_list('session_key', flat=True)[:batch_size]
+    )
+    if keys:
+        model.objects.filter(session_key__in=keys).delete()
+    return len(keys)
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired sessions from the database in batches, instead of '
+        'the single DELETE of clearsessions. Run it from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=0, metavar='SECONDS',
+            help='Sleep between batches, to leave the database to the site.',
+        )
+
+    def handle(self, *args, **options):
+        engine = import_module(settings.SESSION_ENGINE)
+        if not issubclass(engine.SessionStore, DatabaseSessionStore):
+            # The cache and cookie stores expire sessions themselves
+            self.stdout.write(f'{settings.SESSION_ENGINE} keeps no sessions in the database.')
+            return
+        model = engine.SessionStore.get_model_class()
+        # Sessions expiring while this runs are left to the next run
+        now = timezone.now()
+        start = time.perf_counter()
+        deleted = batches = 0
+        while True:
+            batch = delete_expired(model, now, options['batch_size'])
+            deleted += batch
+            batches += 1
+            if batch < options['batch_size']:
+                break
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(
+            f'Deleted {deleted} expired sessions in {batches} batches, {time.perf_counter() - start:.2f}s.'
+        )
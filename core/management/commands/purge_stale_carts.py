@@ -0,0 +1,70 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.purge import purge_orphaned_lines, purge_stale_carts, purge_unused_addresses
+
+# Rows reported, by the labels of QuerySet.delete()
+REPORTED = (
+    ('core.Order', 'orders'),
+    ('core.OrderItem', 'order lines'),
+    ('core.Order_items', 'order-line links'),
+    ('core.Reservation', 'stock holds'),
+    ('core.BillingAddress', 'billing addresses'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete unpaid carts not changed for --days, with their lines and '
+        'stock holds, then order lines in no order and billing addresses no '
+        'order uses. Works in short transactions over chunks of ids.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=30, help='Age of the carts to delete.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--pause', type=float, default=0, metavar='SECONDS',
+            help='Sleep between chunks, to leave the database to the site.',
+        )
+        parser.add_argument(
+            '--watch', type=float, metavar='SECONDS',
+            help='Keep purging at this interval.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.purge(options)
+            if options['watch'] is None:
+                break
+            time.sleep(options['watch'])
+
+    def purge(self, options):
+        start = time.perf_counter()
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted = Counter()
+        chunks = 0
+        for step in (
+            lambda after_id: purge_stale_carts(cutoff, after_id, options['batch_size']),
+            lambda after_id: purge_orphaned_lines(after_id, options['batch_size']),
+            lambda after_id: purge_unused_addresses(after_id, options['batch_size']),
+        ):
+            after_id = 0
+            while True:
+                after_id, counts = step(after_id)
+                if after_id is None:
+                    break
+                deleted.update(counts)
+                chunks += 1
+                if options['pause']:
+                    time.sleep(options['pause'])
+        elapsed = time.perf_counter() - start
+        total = sum(deleted.values())
+        rows = ', '.join(f'{deleted[label]} {name}' for label, name in REPORTED)
+        self.stdout.write(
+            f'Reclaimed {total} rows in {chunks} chunks, {elapsed:.2f}s ({total / elapsed:.0f} rows/s): {rows}'
+        )
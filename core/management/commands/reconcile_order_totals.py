@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.db import retry_on_lock
+from core.models import Order, order_totals_aggregates
+
+TOTAL_FIELDS = ('subtotal', 'discount_total', 'item_count')
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cart totals stored on Order and fix the ones that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Also reconcile orders that were already paid.',
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the drifted orders.',
+        )
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if not options['all']:
+            orders = orders.filter(ordered=False)
+        orders = orders.annotate(**{
+            f'computed_{name}': aggregate
+            for name, aggregate in order_totals_aggregates('items__').items()
+        }).order_by('pk')
+
+        checked = drifted = 0
+        last_pk = 0
+        while True:
+            batch = list(orders.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            checked += len(batch)
+            changed = [order.pk for order in batch if self.reconcile(order)]
+            if changed and not options['dry_run']:
+                drifted += self.fix(orders, changed)
+            else:
+                drifted += len(changed)
+
+        self.stdout.write(f'Checked {checked} orders, {drifted} drifted.')
+
+    @retry_on_lock
+    @transaction.atomic
+    def fix(self, orders, pks):
+        # Recomputed once the orders are locked, so that a cart change that
+        # committed since the batch was read is not overwritten
+        list(Order.objects.select_for_update().filter(pk__in=pks).values_list('pk', flat=True))
+        changed = [order for order in orders.filter(pk__in=pks) if self.reconcile(order)]
+        Order.objects.bulk_update(changed, TOTAL_FIELDS)
+        return len(changed)
+
+    def reconcile(self, order):
+        changed = False
+        for name in TOTAL_FIELDS:
+            computed = getattr(order, f'computed_{name}') or 0
+            # Decimals and counts, compared exactly
+            if getattr(order, name) != computed:
+                setattr(order, name, computed)
+                changed = True
+        return changed
@@ -0,0 +1,20 @@
+from core.inventory import SWEEP_BATCH_SIZE, release_expired
+from core.worker import WatchCommand
+
+
+class Command(WatchCommand):
+    help = 'Give the stock held by expired cart reservations back, in batches.'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE)
+
+    def run_once(self, **options):
+        released = 0
+        while True:
+            batch = release_expired(options['batch_size'])
+            released += batch
+            if batch < options['batch_size']:
+                break
+        if released:
+            self.stdout.write(f'Released {released} reservations.')
@@ -0,0 +1,130 @@
+import random
+import time
+from io import BytesIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image, ImageDraw
+
+from core.caching import bump_catalog_version, invalidate_categories
+from core.images import generate_renditions
+from core.models import Category, Item, StockLevel
+from core.money import from_cents
+from core.search import get_backend as get_search_backend
+
+# Seeded rows are recognisable by these, for --clear
+CATEGORY_PREFIX = 'Seed category'
+SLUG_PREFIX = 'seed-'
+USERNAME_PREFIX = 'shopper-'
+
+ADJECTIVES = ['Waterproof', 'Classic', 'Slim', 'Organic', 'Vintage', 'Light', 'Warm', 'Cotton', 'Leather', 'Sport']
+NOUNS = ['Jacket', 'Boots', 'Shirt', 'Backpack', 'Scarf', 'Sneakers', 'Hat', 'Jeans', 'Sweater', 'Gloves']
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed categories, items with generated images and stock, and shopper '
+        'accounts, for load tests and benchmarks. Users are shopper-<n> with '
+        'the --password given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument(
+            '--images', type=int, default=10,
+            help='Distinct generated images, shared by the items. 0 leaves items without images.',
+        )
+        parser.add_argument(
+            '--stock', type=int, default=10 ** 6,
+            help='Units on hand of every other item, the rest are not stock tracked.',
+        )
+        parser.add_argument('--password', default='shopper')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help='Delete previously seeded rows first.')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        if options['clear']:
+            self.clear()
+        elif Item.objects.filter(slug__startswith=SLUG_PREFIX).exists():
+            raise CommandError('The storefront is already seeded, use --clear to seed it again.')
+
+        start = time.perf_counter()
+        rnd = random.Random(options['seed'])
+        images = self.create_images(options['images'], rnd)
+        with transaction.atomic():
+            Category.objects.bulk_create([
+                Category(title=f'{CATEGORY_PREFIX} {i}') for i in range(options['categories'])
+            ])
+            categories = list(Category.objects.filter(title__startswith=CATEGORY_PREFIX).order_by('id'))
+            Item.objects.bulk_create(
+                (self.make_item(i, rnd, categories, images) for i in range(options['items'])),
+                batch_size=2000,
+            )
+            StockLevel.objects.bulk_create(
+                (
+                    StockLevel(item_id=item_id, on_hand=options['stock'])
+                    for item_id in Item.objects.filter(slug__startswith=SLUG_PREFIX).order_by('id')
+                    .values_list('id', flat=True)[::2]
+                ),
+                batch_size=2000,
+            )
+            # Hashed once, hashing per user would dominate the seeding time
+            password = make_password(options['password'])
+            User.objects.bulk_create(
+                (User(username=f'{USERNAME_PREFIX}{i}', password=password) for i in range(options['users'])),
+                batch_size=2000,
+            )
+            self.process_images(images)
+        # bulk_create skips the signals that keep these up to date
+        get_search_backend().rebuild()
+        invalidate_categories()
+        bump_catalog_version()
+        self.stdout.write(
+            f'Seeded {options["categories"]} categories, {options["items"]} items and '
+            f'{options["users"]} users in {time.perf_counter() - start:.1f}s'
+        )
+
+    def clear(self):
+        Item.objects.filter(slug__startswith=SLUG_PREFIX).delete()
+        Category.objects.filter(title__startswith=CATEGORY_PREFIX).delete()
+        get_user_model().objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    def create_images(self, count, rnd):
+        names = []
+        for i in range(count):
+            image = Image.new('RGB', (1200, 900), tuple(rnd.randrange(256) for _ in range(3)))
+            ImageDraw.Draw(image).ellipse((300, 150, 900, 750), fill=tuple(rnd.randrange(256) for _ in range(3)))
+            buffer = BytesIO()
+            image.save(buffer, format='JPEG', quality=85)
+            names.append(default_storage.save(f'items-images/seed-{i}.jpg', ContentFile(buffer.getvalue())))
+        return names
+
+    def make_item(self, i, rnd, categories, images):
+        adjective, noun = rnd.choice(ADJECTIVES), rnd.choice(NOUNS)
+        cents = rnd.randrange(500, 20000)
+        return Item(
+            title=f'{adjective} {noun} {i}',
+            price=from_cents(cents),
+            discount_price=from_cents(cents * 8 // 10) if i % 4 == 0 else None,
+            category=categories[i % len(categories)],
+            label=rnd.choice('PSD'),
+            description=f'A {adjective.lower()} {noun.lower()} for every day. ' * 3,
+            slug=f'{SLUG_PREFIX}item-{i}',
+            image=images[i % len(images)] if images else None,
+        )
+
+    def process_images(self, images):
+        # The items share a few images: render each once and record its hash
+        # on all of them, instead of an image job per item
+        for name in images:
+            item = Item.objects.filter(image=name).first()
+            if item is not None:
+                image_hash = generate_renditions(item.image)
+                Item.objects.filter(image=name).update(image_hash=image_hash)
@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.routers import replica_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the primary SQLite database into the replica files, a local '
+        'stand-in for replication. With --watch it keeps copying, and the '
+        'interval is the replication lag.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--watch', type=float, metavar='SECONDS',
+            help='Copy again at this interval.',
+        )
+
+    def handle(self, *args, **options):
+        aliases = replica_aliases()
+        if not aliases:
+            raise CommandError('No replicas configured, set SQLITE_REPLICAS.')
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('sync_replica copies SQLite files, use real replication for other databases.')
+        while True:
+            start = time.perf_counter()
+            for alias in aliases:
+                self.copy(connections['default'].settings_dict['NAME'], connections[alias].settings_dict['NAME'])
+            self.stdout.write(f'Synced {len(aliases)} replicas in {time.perf_counter() - start:.2f}s')
+            if options['watch'] is None:
+                break
+            time.sleep(options['watch'])
+
+    def copy(self, source_path, target_path):
+        # The backup API copies a consistent snapshot while the primary
+        # takes writes, and waits for readers of the replica to finish
+        source = sqlite3.connect(source_path, timeout=20)
+        target = sqlite3.connect(target_path, timeout=20)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
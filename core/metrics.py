@@ -0,0 +1,280 @@
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache.backends import db, filebased, locmem, memcached
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template import TemplateDoesNotExist
+from django.template.backends import django as django_backend
+
+logger = logging.getLogger(__name__)
+
+# Request timings per URL name, kept in this process and exposed in the
+# Prometheus text format by metrics_view. With several worker processes,
+# each reports its own.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+# Statements kept for the slow request log
+MAX_LOGGED_QUERIES = 50
+
+_lock = threading.Lock()
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label values -> [cumulative bucket counts..., sum, count]
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def exposition(self, label_names):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, series in sorted(self.series.items()):
+            base = format_labels(label_names, labels)
+            for bound, count in zip(self.buckets, series):
+                yield f'{self.name}_bucket{{{base},le="{bound}"}} {count}'
+            yield f'{self.name}_bucket{{{base},le="+Inf"}} {series[-1]}'
+            yield f'{self.name}_sum{{{base}}} {series[-2]}'
+            yield f'{self.name}_count{{{base}}} {series[-1]}'
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def inc(self, labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def exposition(self, label_names):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self.series.items()):
+            yield f'{self.name}{{{format_labels(label_names, labels)}}} {value}'
+
+
+def format_labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+REQUESTS = Counter('http_requests_total', 'Requests by URL name and status code.')
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Wall time per request.', SECONDS_BUCKETS)
+QUERIES = Histogram('db_queries_per_request', 'Database queries per request.', QUERY_BUCKETS)
+QUERY_SECONDS = Histogram('db_query_duration_seconds', 'Database time per request.', SECONDS_BUCKETS)
+TEMPLATE_SECONDS = Histogram('template_render_duration_seconds', 'Template rendering time per request.', SECONDS_BUCKETS)
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Cache gets by URL name and result.')
+
+
+class RequestMetrics:
+
+    def __init__(self, keep_sql=False):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.sql = [] if keep_sql else None
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.query_seconds += elapsed
+            if self.sql is not None and len(self.sql) < MAX_LOGGED_QUERIES:
+                self.sql.append((elapsed, sql))
+
+    def server_timing(self, total):
+        return ', '.join([
+            f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits {self.cache_misses} misses"',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def record_query(execute, sql, params, many, context):
+    # Installed on every connection by count_queries. Times the query for the
+    # request being served, whose metrics the sync_to_async threads of an
+    # async view see through the copied context.
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.record_query(execute, sql, params, many, context)
+
+
+def count_queries(sender, connection, **kwargs):
+    # connection_created receiver, see core.signals. A connection is opened
+    # again after CONN_MAX_AGE, but keeps its wrappers.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsMiddleware:
+    # Async capable, so that the async views are not run through
+    # async_to_sync
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks __call__ as a coroutine function for Django, like
+            # MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics = start_request()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return finish_request(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = start_request()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return finish_request(request, response, metrics)
+
+
+def start_request():
+    sample_rate = getattr(settings, 'SLOW_REQUEST_SAMPLE_RATE', 0.1)
+    return RequestMetrics(keep_sql=random.random() < sample_rate)
+
+
+def finish_request(request, response, metrics):
+    total = time.perf_counter() - metrics.start
+    match = request.resolver_match
+    view = match.view_name if match is not None else '<unresolved>'
+    with _lock:
+        REQUESTS.inc((view, response.status_code))
+        REQUEST_SECONDS.observe((view,), total)
+        QUERIES.observe((view,), metrics.queries)
+        QUERY_SECONDS.observe((view,), metrics.query_seconds)
+        TEMPLATE_SECONDS.observe((view,), metrics.template_seconds)
+        CACHE_LOOKUPS.inc((view, 'hit'), metrics.cache_hits)
+        CACHE_LOOKUPS.inc((view, 'miss'), metrics.cache_misses)
+
+    if getattr(settings, 'SERVER_TIMING', True):
+        response['Server-Timing'] = metrics.server_timing(total)
+    if metrics.sql is not None and total >= getattr(settings, 'SLOW_REQUEST_SECONDS', 0.5):
+        logger.warning(
+            'Slow request %s %s (%s): %.0fms, %d queries in %.0fms, templates %.0fms\n%s',
+            request.method, request.get_full_path(), view, total * 1000,
+            metrics.queries, metrics.query_seconds * 1000, metrics.template_seconds * 1000,
+            '\n'.join(f'  {elapsed * 1000:7.1f}ms  {sql}' for elapsed, sql in metrics.sql),
+        )
+    return response
+
+
+def metrics_view(request):
+    # For Prometheus, from the addresses in METRICS_ALLOWED_IPS
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return HttpResponseForbidden()
+    lines = []
+    with _lock:
+        lines.extend(REQUESTS.exposition(('view', 'status')))
+        for histogram in (REQUEST_SECONDS, QUERIES, QUERY_SECONDS, TEMPLATE_SECONDS):
+            lines.extend(histogram.exposition(('view',)))
+        lines.extend(CACHE_LOOKUPS.exposition(('view', 'result')))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def reset_metrics():
+    with _lock:
+        for metric in (REQUESTS, REQUEST_SECONDS, QUERIES, QUERY_SECONDS, TEMPLATE_SECONDS, CACHE_LOOKUPS):
+            metric.series.clear()
+
+
+# Template timing: the DjangoTemplates backend, with the top level render
+# of each template timed. Includes and extends render inside it.
+
+class Template(django_backend.Template):
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_seconds += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+# Cache hits and misses: Django's cache backends, counting get()
+
+_missing = object()
+
+
+class CountingCacheMixin:
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version)
+        metrics = _current.get()
+        if metrics is not None:
+            if value is _missing:
+                metrics.cache_misses += 1
+            else:
+                metrics.cache_hits += 1
+        return default if value is _missing else value
+
+
+class LocMemCache(CountingCacheMixin, locmem.LocMemCache):
+    pass
+
+
+class FileBasedCache(CountingCacheMixin, filebased.FileBasedCache):
+    pass
+
+
+class DatabaseCache(CountingCacheMixin, db.DatabaseCache):
+    pass
+
+
+class PyMemcacheCache(CountingCacheMixin, memcached.PyMemcacheCache):
+    pass
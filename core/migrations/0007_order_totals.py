@@ -0,0 +1,48 @@
+# Generated by Django 3.2.3 on 2026-10-18 01:37
+
+from django.db import migrations, models
+
+
+def backfill_totals(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    for order in Order.objects.iterator():
+        subtotal = discount_total = 0
+        item_count = 0
+        for order_item in order.items.select_related('item'):
+            price = order_item.item.price
+            discount_price = order_item.item.discount_price
+            subtotal += order_item.quantity * price
+            if discount_price:
+                discount_total += order_item.quantity * (price - discount_price)
+            item_count += 1
+        Order.objects.filter(pk=order.pk).update(
+            subtotal=subtotal,
+            discount_total=discount_total,
+            item_count=item_count,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_auto_20210531_0921'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount_total',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
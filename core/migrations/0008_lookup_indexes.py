@@ -0,0 +1,87 @@
+# Generated by Django 3.2.3 on 2026-10-18 01:41
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_slugs(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    duplicates = (
+        Item.objects.values('slug')
+        .annotate(n=Count('id'))
+        .filter(n__gt=1)
+        .values_list('slug', flat=True)
+    )
+    for slug in list(duplicates):
+        for item in Item.objects.filter(slug=slug).order_by('id')[1:]:
+            suffix = f'-{item.pk}'
+            item.slug = slug[:50 - len(suffix)] + suffix
+            item.save(update_fields=['slug'])
+
+
+def merge_open_orders(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    users = (
+        Order.objects.filter(ordered=False)
+        .values('user')
+        .annotate(n=Count('id'))
+        .filter(n__gt=1)
+        .values_list('user', flat=True)
+    )
+    for user_id in list(users):
+        orders = list(Order.objects.filter(user_id=user_id, ordered=False).order_by('-id'))
+        keeper, stale = orders[0], orders[1:]
+        Order.items.through.objects.filter(order__in=stale).update(order=keeper)
+        Order.objects.filter(pk__in=[order.pk for order in stale]).delete()
+
+        lines = {}
+        subtotal = discount_total = 0
+        for order_item in keeper.items.select_related('item').order_by('id'):
+            if order_item.item_id in lines:
+                kept = lines[order_item.item_id]
+                kept.quantity += order_item.quantity
+                kept.save(update_fields=['quantity'])
+                OrderItem.objects.filter(pk=order_item.pk).delete()
+            else:
+                lines[order_item.item_id] = order_item
+        for order_item in lines.values():
+            price = order_item.item.price
+            discount_price = order_item.item.discount_price
+            subtotal += order_item.quantity * price
+            if discount_price:
+                discount_total += order_item.quantity * (price - discount_price)
+        Order.objects.filter(pk=keeper.pk).update(
+            subtotal=subtotal,
+            discount_total=discount_total,
+            item_count=len(lines),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_order_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_slugs, migrations.RunPython.noop),
+        migrations.RunPython(merge_open_orders, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'item', 'ordered'], name='orderitem_user_item_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user',), name='one_open_order_per_user'),
+        ),
+    ]
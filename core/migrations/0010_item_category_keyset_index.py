@@ -0,0 +1,23 @@
+# Generated by Django 3.2.3 on 2026-10-18 01:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_image_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='core.category'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['category', 'id'], name='item_category_id_idx'),
+        ),
+    ]
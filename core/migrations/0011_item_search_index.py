@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts USING fts5('
+        'title, description, category, '
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    schema_editor.execute(
+        'INSERT INTO core_item_fts (rowid, title, description, category) '
+        'SELECT i.id, i.title, i.description, c.title '
+        'FROM core_item i INNER JOIN core_category c ON c.id = i.category_id'
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_item_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_item_category_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
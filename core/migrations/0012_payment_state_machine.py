@@ -0,0 +1,73 @@
+# Generated by Django 3.2.3 on 2026-10-18 01:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_existing_payments(apps, schema_editor):
+    # Payments used to be saved only once the charge went through
+    Payment = apps.get_model('core', 'Payment')
+    Order = apps.get_model('core', 'Order')
+    Payment.objects.update(status='succeeded')
+    for order_id, payment_id in Order.objects.filter(payment__isnull=False).values_list('id', 'payment_id'):
+        Payment.objects.filter(pk=payment_id).update(order_id=order_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='idempotency_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='core.order'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='source',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='payment',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='paid_orders', to='core.payment'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_charge_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'id'], name='payment_status_idx'),
+        ),
+        migrations.RunPython(mark_existing_payments, migrations.RunPython.noop),
+    ]
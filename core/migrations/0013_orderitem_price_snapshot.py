@@ -0,0 +1,43 @@
+# Generated by Django 3.2.3 on 2026-10-18 02:06
+
+from django.db import migrations, models
+from django.db.models import Case, F, FloatField, OuterRef, Subquery, When
+
+
+def snapshot_placed_orders(apps, schema_editor):
+    # Lines of paid orders were left open. Mark them ordered, with today's
+    # prices as the best guess of what was paid.
+    Item = apps.get_model('core', 'Item')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    items = Item.objects.filter(pk=OuterRef('item_id'))
+    final_price = Case(
+        When(discount_price__gt=0, then=F('discount_price')),
+        default=F('price'),
+        output_field=FloatField(),
+    )
+    OrderItem.objects.filter(order__ordered=True).update(
+        ordered=True,
+        unit_price=Subquery(items.values('price')[:1]),
+        unit_final_price=Subquery(items.annotate(final_price=final_price).values('final_price')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_payment_state_machine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_final_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(snapshot_placed_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Case, DecimalField, F, Func, OuterRef, Subquery, Value, When
+
+MONEY_FIELDS = {
+    'Item': ('price', 'discount_price'),
+    'OrderItem': ('unit_price', 'unit_final_price'),
+    'Order': ('subtotal', 'discount_total'),
+    'Payment': ('amount',),
+}
+
+
+def money_field(**kwargs):
+    return models.DecimalField(max_digits=10, decimal_places=2, **kwargs)
+
+
+def round_money(name):
+    # Float leftovers such as 29.990000000000002 become 29.99
+    return Func(F(name), Value(2), function='ROUND', output_field=DecimalField(max_digits=10, decimal_places=2))
+
+
+def convert_money(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    # Open lines followed the item until now, fix them at today's price
+    items = Item.objects.filter(pk=OuterRef('item_id'))
+    final_price = Case(
+        When(discount_price__gt=0, then=F('discount_price')),
+        default=F('price'),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+    OrderItem.objects.filter(unit_price__isnull=True).update(
+        unit_price=Subquery(items.values('price')[:1]),
+        unit_final_price=Subquery(items.annotate(final_price=final_price).values('final_price')[:1]),
+    )
+    for model_name, fields in MONEY_FIELDS.items():
+        apps.get_model('core', model_name).objects.update(**{name: round_money(name) for name in fields})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_orderitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='price',
+            field=money_field(),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='discount_price',
+            field=money_field(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='subtotal',
+            field=money_field(default=0),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='discount_total',
+            field=money_field(default=0),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=money_field(),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=money_field(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_final_price',
+            field=money_field(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_money, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=money_field(),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_final_price',
+            field=money_field(),
+        ),
+    ]
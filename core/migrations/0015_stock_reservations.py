@@ -0,0 +1,49 @@
+# Generated by Django 3.2.3 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_decimal_money'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockLevel',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='core.item')),
+                ('on_hand', models.PositiveIntegerField(default=0)),
+                ('reserved', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stocklevel',
+            constraint=models.CheckConstraint(check=models.Q(('reserved__lte', django.db.models.expressions.F('on_hand'))), name='stock_reserved_lte_on_hand'),
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.item'),
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='order_item',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reservation', to='core.orderitem'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['expires', 'id'], name='reservation_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.3 on 2026-10-18 02:56
+
+from django.db import migrations, models
+from django.db.models.functions import Greatest
+
+
+def backfill_updated(apps, schema_editor):
+    # Adding the column stamped every order with the time of the migration,
+    # which would keep abandoned carts from looking stale. The latest of the
+    # known dates is the best guess of their last change.
+    Order = apps.get_model('core', 'Order')
+    Order.objects.update(updated=Greatest('start_date', 'ordered_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_order_shipped'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_updated, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['ordered', 'updated'], name='order_stale_cart_idx'),
+        ),
+    ]
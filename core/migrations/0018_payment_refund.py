@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_order_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='stripe_refund_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
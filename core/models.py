@@ -1,9 +1,12 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import Case, Count, DecimalField, F, Q, Sum, When
 from django.shortcuts import reverse
-from PIL import Image, ImageOps
+from django.utils import timezone
 from django_countries.fields import CountryField
 
+from .money import DECIMAL_PLACES, MAX_DIGITS, ZERO, final_price
+
 LABEL_CHOICES = (
     ('P', 'primary'),
     ('S', 'secondary'),
@@ -19,13 +22,28 @@ class Category(models.Model):
 class Item(models.Model):
     title = models.CharField(max_length=100)
     image = models.ImageField(upload_to='items-images/', blank=True, null=True)
-    price = models.FloatField()
-    discount_price = models.FloatField(blank=True, null=True)
-    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    price = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
+    discount_price = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES, blank=True, null=True)
+    # Indexed together with id below, for the keyset-paginated category pages
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, db_index=False)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
     description = models.TextField(max_length=200)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
+    # Content hash of the image the current renditions were generated from
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    _loaded_image_name = None
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'id'], name='item_category_id_idx'),
+        ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image_name = instance.__dict__.get('image')
+        return instance
 
     def __str__(self):
         return self.title
@@ -39,37 +57,62 @@ class Item(models.Model):
     def get_remove_from_card_url(self):
         return reverse('core:remove-from-card', kwargs={'slug': self.slug})
 
+    def image_replaced(self):
+        if not self.image:
+            return False
+        return not self.image._committed or self.image.name != self._loaded_image_name
+
     def save(self, *args, **kwargs):
-        if self.image :
-            super(Item, self).save()
-            img = Image.open(self.image.path)
-            if img.format != 'JPEG' or img.format != 'JPG':
-                img = img.convert('RGB')
-            img.thumbnail(size=(400,400))
-            img.save(self.image.path, format="JPEG", optimize=True, quality=70)
+        # Renditions are generated off-request, see core.images and the
+        # post_save handler in core.signals
+        self._image_replaced = self.image_replaced()
+        if self._image_replaced:
+            self.image_hash = ''
+        super().save(*args, **kwargs)
+        self._loaded_image_name = self.image.name
 
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # Prices copied from the item when it is added to the cart, so the cart
+    # totals never need the item rows and later catalog changes do not
+    # reprice the line
+    unit_price = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
+    unit_final_price = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item', 'ordered'], name='orderitem_user_item_idx'),
+        ]
 
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
 
+    def save(self, *args, **kwargs):
+        if self.unit_price is None:
+            self.capture_prices(self.item.price, self.item.discount_price)
+        super().save(*args, **kwargs)
+
+    def capture_prices(self, price, discount_price):
+        self.unit_price = price
+        self.unit_final_price = final_price(price, discount_price)
+
+    def has_discount(self):
+        return self.unit_final_price < self.unit_price
+
     def get_total_item_price(self):
-        return self.quantity * self.item.price
+        return self.quantity * self.unit_price
 
     def get_total_discount_item_price(self):
-        return self.quantity * self.item.discount_price
+        return self.quantity * self.unit_final_price
 
     def get_amount_saved(self):
-        return self.get_total_item_price() - self.get_total_discount_item_price()
+        return self.get_total_item_price() - self.get_final_price()
     
     def get_final_price(self):
-        if self.item.discount_price:
-            return self.get_total_discount_item_price()
-        return self.get_total_item_price()
+        return self.quantity * self.unit_final_price
 
 
 class Order(models.Model):
@@ -79,16 +122,78 @@ class Order(models.Model):
     ordered_date = models.DateTimeField()
     ordered = models.BooleanField(default=False)
     billing_address = models.ForeignKey('BillingAddress', on_delete=models.SET_NULL, null=True)
-    payment = models.ForeignKey('Payment', on_delete=models.SET_NULL, null=True)
+    payment = models.ForeignKey('Payment', on_delete=models.SET_NULL, null=True, related_name='paid_orders')
+    # Denormalized cart totals, kept up to date by update_totals()
+    subtotal = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES, default=ZERO)
+    discount_total = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES, default=ZERO)
+    item_count = models.IntegerField(default=0)
+    shipped = models.BooleanField(default=False)
+    shipped_date = models.DateTimeField(blank=True, null=True)
+    # Last change to the cart, for purge_stale_carts
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+            # The admin's list filters, newest first
+            models.Index(fields=['ordered', 'shipped', 'id'], name='order_fulfilment_idx'),
+            models.Index(fields=['ordered', 'updated'], name='order_stale_cart_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=Q(ordered=False),
+                name='one_open_order_per_user',
+            ),
+        ]
 
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        return total
+        return self.subtotal - self.discount_total
+
+    def compute_totals(self):
+        return self.items.aggregate(**order_totals_aggregates())
+
+    def update_totals(self):
+        totals = self.compute_totals()
+        self.subtotal = totals['subtotal'] or ZERO
+        self.discount_total = totals['discount_total'] or ZERO
+        self.item_count = totals['item_count']
+        self.updated = timezone.now()
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=self.subtotal,
+            discount_total=self.discount_total,
+            item_count=self.item_count,
+            updated=self.updated,
+        )
+
+
+def money_field():
+    return DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
+
+
+def item_final_price(prefix=''):
+    # What one unit of the item costs today, mirrors core.money.final_price
+    return Case(
+        When(**{f'{prefix}discount_price__gt': 0}, then=F(f'{prefix}discount_price')),
+        default=F(f'{prefix}price'),
+        output_field=money_field(),
+    )
+
+
+def order_totals_aggregates(prefix=''):
+    # Mirrors OrderItem.get_final_price, evaluated by the database from the
+    # line snapshots alone
+    quantity = F(f'{prefix}quantity')
+    price = F(f'{prefix}unit_price')
+    final = F(f'{prefix}unit_final_price')
+    return {
+        'subtotal': Sum(quantity * price, output_field=money_field()),
+        'discount_total': Sum(quantity * (price - final), output_field=money_field()),
+        'item_count': Count(f'{prefix}id'),
+    }
 
 class BillingAddress(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -101,10 +206,103 @@ class BillingAddress(models.Model):
         return self.user.username
 
 class Payment(models.Model):
-    stripe_charge_id = models.CharField(max_length=50)
+    # One row per charge attempt, moved along by core.payments:
+    # pending -> processing -> succeeded or failed, with transient gateway
+    # errors going back to pending
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (PROCESSING, 'processing'),
+        (SUCCEEDED, 'succeeded'),
+        (FAILED, 'failed'),
+    )
+
+    stripe_charge_id = models.CharField(max_length=50, blank=True)
+    # Set once a charge that could not place its order is given back
+    stripe_refund_id = models.CharField(max_length=50, blank=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
-    amount = models.FloatField()
+    amount = models.DecimalField(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
     timestamp = models.DateField(auto_now_add=True)
+    order = models.ForeignKey('Order', on_delete=models.SET_NULL, blank=True, null=True, related_name='payments')
+    # Sent with every charge request for this attempt, so retrying it can
+    # never charge twice
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    source = models.CharField(max_length=255, blank=True)
+    status = models.CharField(choices=STATUS_CHOICES, max_length=10, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='payment_status_idx'),
+        ]
+
+    def __str__(self):
+        return self.user.username
+
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+
+class ImageJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (RUNNING, 'running'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+    )
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    status = models.CharField(choices=STATUS_CHOICES, max_length=10, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='imagejob_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.item_id} {self.status}"
+
+
+class StockLevel(models.Model):
+    # Items without a stock level are not tracked and never run out.
+    # Available stock is on_hand - reserved, see core.inventory.
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, primary_key=True, related_name='stock')
+    on_hand = models.PositiveIntegerField(default=0)
+    reserved = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(check=Q(reserved__lte=F('on_hand')), name='stock_reserved_lte_on_hand'),
+        ]
+
+    def __str__(self):
+        return f"{self.item_id}: {self.on_hand - self.reserved} of {self.on_hand} available"
+
+
+class Reservation(models.Model):
+    # Stock held for a cart line until it is paid or the hold expires
+    order_item = models.OneToOneField(OrderItem, on_delete=models.CASCADE, related_name='reservation')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=0)
+    expires = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires', 'id'], name='reservation_expires_idx'),
+        ]
 
     def __str__(self):
-        return self.user.username
\ No newline at end of file
+        return f"{self.quantity} of {self.item_id} until {self.expires}"
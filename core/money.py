@@ -0,0 +1,33 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+# Prices are Decimals with two places in Python and DecimalFields in the
+# database. Gateways get integer cents.
+MAX_DIGITS = 10
+DECIMAL_PLACES = 2
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def to_decimal(value):
+    # str() first, so that floats such as 19.99 are not expanded to their
+    # binary approximation
+    if value is None:
+        return None
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def to_cents(amount):
+    return int(to_decimal(amount) * 100)
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(CENT)
+
+
+def final_price(price, discount_price):
+    # The price a unit sells at, mirrors core.models.item_final_price
+    if discount_price is not None and discount_price > 0:
+        return discount_price
+    return price
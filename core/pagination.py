@@ -0,0 +1,95 @@
+from django.core.paginator import Paginator
+from django.db import connection, models
+from django.db.models import Max
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+class KeysetPage:
+    # Page of a queryset ordered by primary key. Unlike Django's Paginator it
+    # never counts the rows or skips them with OFFSET, so every page costs
+    # one indexed range scan however deep it is.
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        return self.object_list[-1].pk if self.has_next() else None
+
+    @property
+    def previous_cursor(self):
+        return self.object_list[0].pk if self.has_previous() else None
+
+
+def parse_id(value):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise Http404('Invalid id')
+
+
+def paginate_keyset(queryset, per_page, after=None, before=None):
+    if before is not None:
+        rows = list(queryset.filter(pk__lt=before).order_by('-pk')[:per_page + 1])
+        has_previous = len(rows) > per_page
+        return KeysetPage(rows[:per_page][::-1], has_next=True, has_previous=has_previous)
+
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    rows = list(queryset.order_by('pk')[:per_page + 1])
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_previous=after is not None)
+
+
+
+def estimate_rows(model):
+    # Approximate row count of the model's table from an index or the
+    # planner statistics, instead of counting every row. None when there is
+    # no cheap estimate.
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        # -1 until the table is first analyzed
+        return row[0] if row and row[0] >= 0 else None
+    if isinstance(model._meta.pk, (models.AutoField, models.BigAutoField)):
+        # The highest id, one index lookup. Deleted rows make it an
+        # overestimate.
+        return model._base_manager.aggregate(highest=Max('pk'))['highest'] or 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    # For admin changelists of large tables. Unfiltered lists take the page
+    # count from estimate_rows(), filtered ones still count the matches,
+    # which the list filters' indexes keep cheap. Small tables are counted
+    # exactly.
+    exact_below = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_rows(self.object_list.model)
+            if estimate is not None and estimate >= self.exact_below:
+                return estimate
+        return super().count
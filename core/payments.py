@@ -0,0 +1,408 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import uuid
+import weakref
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import cart, inventory
+from .caching import invalidate_cart_item_count
+from .db import retry_on_lock
+from .models import Order, Payment
+from .money import to_cents
+from .tasks import submit_later, submit_on_commit
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+CURRENCY = 'usd'
+MAX_ATTEMPTS = 5
+GATEWAY_TIMEOUT = 30
+GENERIC_ERROR = 'Something went wrong, You were not charge. Please try again'
+CHARGE_MISMATCH_ERROR = 'Your cart changed while it was being paid. The charge will be refunded, please pay again'
+
+# Per event loop, an httpx client cannot be shared between loops
+_http_clients = weakref.WeakKeyDictionary()
+# Payments being charged by this process's event loop, and the tasks doing it
+_charging = set()
+_tasks = set()
+
+
+class PaymentDeclined(Exception):
+    # The gateway refused the charge, sending it again will not help
+    pass
+
+
+class GatewayUnavailable(Exception):
+    # Network errors, rate limits and gateway outages. The charge can be
+    # retried with the same idempotency key.
+    pass
+
+
+class PaymentGateway:
+    # Returns the charge id, or raises PaymentDeclined or GatewayUnavailable
+
+    def charge(self, amount, currency, source, idempotency_key, description=''):
+        raise NotImplementedError
+
+    def refund(self, charge_id, idempotency_key):
+        # Refunds the whole charge and returns the refund id, raises like
+        # charge()
+        raise NotImplementedError
+
+    async def charge_async(self, amount, currency, source, idempotency_key, description=''):
+        # Gateways without an async client block a thread, not the event loop
+        return await sync_to_async(self.charge, thread_sensitive=False)(
+            amount, currency, source, idempotency_key, description,
+        )
+
+
+class StripeGateway(PaymentGateway):
+
+    def __init__(self):
+        # STRIPE_API_BASE points the client at `manage.py fake_stripe`
+        api_base = getattr(settings, 'STRIPE_API_BASE', None)
+        if api_base:
+            stripe.api_base = api_base
+
+    def charge(self, amount, currency, source, idempotency_key, description=''):
+        try:
+            charge = stripe.Charge.create(
+                amount=amount,
+                currency=currency,
+                source=source,
+                description=description,
+                idempotency_key=idempotency_key,
+                api_key=settings.STRIPE_SECRET_KEY,
+            )
+        except stripe.error.StripeError as e:
+            raise gateway_error(e) from e
+        return charge['id']
+
+    def refund(self, charge_id, idempotency_key):
+        try:
+            refund = stripe.Refund.create(
+                charge=charge_id,
+                idempotency_key=idempotency_key,
+                api_key=settings.STRIPE_SECRET_KEY,
+            )
+        except stripe.error.StripeError as e:
+            raise gateway_error(e) from e
+        return refund['id']
+
+    async def charge_async(self, amount, currency, source, idempotency_key, description=''):
+        # Same request as stripe.Charge.create, through httpx so that waiting
+        # on Stripe does not hold a thread
+        if httpx is None:
+            return await super().charge_async(amount, currency, source, idempotency_key, description)
+        try:
+            response = await async_http_client().post(
+                f'{stripe.api_base}/v1/charges',
+                data={'amount': amount, 'currency': currency, 'source': source, 'description': description},
+                headers={'Idempotency-Key': idempotency_key},
+                auth=(settings.STRIPE_SECRET_KEY, ''),
+            )
+        except httpx.HTTPError as e:
+            raise GatewayUnavailable('Network error') from e
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code == 200 and 'id' in body:
+            return body['id']
+        raise stripe_error(response.status_code, body.get('error', {}).get('message'))
+
+
+class FakeGateway(PaymentGateway):
+    # In-process gateway for tests. Like Stripe, it answers a repeated
+    # idempotency key with the original charge.
+    DECLINED_SOURCE = 'tok_chargeDeclined'
+
+    charges = {}
+    refunds = {}
+    # Number of upcoming calls that fail as if the gateway was down
+    outages = 0
+    _lock = threading.Lock()
+
+    def charge(self, amount, currency, source, idempotency_key, description=''):
+        with self._lock:
+            if FakeGateway.outages > 0:
+                FakeGateway.outages -= 1
+                raise GatewayUnavailable('Network error')
+            if source == self.DECLINED_SOURCE:
+                raise PaymentDeclined('Your card was declined.')
+            if idempotency_key not in self.charges:
+                self.charges[idempotency_key] = {
+                    'id': f'ch_{uuid.uuid4().hex[:24]}',
+                    'amount': amount,
+                    'currency': currency,
+                }
+            return self.charges[idempotency_key]['id']
+
+    async def charge_async(self, amount, currency, source, idempotency_key, description=''):
+        return self.charge(amount, currency, source, idempotency_key, description)
+
+    def refund(self, charge_id, idempotency_key):
+        with self._lock:
+            if FakeGateway.outages > 0:
+                FakeGateway.outages -= 1
+                raise GatewayUnavailable('Network error')
+            if not any(charge['id'] == charge_id for charge in self.charges.values()):
+                raise PaymentDeclined('No such charge')
+            if idempotency_key not in self.refunds:
+                self.refunds[idempotency_key] = {'id': f're_{uuid.uuid4().hex[:24]}', 'charge': charge_id}
+            return self.refunds[idempotency_key]['id']
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.charges = {}
+            cls.refunds = {}
+            cls.outages = 0
+
+
+def gateway_error(e):
+    # PaymentDeclined or GatewayUnavailable for an error of the Stripe
+    # library
+    if isinstance(e, stripe.error.CardError):
+        err = (e.json_body or {}).get('error', {})
+        return PaymentDeclined(err.get('message') or 'Your card was declined')
+    if isinstance(e, stripe.error.RateLimitError):
+        return GatewayUnavailable('Rate limit error')
+    if isinstance(e, stripe.error.APIConnectionError):
+        return GatewayUnavailable('Network error')
+    if isinstance(e, stripe.error.InvalidRequestError):
+        return PaymentDeclined('Invalid parameters')
+    if isinstance(e, stripe.error.AuthenticationError):
+        return PaymentDeclined('Not Authenticated')
+    if e.http_status is None or e.http_status >= 500:
+        return GatewayUnavailable(GENERIC_ERROR)
+    return PaymentDeclined(GENERIC_ERROR)
+
+
+def stripe_error(status, message):
+    # The exception StripeGateway.charge raises for the same response
+    if status == 402:
+        return PaymentDeclined(message or 'Your card was declined')
+    if status == 429:
+        return GatewayUnavailable('Rate limit error')
+    if status in (400, 404):
+        return PaymentDeclined('Invalid parameters')
+    if status == 401:
+        return PaymentDeclined('Not Authenticated')
+    if status >= 500:
+        return GatewayUnavailable(GENERIC_ERROR)
+    return PaymentDeclined(GENERIC_ERROR)
+
+
+def async_http_client():
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = _http_clients[loop] = httpx.AsyncClient(timeout=GATEWAY_TIMEOUT)
+    return client
+
+
+def get_gateway():
+    return import_string(getattr(settings, 'PAYMENT_GATEWAY', 'core.payments.StripeGateway'))()
+
+
+@retry_on_lock
+@transaction.atomic
+def start_payment(user, source, enqueue=True):
+    # Charge attempt for the user's open order. A retried or double-clicked
+    # submit gets the attempt that is already in flight. Raises
+    # inventory.OutOfStock when the cart's stock can no longer be held. Without enqueue,
+    # the caller charges it, e.g. with schedule_payment().
+    order = Order.objects.select_for_update().filter(user=user, ordered=False).first()
+    if order is None:
+        return None
+    payment = order.payments.filter(status__in=(Payment.PENDING, Payment.PROCESSING)).first()
+    if payment is not None:
+        return payment
+    # Raises OutOfStock before anything is charged
+    inventory.refresh_holds(order)
+    # Totals from the line snapshots, which is what the order is placed at
+    order.update_totals()
+    # A new key per attempt, so a declined card can be retried
+    attempt = order.payments.count() + 1
+    payment = Payment.objects.create(
+        user=user,
+        order=order,
+        amount=order.get_total(),
+        source=source,
+        idempotency_key=f'order-{order.pk}-{attempt}',
+    )
+    if enqueue:
+        submit_on_commit(process_payment, payment.pk)
+    return payment
+
+
+@retry_on_lock
+@transaction.atomic
+def claim_payment(payment_id):
+    claimed = Payment.objects.filter(pk=payment_id, status=Payment.PENDING).update(
+        status=Payment.PROCESSING,
+        attempts=F('attempts') + 1,
+        updated=timezone.now(),
+    )
+    if not claimed:
+        # Another worker got it first
+        return None
+    return Payment.objects.get(pk=payment_id)
+
+
+def charge_arguments(payment):
+    return {
+        'amount': to_cents(payment.amount),
+        'currency': CURRENCY,
+        'source': payment.source,
+        'idempotency_key': payment.idempotency_key,
+        'description': f'Order {payment.order_id}',
+    }
+
+
+def settle_payment(payment, charge_id=None, exc=None):
+    # Records the outcome of a charge. Returns how long to wait before
+    # charging again, or None once the payment succeeded or failed.
+    if exc is None:
+        finish_payment(payment, Payment.SUCCEEDED, charge_id=charge_id)
+        return None
+    if isinstance(exc, PaymentDeclined):
+        finish_payment(payment, Payment.FAILED, error=str(exc))
+        return None
+    if not isinstance(exc, GatewayUnavailable):
+        logger.error('Charging payment %s failed', payment.pk, exc_info=exc)
+    if payment.attempts >= MAX_ATTEMPTS:
+        finish_payment(payment, Payment.FAILED, error=str(exc))
+        return None
+    finish_payment(payment, Payment.PENDING, error=str(exc))
+    return getattr(settings, 'PAYMENT_RETRY_DELAY', 0.5) * 2 ** (payment.attempts - 1)
+
+
+def process_payment(payment_id):
+    payment = claim_payment(payment_id)
+    if payment is None:
+        return
+    try:
+        charge_id = get_gateway().charge(**charge_arguments(payment))
+    except Exception as exc:
+        retry_in = settle_payment(payment, exc=exc)
+    else:
+        retry_in = settle_payment(payment, charge_id=charge_id)
+    if retry_in is not None:
+        submit_later(retry_in, process_payment, payment.pk)
+
+
+async def process_payment_async(payment_id):
+    # process_payment for the event loop. Only the ORM calls need a thread,
+    # the charge itself is awaited.
+    try:
+        while True:
+            payment = await sync_to_async(claim_payment)(payment_id)
+            if payment is None:
+                return
+            try:
+                charge_id = await get_gateway().charge_async(**charge_arguments(payment))
+            except Exception as exc:
+                retry_in = await sync_to_async(settle_payment)(payment, exc=exc)
+            else:
+                retry_in = await sync_to_async(settle_payment)(payment, charge_id=charge_id)
+            if retry_in is None:
+                return
+            await asyncio.sleep(retry_in)
+    finally:
+        _charging.discard(payment_id)
+
+
+async def schedule_payment(payment_id):
+    # Charges the payment on the running event loop, after the response
+    # has been sent
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        return await process_payment_async(payment_id)
+    if payment_id in _charging:
+        return
+    _charging.add(payment_id)
+    # In an empty context, so that the request's metrics and replica
+    # routing state do not follow the charge, nor the executor of the
+    # request's thread for asgiref versions that keep it in a context var
+    task = contextvars.Context().run(asyncio.get_running_loop().create_task, process_payment_async(payment_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+@retry_on_lock
+@transaction.atomic
+def finish_payment(payment, status, charge_id='', error=''):
+    fields = {'status': status, 'error': error, 'updated': timezone.now()}
+    if status != Payment.PENDING:
+        # Card tokens are single use
+        fields['source'] = ''
+    if charge_id:
+        fields['stripe_charge_id'] = charge_id
+    if not Payment.objects.filter(pk=payment.pk, status=Payment.PROCESSING).update(**fields):
+        return
+    if status == Payment.SUCCEEDED:
+        # The order is placed in the same transaction as the payment
+        # succeeds, so neither can be seen without the other
+        try:
+            placed = cart.finalize_order(payment.order_id, payment.pk)
+        except cart.ChargeMismatch as exc:
+            # Charged for other lines than the order has: it stays open,
+            # and the charge, recorded on the payment, is refunded
+            Payment.objects.filter(pk=payment.pk).update(status=Payment.FAILED, error=CHARGE_MISMATCH_ERROR)
+            logger.error('Payment %s is refunded: %s', payment.pk, exc)
+            submit_on_commit(refund_payment, payment.pk)
+            return
+        if not placed:
+            logger.warning('Payment %s succeeded for order %s, which was already placed', payment.pk, payment.order_id)
+        invalidate_cart_item_count(payment.user_id)
+
+
+def refund_payment(payment_id):
+    # Gives back a charge that placed no order, see finish_payment. Its own
+    # idempotency key makes a repeated refund return the first one.
+    payment = Payment.objects.filter(pk=payment_id, stripe_refund_id='').exclude(stripe_charge_id='').first()
+    if payment is None:
+        return
+    try:
+        refund_id = get_gateway().refund(payment.stripe_charge_id, f'{payment.idempotency_key}-refund')
+    except (PaymentDeclined, GatewayUnavailable) as exc:
+        # Left for process_payments to send again
+        logger.error('Refunding payment %s failed: %s', payment.pk, exc)
+        return
+    Payment.objects.filter(pk=payment.pk).update(stripe_refund_id=refund_id, updated=timezone.now())
+
+
+def unrefunded_payment_ids(limit=None):
+    # Charges that failed to place their order and are not refunded yet
+    payment_ids = (
+        Payment.objects
+        .filter(status=Payment.FAILED, stripe_refund_id='')
+        .exclude(stripe_charge_id='')
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    return list(payment_ids[:limit] if limit else payment_ids)
+
+
+def pending_payment_ids(limit=None):
+    payment_ids = (
+        Payment.objects
+        .filter(status=Payment.PENDING)
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    return list(payment_ids[:limit] if limit else payment_ids)
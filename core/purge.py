@@ -0,0 +1,84 @@
+from collections import Counter
+
+from django.db import transaction
+
+from . import inventory
+from .caching import invalidate_cart_item_count
+from .db import retry_on_lock
+from .models import BillingAddress, Order, OrderItem, Payment, Reservation
+
+# Garbage collection of abandoned carts, see the purge_stale_carts command.
+# Each function handles one chunk in its own short transaction, walking the
+# table by id: it returns the last id it looked at, None once there is
+# nothing left, and the rows it deleted by model.
+
+
+def _deleted(*results):
+    counts = Counter()
+    for _, per_model in results:
+        counts.update(per_model)
+    return counts
+
+
+@retry_on_lock
+@transaction.atomic
+def purge_stale_carts(cutoff, after_id=0, batch_size=500):
+    # Open orders unchanged since the cutoff, with their lines and stock
+    # holds. Orders with a charge in flight are left alone.
+    chunk = list(
+        Order.objects.select_for_update()
+        .filter(ordered=False, updated__lt=cutoff, id__gt=after_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not chunk:
+        return None, Counter()
+    stale = list(
+        Order.objects.filter(id__in=chunk)
+        .exclude(payments__status__in=(Payment.PENDING, Payment.PROCESSING))
+        .values_list('id', 'user_id')
+    )
+    order_ids = [order_id for order_id, _ in stale]
+    lines = OrderItem.objects.filter(order__in=order_ids, ordered=False)
+    released = inventory.release(Reservation.objects.filter(order_item__in=lines))
+    deleted = _deleted(lines.delete(), Order.objects.filter(id__in=order_ids).delete())
+    if released:
+        deleted['core.Reservation'] += released
+    for _, user_id in stale:
+        invalidate_cart_item_count(user_id)
+    return chunk[-1], deleted
+
+
+@retry_on_lock
+@transaction.atomic
+def purge_orphaned_lines(after_id=0, batch_size=500):
+    # Unpaid lines in no order. Lines are added to their order in the
+    # transaction that creates them, so these are left over.
+    chunk = list(
+        OrderItem.objects.filter(id__gt=after_id, ordered=False)
+        .order_by('id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not chunk:
+        return None, Counter()
+    orphans = OrderItem.objects.filter(id__in=chunk, order__isnull=True)
+    released = inventory.release(Reservation.objects.filter(order_item__in=orphans))
+    deleted = _deleted(orphans.delete())
+    if released:
+        deleted['core.Reservation'] += released
+    return chunk[-1], deleted
+
+
+@retry_on_lock
+@transaction.atomic
+def purge_unused_addresses(after_id=0, batch_size=500):
+    # Billing addresses no order points to. Checkout saves the address and
+    # the order in one transaction.
+    chunk = list(
+        BillingAddress.objects.filter(id__gt=after_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not chunk:
+        return None, Counter()
+    return chunk[-1], _deleted(BillingAddress.objects.filter(id__in=chunk, order__isnull=True).delete())
@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+# Catalog reads made while serving a request may go to a replica. Carts,
+# orders and payments, every write, and everything outside a request
+# (commands, background tasks) use the primary.
+REPLICA_MODELS = {('core', 'item'), ('core', 'category')}
+STICKY_COOKIE = 'primary_until'
+
+
+class RoutingState:
+    # Per request: read from the primary, e.g. right after a write, and
+    # whether this request wrote
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# A mutable object rather than a flag, so that writes made in
+# sync_to_async threads are seen by the middleware
+_state = contextvars.ContextVar('replica_routing', default=None)
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        aliases = replica_aliases()
+        if (
+            not aliases
+            or state is None
+            or state.pinned
+            or (model._meta.app_label, model._meta.model_name) not in REPLICA_MODELS
+            # Reads in a write transaction, e.g. the item prices copied
+            # into a cart line, must see the primary
+            or connections['default'].in_atomic_block
+        ):
+            return 'default'
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label == 'core':
+            # Read your own writes for the rest of the request, and for
+            # REPLICA_STICKY_SECONDS after it
+            state.pinned = state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas are copies of the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema along with the data, see sync_replica
+        return db not in replica_aliases()
+
+
+class StickyPrimaryMiddleware:
+    # Keeps a user on the primary for a few seconds after they wrote, so a
+    # lagging replica never shows them a stale cart or product. Async
+    # capable, so that the async views are not run through async_to_sync.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks __call__ as a coroutine function for Django, like
+            # MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state = start_routing(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return finish_routing(state, response)
+
+    async def __acall__(self, request):
+        state = start_routing(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return finish_routing(state, response)
+
+
+def start_routing(request):
+    try:
+        pinned = float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        pinned = False
+    return RoutingState(pinned)
+
+
+def finish_routing(state, response):
+    if state.wrote:
+        seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+        response.set_cookie(
+            STICKY_COOKIE, f'{time.time() + seconds:.3f}',
+            max_age=seconds, httponly=True, samesite='Lax',
+        )
+    return response
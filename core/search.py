@@ -0,0 +1,166 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, When
+from django.utils.module_loading import import_string
+
+from .models import Item
+
+FTS_TABLE = 'core_item_fts'
+
+# Title matches weigh the most, then the category, then the description
+FTS_CREATE_SQL = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+    'title, description, category, '
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+# Only the FTS_CANDIDATES newest matches are ranked. FTS5 reads matches in
+# rowid order without scoring them, so this bounds the cost of very broad
+# queries on a large catalog; a query with fewer matches is ranked in full.
+# The bm25 weights go in through "rank MATCH".
+FTS_CANDIDATES = 500
+FTS_SEARCH_SQL = (
+    f'SELECT rowid FROM ('
+    f'SELECT rowid, rank FROM {FTS_TABLE} '
+    f"WHERE {FTS_TABLE} MATCH %s AND rank MATCH 'bm25(10.0, 1.0, 5.0)' "
+    f'ORDER BY rowid DESC LIMIT {FTS_CANDIDATES}'
+    ') ORDER BY rank LIMIT %s'
+)
+FTS_DELETE_SQL = f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({{}})'
+FTS_INSERT_SQL = (
+    f'INSERT INTO {FTS_TABLE} (rowid, title, description, category) '
+    'SELECT i.id, i.title, i.description, c.title '
+    'FROM core_item i INNER JOIN core_category c ON c.id = i.category_id'
+)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text or '')
+
+
+def match_query(text, column=None, prefix=False):
+    # Every word must match. With prefix, the last one may still be being
+    # typed. Quoting keeps FTS5 operators in user input inert.
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    if prefix:
+        terms[-1] += '*'
+    query = ' '.join(terms)
+    return f'{column} : ({query})' if column else query
+
+
+def preserve_order(ids):
+    return Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)], output_field=IntegerField())
+
+
+class SearchBackend:
+    # Subclasses return item ids, best match first
+
+    def search_ids(self, text, limit):
+        raise NotImplementedError
+
+    def autocomplete_ids(self, text, limit):
+        return self.search_ids(text, limit)
+
+    def index_items(self, item_ids):
+        pass
+
+    def index_category(self, category_id):
+        pass
+
+    def remove_items(self, item_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, text, limit=40):
+        return self._items(self.search_ids(text, limit))
+
+    def autocomplete(self, text, limit=8):
+        return self._items(self.autocomplete_ids(text, limit))
+
+    def _items(self, ids):
+        if not ids:
+            return Item.objects.none()
+        return (
+            Item.objects
+            .filter(pk__in=ids)
+            .select_related('category')
+            .defer('description')
+            .order_by(preserve_order(ids))
+        )
+
+
+class SQLiteFTSBackend(SearchBackend):
+    # FTS5 table kept in sync by core.signals, in the same transaction as the
+    # catalog change
+
+    def search_ids(self, text, limit):
+        return self._match(match_query(text), limit)
+
+    def autocomplete_ids(self, text, limit):
+        return self._match(match_query(text, column='title', prefix=True), limit)
+
+    def _match(self, query, limit):
+        if query is None:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(FTS_SEARCH_SQL, [query, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def index_items(self, item_ids):
+        item_ids = list(item_ids)
+        if not item_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(item_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(FTS_DELETE_SQL.format(placeholders), item_ids)
+            cursor.execute(f'{FTS_INSERT_SQL} WHERE i.id IN ({placeholders})', item_ids)
+
+    def index_category(self, category_id):
+        self.index_items(Item.objects.filter(category_id=category_id).values_list('id', flat=True))
+
+    def remove_items(self, item_ids):
+        item_ids = list(item_ids)
+        if item_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(FTS_DELETE_SQL.format(', '.join(['%s'] * len(item_ids))), item_ids)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(FTS_INSERT_SQL)
+
+
+class DatabaseSearchBackend(SearchBackend):
+    # Unindexed fallback for databases without full-text search
+
+    def search_ids(self, text, limit):
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        condition = Q()
+        for token in tokens:
+            condition &= (
+                Q(title__icontains=token)
+                | Q(description__icontains=token)
+                | Q(category__title__icontains=token)
+            )
+        return list(Item.objects.filter(condition).order_by('pk').values_list('pk', flat=True)[:limit])
+
+
+def default_backend_path():
+    if connection.vendor == 'sqlite':
+        return 'core.search.SQLiteFTSBackend'
+    return 'core.search.DatabaseSearchBackend'
+
+
+def get_backend():
+    path = getattr(settings, 'SEARCH_BACKEND', None) or default_backend_path()
+    return import_string(path)()
@@ -0,0 +1,56 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import cart
+from .caching import bump_catalog_version, invalidate_categories
+from .images import enqueue_image_processing
+from .metrics import count_queries
+from .models import Category, Item
+from .search import get_backend as get_search_backend
+
+# Request metrics count the queries of every connection, including those
+# of the threads sync_to_async runs the ORM in
+connection_created.connect(count_queries)
+
+# Caches are invalidated on commit, or a concurrent request could cache the
+# old rows again under the new version
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, **kwargs):
+    transaction.on_commit(invalidate_categories)
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    # Items are indexed with their category title
+    if not created:
+        get_search_backend().index_category(instance.pk)
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+    get_search_backend().remove_items([instance.pk])
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+    get_search_backend().index_items([instance.pk])
+    if getattr(instance, '_image_replaced', False):
+        enqueue_image_processing(instance)
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    # Requests that went through core.cart.AnonymousCartMiddleware
+    anonymous_cart = getattr(request, 'anonymous_cart', None)
+    # Kept in the cookie when the user's order is being paid
+    if anonymous_cart and cart.merge_lines(user, anonymous_cart.lines) is not None:
+        anonymous_cart.clear()
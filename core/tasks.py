@@ -0,0 +1,58 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'BACKGROUND_WORKERS', 2),
+                thread_name_prefix='core-tasks',
+            )
+    return _executor
+
+
+def _run(func, args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        # Keeps the worker thread's connection unless it is broken or older
+        # than CONN_MAX_AGE
+        close_old_connections()
+
+
+def submit(func, *args):
+    # BACKGROUND_TASKS_EAGER runs the task inline, for tests and debugging
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        return func(*args)
+    return get_executor().submit(_run, func, args)
+
+
+def submit_on_commit(func, *args):
+    transaction.on_commit(lambda: submit(func, *args))
+
+
+def submit_later(delay, func, *args):
+    # Submits the task after delay seconds, without holding a pool thread
+    # while it waits. The timer is not waited for at exit: the work it
+    # would have started is still queued in the database, see
+    # process_payments.
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        return func(*args)
+    timer = threading.Timer(delay, submit, (func, *args))
+    timer.daemon = True
+    timer.start()
+    return timer
@@ -1,12 +1,10 @@
 from django import template
-from core.models import Order
+from core.caching import get_cart_item_count
 
 register = template.Library()
 
 @register.filter
 def cart_item_count(user):
     if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
+        return get_cart_item_count(user)
     return 0
@@ -0,0 +1,43 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+from core.images import available_formats, renditions_ready, srcset
+from core.images import rendition_url as get_rendition_url
+
+register = template.Library()
+
+# Matches the grid columns the renditions are displayed in
+SIZES = {
+    'card': '(min-width: 992px) 25vw, (min-width: 768px) 50vw, 100vw',
+    'product': '(min-width: 768px) 50vw, 100vw',
+    'retina': '100vw',
+}
+
+@register.filter
+def rendition_url(item, name='card'):
+    return get_rendition_url(item, name)
+
+@register.simple_tag
+def responsive_image(item, rendition='card', sizes=None, css_class='', alt=''):
+    if not item.image:
+        return ''
+    if not item.image_hash or not renditions_ready(item):
+        return format_html('<img src="{}" class="{}" alt="{}">', item.image.url, css_class, alt)
+    sizes = sizes or SIZES[rendition]
+    sources = format_html_join(
+        '',
+        '<source type="{}" srcset="{}" sizes="{}">',
+        (
+            (mime_type, srcset(item, extension), sizes)
+            for extension, _, mime_type, _ in available_formats()
+            if extension != 'jpg'
+        ),
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="lazy"></picture>',
+        sources,
+        get_rendition_url(item, rendition),
+        srcset(item),
+        sizes,
+        css_class,
+        alt,
+    )
@@ -1,3 +1,1965 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import json
+import re
+import shutil
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from http.cookies import SimpleCookie
+from io import BytesIO, StringIO
+from unittest import mock
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse
+from django.template import Context, Template
+from django.test import (
+    AsyncRequestFactory, Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve, reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from . import async_views, cart, inventory, payments, tasks, urls as core_urls
+from .api import available_encodings, negotiate_encoding
+from .fake_stripe import make_server, server_url
+from .payments import MAX_ATTEMPTS, FakeGateway, GatewayUnavailable, PaymentDeclined, StripeGateway
+from .caching import catalog_version, cart_count_stats, get_cart_item_count, reset_cart_count_stats
+from .routers import STICKY_COOKIE, ReplicaRouter, StickyPrimaryMiddleware
+from .search import get_backend as get_search_backend, match_query
+from .db import retry_on_lock
+from .metrics import MetricsMiddleware, reset_metrics
+from .money import from_cents, to_cents, to_decimal
+from .pagination import EstimatedCountPaginator
+from .images import RENDITIONS, WIDTHS, available_formats, rendition_name, rendition_url
+from .models import BillingAddress, Category, ImageJob, Item, Order, OrderItem, Payment, Reservation, StockLevel
+from PIL import Image
+import stripe
+
+from ecommerce import urls as ecommerce_urls
+
+
+class CatalogFixtureMixin:
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories = [
+            Category.objects.create(title=f'Category {i}') for i in range(3)
+        ]
+        # bulk_create skips Item.save, which needs an uploaded image
+        Item.objects.bulk_create([
+            Item(
+                title=f'Item {i}',
+                price=10 + i,
+                discount_price=5 + i if i % 2 else None,
+                category=cls.categories[i % 3],
+                label='P',
+                description='A description',
+                slug=f'item-{i}',
+            )
+            for i in range(25)
+        ])
+        cls.items = list(Item.objects.order_by('id'))
+        cls.user = get_user_model().objects.create_user(
+            username='shopper', password='secret-password'
+        )
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+    def fill_cart(self, lines):
+        order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        for item in self.items[:lines]:
+            order.items.add(
+                OrderItem.objects.create(user=self.user, item=item, quantity=2)
+            )
+        order.update_totals()
+        return order
+
+
+class QueryBudgetTests(CatalogFixtureMixin, TestCase):
+    # Budgets are per request and must not grow with the page or cart size
+
+    def test_home_anonymous(self):
+        # categories + page of items, then served from the page cache
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('core:home'))
+        self.assertEqual(len(response.context['object_list']), 10)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('core:home'))
+
+    def test_home_does_not_depend_on_page_depth(self):
+        self.client.get(reverse('core:home'))
+        # Keyset pagination: no COUNT(*) and no OFFSET
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('core:home') + f'?after={self.items[19].pk}')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def test_home_caches_categories(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:home'))
+        self.assertEqual(len(response.context['categories']), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(title='New category')
+        response = self.client.get(reverse('core:home'))
+        self.assertEqual(len(response.context['categories']), 4)
+
+    def test_home_defers_description(self):
+        response = self.client.get(reverse('core:home'))
+        item = response.context['object_list'][0]
+        self.assertIn('description', item.get_deferred_fields())
+
+    def test_home_authenticated(self):
+        self.client.force_login(self.user)
+        self.fill_cart(5)
+        self.client.get(reverse('core:home'))
+        # session + user + page of items, the cart badge is cached
+        with self.assertNumQueries(3):
+            self.client.get(reverse('core:home'))
+
+    def test_product_page(self):
+        with self.assertNumQueries(1):
+            self.client.get(self.items[0].get_absolute_url())
+
+    def test_order_summary(self):
+        self.client.force_login(self.user)
+        self.fill_cart(10)
+        # session + user + order + order lines + cart badge
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('core:order-summary'))
+        self.assertContains(response, 'Item 9')
+
+    def test_checkout_page(self):
+        self.client.force_login(self.user)
+        self.fill_cart(3)
+        # session + user + cart badge
+        with self.assertNumQueries(3):
+            self.client.get(reverse('core:checkout'))
+
+    def test_payment_page(self):
+        self.client.force_login(self.user)
+        self.fill_cart(10)
+        # session + user + order + order lines + cart badge
+        with self.assertNumQueries(5):
+            self.client.get(reverse('core:payment', kwargs={'payment_option': 'stripe'}))
+
+
+class OrderTotalsTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def python_total(self, order):
+        return sum(line.get_final_price() for line in order.items.all())
+
+    def test_update_totals_matches_line_prices(self):
+        order = self.fill_cart(6)
+        self.assertEqual(order.item_count, 6)
+        self.assertAlmostEqual(order.get_total(), self.python_total(order))
+        self.assertAlmostEqual(
+            order.subtotal,
+            sum(line.get_total_item_price() for line in order.items.all()),
+        )
+
+    def test_get_total_does_not_query(self):
+        order = Order.objects.get(pk=self.fill_cart(6).pk)
+        with self.assertNumQueries(0):
+            order.get_total()
+            order.get_total()
+
+    def test_cart_views_keep_totals_in_sync(self):
+        item = self.items[1]
+        self.client.get(reverse('core:add-to-card', kwargs={'slug': item.slug}))
+        self.client.get(reverse('core:add-to-card', kwargs={'slug': item.slug}))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.item_count, 1)
+        self.assertAlmostEqual(order.subtotal, 2 * item.price)
+        self.assertAlmostEqual(order.get_total(), 2 * item.discount_price)
+
+        self.client.get(reverse('core:remove-single-item-from-card', kwargs={'slug': item.slug}))
+        order.refresh_from_db()
+        self.assertAlmostEqual(order.get_total(), item.discount_price)
+
+        self.client.get(reverse('core:remove-from-card', kwargs={'slug': item.slug}))
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.get_total()), (0, 0))
+
+    def test_totals_do_not_join_items(self):
+        order = self.fill_cart(6)
+        with CaptureQueriesContext(connection) as queries:
+            order.update_totals()
+        self.assertNotIn('core_item"', queries[0]['sql'])
+
+    def test_price_changes_do_not_reprice_cart(self):
+        item = self.items[1]
+        self.client.get(reverse('core:add-to-card', kwargs={'slug': item.slug}))
+        Item.objects.filter(pk=item.pk).update(price=100, discount_price=None)
+        self.client.get(reverse('core:add-to-card', kwargs={'slug': item.slug}))
+        order = Order.objects.get(user=self.user, ordered=False)
+        line = order.items.get()
+        self.assertEqual((line.unit_price, line.unit_final_price), (item.price, item.discount_price))
+        self.assertEqual(order.get_total(), 2 * item.discount_price)
+
+    def test_reconcile_order_totals(self):
+        order = self.fill_cart(4)
+        Order.objects.filter(pk=order.pk).update(subtotal=0)
+        out = StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('1 drifted', out.getvalue())
+        order.refresh_from_db()
+        self.assertEqual(order.get_total(), self.python_total(order))
+
+    def test_reconcile_compares_cents_exactly(self):
+        order = self.fill_cart(0)
+        for price in ('0.10', '0.20', '0.70'):
+            order.items.add(OrderItem.objects.create(
+                user=self.user, item=self.items[0], quantity=3,
+                unit_price=Decimal(price), unit_final_price=Decimal(price),
+            ))
+        order.update_totals()
+        out = StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('0 drifted', out.getvalue())
+
+        # One cent off is a drift
+        Order.objects.filter(pk=order.pk).update(subtotal=Decimal('2.99'))
+        out = StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('1 drifted', out.getvalue())
+        order.refresh_from_db()
+        self.assertEqual(order.subtotal, Decimal('3.00'))
+
+
+class CartCountCacheTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_cart_count_stats()
+        self.client.force_login(self.user)
+
+    def test_badge_hits_database_once_per_miss(self):
+        self.fill_cart(3)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_cart_item_count(self.user), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_item_count(self.user), 3)
+        stats = cart_count_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_cart_views_invalidate_badge(self):
+        self.assertEqual(get_cart_item_count(self.user), 0)
+        slug = self.items[0].slug
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('core:add-to-card', kwargs={'slug': slug}))
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('core:remove-from-card', kwargs={'slug': slug}))
+        self.assertEqual(get_cart_item_count(self.user), 0)
+
+    def test_stats_view_is_staff_only(self):
+        response = self.client.get(reverse('core:cache-stats'))
+        self.assertEqual(response.status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('core:cache-stats'))
+        self.assertIn('hit_rate', response.json()['cart_count'])
+
+
+class SessionTests(CatalogFixtureMixin, TestCase):
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_cart_clicks_do_not_touch_the_session_table(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:add-to-card', kwargs={'slug': self.items[1].slug}))
+            response = self.client.get(response.url)
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+        self.assertContains(response, 'This item was added')
+
+    def test_purge_sessions(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            [Session(session_key=f'expired-{i}', session_data='', expire_date=now - timezone.timedelta(days=1))
+             for i in range(5)]
+            + [Session(session_key='current', session_data='', expire_date=now + timezone.timedelta(days=1))]
+        )
+        out = StringIO()
+        call_command('purge_sessions', batch_size=2, stdout=out)
+        self.assertIn('Deleted 5 expired sessions in 3 batches', out.getvalue())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['current'])
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache')
+    def test_purge_sessions_of_the_cache_store(self):
+        out = StringIO()
+        call_command('purge_sessions', stdout=out)
+        self.assertIn('keeps no sessions in the database', out.getvalue())
+
+
+class CartServiceTests(CatalogFixtureMixin, TestCase):
+
+    def test_add_increments_existing_line(self):
+        slug = self.items[0].slug
+        self.assertEqual(cart.add_item(self.user, slug), cart.ADDED)
+        self.assertEqual(cart.add_item(self.user, slug), cart.UPDATED)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 2)
+
+    def test_add_unknown_slug(self):
+        with self.assertRaises(Http404):
+            cart.add_item(self.user, 'missing')
+
+    def test_remove_single_item_deletes_last_unit(self):
+        slug = self.items[0].slug
+        self.assertEqual(cart.remove_single_item(self.user, slug), cart.NO_ORDER)
+        cart.add_item(self.user, slug)
+        cart.add_item(self.user, slug)
+        self.assertEqual(cart.remove_single_item(self.user, slug), cart.UPDATED)
+        self.assertEqual(cart.remove_single_item(self.user, slug), cart.REMOVED)
+        self.assertEqual(cart.remove_single_item(self.user, slug), cart.NOT_IN_CART)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_remove_item(self):
+        cart.add_item(self.user, self.items[0].slug)
+        cart.add_item(self.user, self.items[1].slug)
+        self.assertEqual(cart.remove_item(self.user, self.items[0].slug), cart.REMOVED)
+        self.assertEqual(cart.remove_item(self.user, self.items[0].slug), cart.NOT_IN_CART)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.item_count, 1)
+
+    def test_cart_is_frozen_while_a_payment_is_in_flight(self):
+        slug = self.items[0].slug
+        cart.add_item(self.user, slug)
+        payment = payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        for operation in (cart.add_item, cart.remove_single_item, cart.remove_item):
+            self.assertEqual(operation(self.user, self.items[1].slug), cart.PAYMENT_IN_PROGRESS)
+            self.assertEqual(operation(self.user, slug), cart.PAYMENT_IN_PROGRESS)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.get_total(), payment.amount)
+        self.assertEqual(order.items.get().quantity, 1)
+
+        Payment.objects.filter(pk=payment.pk).update(status=Payment.FAILED)
+        self.assertEqual(cart.add_item(self.user, slug), cart.UPDATED)
+
+    def test_cart_view_while_a_payment_is_in_flight(self):
+        cart.add_item(self.user, self.items[0].slug)
+        payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:add-to-card', kwargs={'slug': self.items[1].slug}), follow=True)
+        self.assertContains(response, 'Your payment is being processed')
+
+    def test_query_count_is_bounded(self):
+        # Cart size must not change the number of statements per click
+        for item in self.items[:20]:
+            cart.add_item(self.user, item.slug)
+        for operation in (cart.add_item, cart.remove_single_item, cart.remove_item):
+            with CaptureQueriesContext(connection) as queries:
+                operation(self.user, self.items[0].slug)
+            self.assertLessEqual(len(queries), 10, operation.__name__)
+
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class AnonymousCartTests(CatalogFixtureMixin, TestCase):
+
+    def add(self, item):
+        return self.client.get(reverse('core:add-to-card', kwargs={'slug': item.slug}))
+
+    def test_cart_clicks_write_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.add(self.items[1])
+            self.add(self.items[1])
+            self.add(self.items[2])
+            self.client.get(reverse('core:remove-single-item-from-card', kwargs={'slug': self.items[1].slug}))
+        self.assertEqual(response.url, reverse('core:order-summary'))
+        self.assertFalse([query for query in queries if query['sql'].startswith(WRITES)])
+        self.assertFalse(Order.objects.exists())
+
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertContains(response, 'Item 1')
+        self.assertContains(response, 'Item 2')
+        total = self.items[1].discount_price + self.items[2].price
+        self.assertEqual(response.context['object'].get_total(), total)
+
+    def test_remove(self):
+        self.add(self.items[1])
+        response = self.client.get(reverse('core:remove-from-card', kwargs={'slug': self.items[1].slug}))
+        self.assertEqual(response.url, reverse('core:order-summary'))
+        self.assertEqual(response.cookies[cart.ANONYMOUS_CART_COOKIE].value, '')
+        response = self.client.get(reverse('core:remove-from-card', kwargs={'slug': self.items[1].slug}))
+        self.assertEqual(response.url, self.items[1].get_absolute_url())
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response.url, '/')
+
+    def test_tampered_cookie_is_ignored(self):
+        self.add(self.items[1])
+        value = self.client.cookies[cart.ANONYMOUS_CART_COOKIE].value
+        self.assertTrue(value.startswith(f'{self.items[1].pk}:1:'))
+        self.client.cookies[cart.ANONYMOUS_CART_COOKIE] = f'{self.items[1].pk}:9:' + value.split(':', 2)[2]
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response.url, '/')
+
+    def test_sold_out_items_are_not_added(self):
+        StockLevel.objects.create(item=self.items[1], on_hand=1)
+        self.add(self.items[1])
+        response = self.add(self.items[1])
+        self.assertEqual(response.url, self.items[1].get_absolute_url())
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_cart_is_capped(self):
+        anonymous_cart = cart.AnonymousCart({item.pk: 1 for item in self.items[:2]})
+        with mock.patch('core.cart.MAX_ANONYMOUS_CART_LINES', 2):
+            self.assertEqual(anonymous_cart.add(self.items[0].slug), cart.UPDATED)
+            self.assertEqual(anonymous_cart.add(self.items[2].slug), cart.CART_FULL)
+
+    def test_cached_pages_show_the_cart_count(self):
+        self.client.get(reverse('core:home'))
+        self.add(self.items[1])
+        self.assertContains(self.client.get(reverse('core:home')), 'badge red z-depth-1 mr-1">1<')
+        self.add(self.items[2])
+        self.assertContains(self.client.get(reverse('core:home')), 'badge red z-depth-1 mr-1">2<')
+
+    def test_checkout_needs_login(self):
+        self.add(self.items[1])
+        response = self.client.get(reverse('core:checkout'))
+        self.assertTrue(response.url.startswith(reverse('account_login')))
+
+    def test_login_merges_the_cart(self):
+        self.fill_cart(1)
+        self.add(self.items[0])
+        self.add(self.items[1])
+        self.add(self.items[1])
+        response = self.client.post(reverse('account_login'), {'login': 'shopper', 'password': 'secret-password'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[cart.ANONYMOUS_CART_COOKIE].value, '')
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        quantities = dict(order.items.values_list('item_id', 'quantity'))
+        self.assertEqual(quantities, {self.items[0].pk: 3, self.items[1].pk: 2})
+        self.assertEqual(order.item_count, 2)
+        self.assertEqual(order.get_total(), 3 * self.items[0].price + 2 * self.items[1].discount_price)
+
+    def test_merge_waits_for_a_payment_in_flight(self):
+        order = self.fill_cart(1)
+        Payment.objects.create(user=self.user, order=order, amount=order.get_total())
+        self.add(self.items[1])
+        response = self.client.post(reverse('account_login'), {'login': 'shopper', 'password': 'secret-password'})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(cart.ANONYMOUS_CART_COOKIE, response.cookies)
+        self.assertEqual(order.items.count(), 1)
+
+    async def test_async_views_save_the_cart(self):
+        async def get_response(request):
+            await sync_to_async(request.anonymous_cart.add)(self.items[0].slug)
+            return HttpResponse()
+
+        middleware = cart.AnonymousCartMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().get('/'))
+        self.assertIn(cart.ANONYMOUS_CART_COOKIE, response.cookies)
+
+    def test_merge_query_count_does_not_grow_with_the_cart(self):
+        def merge(lines):
+            with CaptureQueriesContext(connection) as queries:
+                cart.merge_lines(self.user, {item.pk: 1 for item in self.items[:lines]})
+            return len(queries)
+
+        self.fill_cart(1)
+        small = merge(2)
+        Order.objects.all().delete()
+        OrderItem.objects.all().delete()
+        self.fill_cart(1)
+        self.assertEqual(merge(20), small)
+        self.assertEqual(Order.objects.get(user=self.user, ordered=False).item_count, 20)
+
+
+class CartConcurrencyTests(TransactionTestCase):
+
+    def setUp(self):
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title='Item', price=10, category=category, label='P', slug='item')
+        ])
+        self.user = get_user_model().objects.create_user(username='shopper')
+
+    def test_concurrent_adds_are_not_lost(self):
+        threads, clicks = 4, 10
+        errors = []
+
+        def click():
+            try:
+                for _ in range(clicks):
+                    cart.add_item(self.user, 'item')
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=click) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, threads * clicks)
+        self.assertEqual(order.item_count, 1)
+
+
+@override_settings(
+    PAYMENT_GATEWAY='core.payments.FakeGateway',
+    PAYMENT_RETRY_DELAY=0,
+    BACKGROUND_TASKS_EAGER=True,
+)
+class InventoryTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.item = self.items[0]
+        self.stock = StockLevel.objects.create(item=self.item, on_hand=3)
+        self.other = get_user_model().objects.create_user(username='other')
+
+    def assertStock(self, on_hand, reserved):
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (on_hand, reserved))
+
+    def test_adding_reserves_until_sold_out(self):
+        self.assertEqual(cart.add_item(self.user, self.item.slug), cart.ADDED)
+        self.assertEqual(cart.add_item(self.user, self.item.slug), cart.UPDATED)
+        self.assertEqual(cart.add_item(self.other, self.item.slug), cart.ADDED)
+        self.assertEqual(cart.add_item(self.other, self.item.slug), cart.OUT_OF_STOCK)
+        self.assertStock(3, 3)
+        self.assertEqual(Reservation.objects.get(order_item__user=self.user).quantity, 2)
+        self.assertEqual(OrderItem.objects.get(user=self.other).quantity, 1)
+
+    def test_untracked_items_never_run_out(self):
+        for _ in range(5):
+            cart.add_item(self.user, self.items[1].slug)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_removing_releases_stock(self):
+        cart.add_item(self.user, self.item.slug)
+        cart.add_item(self.user, self.item.slug)
+        cart.remove_single_item(self.user, self.item.slug)
+        self.assertStock(3, 1)
+        cart.remove_item(self.user, self.item.slug)
+        self.assertStock(3, 0)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_sweeper_releases_expired_holds(self):
+        cart.add_item(self.user, self.item.slug)
+        cart.add_item(self.other, self.item.slug)
+        Reservation.objects.filter(order_item__user=self.user).update(expires=timezone.now())
+        call_command('release_reservations', '--batch-size', '1', stdout=StringIO())
+        self.assertStock(3, 1)
+        self.assertEqual(Reservation.objects.get().order_item.user, self.other)
+
+    def test_payment_takes_stock(self):
+        cart.add_item(self.user, self.item.slug)
+        cart.add_item(self.user, self.item.slug)
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+        self.assertEqual(Payment.objects.get().status, Payment.SUCCEEDED)
+        self.assertStock(1, 0)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_expired_hold_is_taken_again_before_charging(self):
+        cart.add_item(self.user, self.item.slug)
+        Reservation.objects.update(expires=timezone.now())
+        inventory.release_expired()
+        for _ in range(3):
+            cart.add_item(self.other, self.item.slug)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('core:order-summary'), fetch_redirect_response=False)
+        self.assertFalse(Payment.objects.exists())
+        self.assertStock(3, 3)
+
+    def test_hold_expired_while_charging(self):
+        cart.add_item(self.user, self.item.slug)
+        cart.add_item(self.user, self.item.slug)
+        found = payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        # The charge outlives one of the two held units, which other carts
+        # then take with the last unit on hand
+        inventory.release_one(OrderItem.objects.filter(user=self.user))
+        cart.add_item(self.other, self.item.slug)
+        cart.add_item(self.other, self.item.slug)
+        self.assertStock(3, 3)
+        payments.process_payment(found.pk)
+        self.assertEqual(Payment.objects.get().status, Payment.SUCCEEDED)
+        # Nothing taken, the unit still held by the order is given back
+        self.assertStock(3, 2)
+        self.assertEqual(Reservation.objects.get().order_item.user, self.other)
+
+
+class StockContentionTests(TransactionTestCase):
+
+    def test_concurrent_carts_do_not_oversell(self):
+        category = Category.objects.create(title='Category')
+        item = Item.objects.create(title='Item', price=10, category=category, label='P', slug='item')
+        StockLevel.objects.create(item=item, on_hand=5)
+        users = [get_user_model().objects.create_user(username=f'shopper-{i}') for i in range(6)]
+        results = []
+        errors = []
+
+        def shop(user):
+            try:
+                for _ in range(3):
+                    results.append(cart.add_item(user, 'item'))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=shop, args=(user,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results) - results.count(cart.OUT_OF_STOCK), 5)
+        self.assertEqual(sum(OrderItem.objects.values_list('quantity', flat=True)), 5)
+        stock = StockLevel.objects.get()
+        self.assertEqual((stock.on_hand, stock.reserved), (5, 5))
+
+        # Paying for every cart at once takes exactly what was held
+        @retry_on_lock
+        @transaction.atomic
+        def pay(order):
+            payment = Payment.objects.create(user=order.user, order=order, amount=order.get_total())
+            cart.finalize_order(order.pk, payment.pk)
+
+        def checkout(order):
+            try:
+                pay(order)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=checkout, args=(order,)) for order in Order.objects.select_related('user')]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        stock.refresh_from_db()
+        self.assertEqual((stock.on_hand, stock.reserved), (0, 0))
+
+
+@skipUnless(connection.settings_dict['ENGINE'] == 'core.backends.sqlite3', 'SQLite tuning is off')
+class SQLiteTuningTests(TransactionTestCase):
+
+    def test_connections_apply_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -64000)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+
+    def test_transactions_take_the_write_lock_up_front(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Category.objects.exists()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def serve(self, view, cookies=None):
+        # Runs view() inside the middleware and returns its result and the response
+        result = {}
+
+        def get_response(request):
+            result['value'] = view()
+            return HttpResponse()
+
+        request = self.factory.get('/')
+        request.COOKIES.update(cookies or {})
+        response = StickyPrimaryMiddleware(get_response)(request)
+        return result['value'], response
+
+    def test_catalog_reads_use_the_replica_during_requests(self):
+        databases, _ = self.serve(lambda: [self.router.db_for_read(model) for model in (Item, Category, Order)])
+        self.assertEqual(databases, ['replica_1', 'replica_1', 'default'])
+        # Commands and background tasks
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+
+    def test_writes_stick_to_the_primary(self):
+        def write_then_read():
+            self.router.db_for_write(OrderItem)
+            return self.router.db_for_read(Item)
+
+        database, response = self.serve(write_then_read)
+        self.assertEqual(database, 'default')
+        cookie = response.cookies[STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+
+        database, response = self.serve(lambda: self.router.db_for_read(Item), {STICKY_COOKIE: cookie.value})
+        self.assertEqual(database, 'default')
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        expired = {STICKY_COOKIE: str(time.time() - 1)}
+        self.assertEqual(self.serve(lambda: self.router.db_for_read(Item), expired)[0], 'replica_1')
+        self.assertEqual(self.serve(lambda: self.router.db_for_read(Item), {STICKY_COOKIE: 'x'})[0], 'replica_1')
+
+    async def test_async_views_stick_to_the_primary(self):
+        # The state set by the middleware reaches the sync_to_async threads
+        async def get_response(request):
+            await sync_to_async(self.router.db_for_write)(OrderItem)
+            return HttpResponse()
+
+        middleware = StickyPrimaryMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(self.factory.get('/'))
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(self.router.allow_migrate('replica_1', 'core'))
+        self.assertTrue(self.router.allow_migrate('default', 'core'))
+
+
+def make_image(size=(1200, 900), format='PNG', color='red'):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=format)
+    return SimpleUploadedFile(f'photo.{format.lower()}', buffer.getvalue())
+
+
+@override_settings(BACKGROUND_TASKS_EAGER=True)
+class ImageProcessingTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media.disable()
+        shutil.rmtree(cls.media_root)
+        super().tearDownClass()
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+    def create_item(self, **kwargs):
+        return Item.objects.create(
+            title='Photo',
+            price=10,
+            category=Category.objects.create(title='Category'),
+            label='P',
+            description='',
+            slug=kwargs.pop('slug', 'photo'),
+            **kwargs,
+        )
+
+    def test_save_without_image(self):
+        item = self.create_item()
+        self.assertTrue(Item.objects.filter(pk=item.pk).exists())
+        self.assertFalse(ImageJob.objects.exists())
+
+    def test_renditions_are_generated_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            item = self.create_item(image=make_image())
+        self.assertEqual(ImageJob.objects.get().status, ImageJob.PENDING)
+        self.assertEqual(rendition_url(item), item.image.url)
+
+        for callback in callbacks:
+            callback()
+        item.refresh_from_db()
+        self.assertEqual(ImageJob.objects.get().status, ImageJob.DONE)
+        self.assertEqual(len(item.image_hash), 64)
+        for width in RENDITIONS.values():
+            with default_storage.open(rendition_name(item.image_hash, width)) as f:
+                image = Image.open(f)
+                self.assertEqual(image.format, 'JPEG')
+                self.assertEqual(max(image.size), min(width, 1200))
+        # The upload itself is left untouched
+        self.assertEqual(Image.open(item.image.path).format, 'PNG')
+
+    def test_unchanged_image_is_not_processed_again(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = self.create_item(image=make_image())
+        item = Item.objects.get(pk=item.pk)
+        item.title = 'Renamed'
+        item.save()
+        self.assertEqual(ImageJob.objects.count(), 1)
+
+    def test_identical_upload_reuses_renditions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.create_item(image=make_image())
+            second = self.create_item(image=make_image(), slug='copy')
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image_hash, second.image_hash)
+        self.assertEqual(rendition_url(first, 'retina'), rendition_url(second, 'retina'))
+
+    def test_process_image_jobs_command(self):
+        with self.captureOnCommitCallbacks():
+            item = self.create_item(image=make_image(format='JPEG'))
+        call_command('process_image_jobs', workers=1, stdout=StringIO())
+        item.refresh_from_db()
+        self.assertTrue(item.image_hash)
+        self.assertEqual(ImageJob.objects.get().status, ImageJob.DONE)
+
+
+    def render_tag(self, item):
+        return Template(
+            "{% load image_tags %}{% responsive_image item 'card' css_class='card-img-top' %}"
+        ).render(Context({'item': item}))
+
+    def test_responsive_image_before_processing(self):
+        with self.captureOnCommitCallbacks():
+            item = self.create_item(image=make_image())
+        html = self.render_tag(item)
+        self.assertInHTML(f'<img src="{item.image.url}" class="card-img-top" alt="">', html)
+
+    def test_responsive_image_srcset(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = self.create_item(image=make_image())
+        item.refresh_from_db()
+        html = self.render_tag(item)
+        for extension, _, mime_type, _ in available_formats():
+            for width in WIDTHS:
+                name = rendition_name(item.image_hash, width, extension)
+                self.assertTrue(default_storage.exists(name))
+                self.assertIn(f'{default_storage.url(name)} {width}w', html)
+            if extension != 'jpg':
+                self.assertIn(f'<source type="{mime_type}"', html)
+        self.assertIn('sizes="(min-width: 992px) 25vw', html)
+
+    def test_missing_renditions_are_generated_by_a_job(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = self.create_item(image=make_image())
+        item.refresh_from_db()
+        name = rendition_name(item.image_hash, WIDTHS[0], 'webp')
+        default_storage.delete(name)
+        caches['default'].clear()
+        with self.captureOnCommitCallbacks() as callbacks:
+            html = self.render_tag(item)
+            # Queued once, not on every render
+            self.render_tag(item)
+        self.assertInHTML(f'<img src="{item.image.url}" class="card-img-top" alt="">', html)
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(len(callbacks), 1)
+
+        callbacks[0]()
+        self.assertTrue(default_storage.exists(name))
+        self.assertIn('<picture>', self.render_tag(item))
+
+
+class SeedStorefrontTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media.disable()
+        shutil.rmtree(cls.media_root)
+        super().tearDownClass()
+
+    def seed(self, *args):
+        call_command(
+            'seed_storefront', '--categories', '2', '--items', '6', '--users', '2', '--images', '1',
+            *args, stdout=StringIO(),
+        )
+
+    def test_seed(self):
+        self.seed()
+        self.assertEqual(Category.objects.count(), 2)
+        self.assertEqual(StockLevel.objects.count(), 3)
+        self.assertFalse(Item.objects.filter(image_hash='').exists())
+        item = Item.objects.first()
+        self.assertTrue(default_storage.exists(rendition_name(item.image_hash, WIDTHS[0], 'jpg')))
+        self.assertIn(item, get_search_backend().search(item.title))
+        self.assertTrue(self.client.login(username='shopper-1', password='shopper'))
+
+    def test_seed_again(self):
+        self.seed()
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.seed('--clear')
+        self.assertEqual(Item.objects.count(), 6)
+        self.assertEqual(get_user_model().objects.count(), 2)
+
+
+class PageCacheTests(CatalogFixtureMixin, TestCase):
+
+    def test_anonymous_page_is_cached_until_the_catalog_changes(self):
+        url = self.items[0].get_absolute_url()
+        self.assertContains(self.client.get(url), 'A description')
+        Item.objects.filter(pk=self.items[0].pk).update(description='Stale')
+        self.assertContains(self.client.get(url), 'A description')
+
+        item = Item.objects.get(pk=self.items[0].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            item.save()
+        self.assertContains(self.client.get(url), 'Stale')
+
+    @override_settings(CATALOG_VERSION_TIMEOUT=0.2)
+    def test_changes_from_other_processes_show_after_the_version_expires(self):
+        # What another worker or a command does to its own locmem cache
+        url = self.items[0].get_absolute_url()
+        self.assertContains(self.client.get(url), 'A description')
+        Item.objects.filter(pk=self.items[0].pk).update(description='Changed elsewhere')
+        self.assertContains(self.client.get(url), 'A description')
+        time.sleep(0.3)
+        self.assertContains(self.client.get(url), 'Changed elsewhere')
+
+    def test_pages_are_keyed_by_cursor(self):
+        first = self.client.get(reverse('core:home'))
+        second = self.client.get(reverse('core:home') + f'?after={self.items[9].pk}')
+        self.assertNotEqual(first.content, second.content)
+        self.assertContains(second, 'Item 10')
+
+    def test_conditional_get(self):
+        url = reverse('core:home')
+        response = self.client.get(url)
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_authenticated_users_get_their_own_page(self):
+        self.client.get(reverse('core:home'))
+        self.client.force_login(self.user)
+        self.fill_cart(2)
+        response = self.client.get(reverse('core:home'))
+        self.assertFalse(response.has_header('ETag'))
+        self.assertContains(response, 'Logout')
+
+    def test_item_cards_are_cached_for_authenticated_users(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('core:home'))
+        Item.objects.filter(pk=self.items[0].pk).update(title='Stale')
+        self.assertNotContains(self.client.get(reverse('core:home')), 'Stale')
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(title='New category')
+        self.assertContains(self.client.get(reverse('core:home')), 'Stale')
+
+
+class MetricsTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_metrics()
+
+    def exposition(self):
+        response = self.client.get(reverse('core:metrics'))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('core:home'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+        # Served from the page cache
+        response = self.client.get(reverse('core:home'))
+        self.assertIn('desc="0 queries"', response['Server-Timing'])
+
+    def test_exposition_by_view(self):
+        self.client.get(reverse('core:home'))
+        self.client.get(reverse('core:home'))
+        text = self.exposition()
+        self.assertIn('http_requests_total{view="core:home",status="200"} 2', text)
+        self.assertIn('db_queries_per_request_bucket{view="core:home",le="0"} 1', text)
+        self.assertIn('db_queries_per_request_sum{view="core:home"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{view="core:home"} 2', text)
+        self.assertIn('cache_lookups_total{view="core:home",result="hit"}', text)
+
+    def test_template_time_is_recorded(self):
+        self.client.get(self.items[0].get_absolute_url())
+        total = re.search(r'template_render_duration_seconds_sum\{view="core:product"\} (\S+)', self.exposition())
+        self.assertGreater(float(total.group(1)), 0)
+
+    def test_cache_hits_and_misses(self):
+        self.client.get(reverse('core:home'))
+        response = self.client.get(reverse('core:home'))
+        self.assertRegex(response['Server-Timing'], r'cache;desc="[1-9]\d* hits 0 misses"')
+
+    def test_metrics_are_restricted(self):
+        response = self.client.get(reverse('core:metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 403)
+
+    async def test_async_views_are_measured(self):
+        # The queries run in a sync_to_async thread
+        async def get_response(request):
+            await sync_to_async(lambda: list(Category.objects.all()))()
+            return HttpResponse()
+
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().get('/'))
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    @override_settings(SLOW_REQUEST_SECONDS=0, SLOW_REQUEST_SAMPLE_RATE=1)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.client.get(reverse('core:home'))
+        self.assertIn('Slow request GET / (core:home)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(SLOW_REQUEST_SECONDS=0, SLOW_REQUEST_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_logged(self):
+        with self.assertNoLogs('core.metrics', 'WARNING'):
+            self.client.get(reverse('core:home'))
+
+
+class CatalogPaginationTests(CatalogFixtureMixin, TestCase):
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('core:home'), params)
+        return response, [item.title for item in response.context['object_list']]
+
+    def test_walk_forward_and_back(self):
+        response, titles = self.get_page()
+        self.assertEqual(titles, [f'Item {i}' for i in range(10)])
+        page = response.context['page_obj']
+        self.assertFalse(page.has_previous())
+        self.assertContains(response, f'after={page.next_cursor}')
+
+        response, titles = self.get_page(after=page.next_cursor)
+        self.assertEqual(titles, [f'Item {i}' for i in range(10, 20)])
+        page = response.context['page_obj']
+
+        response, titles = self.get_page(after=page.next_cursor)
+        self.assertEqual(titles, [f'Item {i}' for i in range(20, 25)])
+        self.assertFalse(response.context['page_obj'].has_next())
+
+        response, titles = self.get_page(before=page.previous_cursor)
+        self.assertEqual(titles, [f'Item {i}' for i in range(10)])
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_category_filter(self):
+        category = self.categories[1]
+        response, titles = self.get_page(category=category.pk)
+        self.assertEqual(titles, [f'Item {i}' for i in range(1, 25, 3)])
+        self.assertEqual(response.context['current_category'], category)
+        self.assertContains(response, f'href="?category={category.pk}"')
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse('core:home'), {'after': 'x'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('core:home'), {'category': 999}).status_code, 404)
+
+
+class CatalogImportTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write_csv(self, rows, name='catalog.csv'):
+        path = f'{self.dir}/{name}'
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['slug', 'title', 'category', 'price', 'discount_price', 'label', 'image'])
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def rows(self, count, **values):
+        return [
+            {'slug': f'sku-{i}', 'title': f'Boots {i}', 'category': f'Shoes {i % 2}', 'price': '19.99', **values}
+            for i in range(count)
+        ]
+
+    def import_catalog(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        out, _ = self.import_catalog(self.write_csv(self.rows(5)))
+        self.assertIn('5 created, 0 updated, 0 unchanged, 0 invalid', out)
+        self.assertEqual(sorted(Category.objects.values_list('title', flat=True)), ['Shoes 0', 'Shoes 1'])
+        item = Item.objects.get(slug='sku-3')
+        self.assertEqual((item.price, item.category.title, item.label), (Decimal('19.99'), 'Shoes 1', 'P'))
+        self.assertIn(item, get_search_backend().search('boots 3'))
+
+    def test_upsert_by_slug(self):
+        path = self.write_csv(self.rows(5))
+        self.import_catalog(path)
+        out, _ = self.import_catalog(path)
+        self.assertIn('0 created, 0 updated, 5 unchanged', out)
+        rows = self.rows(6)
+        rows[0]['price'] = '25'
+        out, _ = self.import_catalog(self.write_csv(rows))
+        self.assertIn('1 created, 1 updated, 4 unchanged', out)
+        self.assertEqual(Item.objects.get(slug='sku-0').price, Decimal('25.00'))
+        self.assertEqual(Item.objects.count(), 6)
+
+    def test_queries_do_not_grow_with_rows(self):
+        self.import_catalog(self.write_csv(self.rows(2), 'seed.csv'))
+        with CaptureQueriesContext(connection) as few:
+            self.import_catalog(self.write_csv(self.rows(20, price='30'), 'few.csv'))
+        Item.objects.all().delete()
+        self.import_catalog(self.write_csv(self.rows(2), 'seed.csv'))
+        with CaptureQueriesContext(connection) as many:
+            self.import_catalog(self.write_csv(self.rows(100, price='30'), 'many.csv'))
+        self.assertEqual(len(few), len(many))
+
+    def test_images_are_queued(self):
+        self.import_catalog(self.write_csv(self.rows(3, image='items-images/boots.jpg')))
+        self.assertEqual(ImageJob.objects.filter(status=ImageJob.PENDING).count(), 3)
+        # Unchanged images are not processed again
+        self.import_catalog(self.write_csv(self.rows(3, image='items-images/boots.jpg', price='5')))
+        self.assertEqual(ImageJob.objects.count(), 3)
+
+    def test_invalid_rows_are_skipped(self):
+        rows = self.rows(3)
+        rows[1]['price'] = 'free'
+        rows[2]['slug'] = 'not a slug'
+        out, err = self.import_catalog(self.write_csv(rows))
+        self.assertIn('1 created, 0 updated, 0 unchanged, 2 invalid', out)
+        self.assertIn('Line 3: price is not a valid price', err)
+        self.assertIn('Line 4:', err)
+        with self.assertRaises(CommandError):
+            self.import_catalog(self.write_csv(rows), '--max-errors', '1')
+
+    def test_non_finite_prices_are_invalid(self):
+        rows = self.rows(4)
+        rows[1]['price'] = 'inf'
+        rows[2]['price'] = 'NaN'
+        rows[3]['discount_price'] = '1e20'
+        out, err = self.import_catalog(self.write_csv(rows))
+        self.assertIn('1 created, 0 updated, 0 unchanged, 3 invalid', out)
+        self.assertIn("Line 3: price is not a valid price: 'inf'", err)
+        self.assertIn("Line 4: price is not a valid price: 'NaN'", err)
+        self.assertIn("Line 5: discount_price is not a valid price: '1e20'", err)
+
+    def test_json_rows_must_be_objects(self):
+        path = f'{self.dir}/catalog.jsonl'
+        with open(path, 'w') as f:
+            f.write('[1, 2]\n"x"\n')
+            f.write(json.dumps({'slug': 'sku-0', 'title': 'Boots', 'category': 'Shoes', 'price': float('nan')}) + '\n')
+            f.write(json.dumps(self.rows(1)[0]) + '\n')
+        out, err = self.import_catalog(path)
+        self.assertIn('1 created, 0 updated, 0 unchanged, 3 invalid', out)
+        self.assertIn('Line 1: Expected an object, got list', err)
+        self.assertIn('Line 2: Expected an object, got str', err)
+        self.assertIn('Line 3: price is not a valid price', err)
+
+    def test_export_round_trip(self):
+        self.import_catalog(self.write_csv(self.rows(5, discount_price='9.50')))
+        for format in ('csv', 'jsonl'):
+            path = f'{self.dir}/export.{format}'
+            call_command('export_catalog', path, '--batch-size', '2', stderr=StringIO())
+            out, _ = self.import_catalog(path)
+            self.assertIn('0 created, 0 updated, 5 unchanged', out)
+        with open(f'{self.dir}/export.jsonl') as f:
+            first = json.loads(f.readline())
+        self.assertEqual((first['slug'], first['discount_price']), ('sku-0', '9.50'))
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        shoes = Category.objects.create(title='Shoes')
+        shirts = Category.objects.create(title='Shirts')
+        cls.boots = Item.objects.create(
+            title='Leather boots', price=80, category=shoes, label='P',
+            description='Waterproof hiking boots', slug='leather-boots',
+        )
+        cls.sneakers = Item.objects.create(
+            title='Running sneakers', price=60, category=shoes, label='S',
+            description='Light shoes for leather-free running', slug='running-sneakers',
+        )
+        cls.shirt = Item.objects.create(
+            title='Linen shirt', price=30, category=shirts, label='D',
+            description='Summer shirt', slug='linen-shirt',
+        )
+
+    def search(self, text):
+        return [item.slug for item in get_search_backend().search(text)]
+
+    def test_match_query_escapes_operators(self):
+        self.assertEqual(match_query('boots OR "x'), '"boots" "OR" "x"')
+        self.assertEqual(match_query('boo', column='title', prefix=True), 'title : ("boo"*)')
+        self.assertIsNone(match_query('  -- '))
+
+    def test_ranked_results(self):
+        # A title match ranks above a description match
+        self.assertEqual(self.search('leather'), ['leather-boots', 'running-sneakers'])
+        self.assertEqual(sorted(self.search('shoes')), ['leather-boots', 'running-sneakers'])
+        self.assertEqual(self.search('hiking boots'), ['leather-boots'])
+        self.assertEqual(self.search(''), [])
+
+    def test_best_match_is_found_among_many(self):
+        Item.objects.bulk_create([
+            Item(
+                title=f'Sock {i}', price=5, category=self.shirt.category, label='P',
+                description='Wool socks', slug=f'sock-{i}',
+            )
+            for i in range(600)
+        ])
+        Item.objects.create(title='Wool hat', price=20, category=self.shirt.category, label='P', slug='wool-hat')
+        backend = get_search_backend()
+        # bulk_create sends no signals
+        backend.rebuild()
+        # Broad queries rank the newest FTS_CANDIDATES matches
+        self.assertEqual([item.slug for item in backend.search('wool', limit=1)], ['wool-hat'])
+
+    def test_index_follows_model_changes(self):
+        self.shirt.title = 'Cotton tee'
+        self.shirt.save()
+        self.assertEqual(self.search('linen'), [])
+        self.assertEqual(self.search('cotton'), ['linen-shirt'])
+
+        category = self.shirt.category
+        category.title = 'Tops'
+        category.save()
+        self.assertEqual(self.search('tops'), ['linen-shirt'])
+
+        self.shirt.delete()
+        self.assertEqual(self.search('cotton'), [])
+
+    def test_autocomplete_matches_title_prefixes(self):
+        response = self.client.get(reverse('core:search-autocomplete'), {'q': 'run'})
+        self.assertEqual([r['slug'] for r in response.json()['results']], ['running-sneakers'])
+        response = self.client.get(reverse('core:search-autocomplete'), {'q': 'waterpr'})
+        self.assertEqual(response.json()['results'], [])
+
+    def test_search_json(self):
+        response = self.client.get(reverse('core:search-json'), {'q': 'boots'})
+        result = response.json()['results'][0]
+        self.assertEqual(result['url'], self.boots.get_absolute_url())
+        self.assertEqual(result['category'], 'Shoes')
+
+    def test_search_page(self):
+        response = self.client.get(reverse('core:search'), {'q': 'shirt'})
+        self.assertContains(response, 'Linen shirt')
+        self.assertNotContains(response, 'Leather boots')
+        response = self.client.get(reverse('core:search'), {'q': 'nothing'})
+        self.assertContains(response, 'No item matches')
+
+    @override_settings(SEARCH_BACKEND='core.search.DatabaseSearchBackend')
+    def test_fallback_backend(self):
+        self.assertEqual(sorted(self.search('leather')), ['leather-boots', 'running-sneakers'])
+
+
+class CatalogAPITests(CatalogFixtureMixin, TestCase):
+
+    def test_list_pages_with_cursor(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('core:api-items'), {'limit': 10})
+        data = response.json()
+        self.assertEqual([row['id'] for row in data['results']], [item.pk for item in self.items[:10]])
+        self.assertEqual(data['results'][0]['category'], 'Category 0')
+        self.assertEqual(data['next'], self.items[9].pk)
+
+        data = self.client.get(reverse('core:api-items'), {'limit': 10, 'after': data['next']}).json()
+        self.assertEqual(data['results'][0]['id'], self.items[10].pk)
+        data = self.client.get(reverse('core:api-items'), {'limit': 10, 'after': self.items[19].pk}).json()
+        self.assertEqual(len(data['results']), 5)
+        self.assertIsNone(data['next'])
+
+    def test_field_selection(self):
+        data = self.client.get(reverse('core:api-items'), {'fields': 'slug,price', 'limit': 2}).json()
+        self.assertEqual(data['results'], [{'slug': 'item-0', 'price': '10.00'}, {'slug': 'item-1', 'price': '11.00'}])
+        self.assertEqual(data['next'], self.items[1].pk)
+
+        response = self.client.get(reverse('core:api-items'), {'fields': 'slug,secret'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unknown fields: secret'})
+
+    def test_invalid_parameters(self):
+        url = reverse('core:api-items')
+        for params, error in [
+            ({'limit': 'abc'}, 'limit must be an integer'),
+            ({'after': 'x'}, 'after must be an integer'),
+            ({'category': 'x'}, 'category must be an integer'),
+            ({'limit': 0}, 'limit must be at least 1'),
+            ({'limit': -5}, 'limit must be at least 1'),
+        ]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(response.json(), {'error': error})
+        with mock.patch('core.api.MAX_LIMIT', 10):
+            data = self.client.get(url, {'limit': 1000}).json()
+        self.assertEqual(len(data['results']), 10)
+
+    def test_detail(self):
+        response = self.client.get(reverse('core:api-item', args=['item-3']))
+        self.assertEqual(response.json()['description'], 'A description')
+        self.assertIsNone(response.json()['image'])
+        self.assertEqual(self.client.get(reverse('core:api-item', args=['missing'])).status_code, 404)
+
+    def test_conditional_get(self):
+        url = reverse('core:api-item', args=['item-3'])
+        etag = self.client.get(url)['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        item = self.items[3]
+        with self.captureOnCommitCallbacks(execute=True):
+            item.title = 'Renamed'
+            item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'Renamed')
+
+    def test_compression(self):
+        url = reverse('core:api-items')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content))['results'][0]['slug'], 'item-0')
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.json()['results'][0]['slug'], 'item-0')
+
+    def test_negotiate_encoding(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0.5, br')
+        expected = 'br' if 'br' in available_encodings() else 'gzip'
+        self.assertEqual(negotiate_encoding(request), expected)
+        self.assertIsNone(negotiate_encoding(RequestFactory().get('/')))
+
+
+class AdminTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = get_user_model().objects.create_superuser(username='admin', password='admin-password')
+        self.client.force_login(self.admin)
+
+    def paid_orders(self, count):
+        Order.objects.bulk_create([
+            Order(user=self.user, ordered=True, ordered_date=timezone.now()) for _ in range(count)
+        ])
+        return Order.objects.filter(ordered=True)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        for name in ('order', 'orderitem', 'item', 'payment'):
+            url = reverse(f'admin:core_{name}_changelist')
+            with CaptureQueriesContext(connection) as few:
+                self.client.get(url)
+            if name == 'order':
+                self.paid_orders(30)
+            elif name == 'orderitem':
+                self.fill_cart(20)
+            elif name == 'payment':
+                Payment.objects.bulk_create([Payment(user=self.user, amount=10) for _ in range(30)])
+            with CaptureQueriesContext(connection) as many:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(few), len(many), name)
+
+    def test_unfiltered_list_is_not_counted(self):
+        url = reverse('admin:core_item_changelist')
+        with mock.patch.object(EstimatedCountPaginator, 'exact_below', 10):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.context['cl'].result_count, self.items[-1].pk)
+            self.assertFalse([q['sql'] for q in queries if 'COUNT(' in q['sql']])
+            # Filtered lists are counted
+            response = self.client.get(url, {'category__id__exact': self.categories[0].pk})
+            self.assertEqual(response.context['cl'].result_count, 9)
+
+    def test_exact_search(self):
+        url = reverse('admin:core_item_changelist')
+        response = self.client.get(url, {'q': 'item-3'})
+        self.assertEqual([item.slug for item in response.context['cl'].result_list], ['item-3'])
+        response = self.client.get(url, {'q': 'item'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_mark_shipped(self):
+        orders = list(self.paid_orders(3))
+        open_order = self.fill_cart(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('admin:core_order_changelist'), {
+                'action': 'mark_shipped',
+                '_selected_action': [order.pk for order in orders] + [open_order.pk],
+            })
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(Order.objects.filter(shipped=True, shipped_date__isnull=False).count(), 3)
+        open_order.refresh_from_db()
+        self.assertFalse(open_order.shipped)
+
+    def test_apply_discount(self):
+        version = catalog_version()['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:core_item_changelist'), {
+                'action': 'apply_discount_10',
+                '_selected_action': [item.pk for item in self.items[:2]],
+            })
+        self.assertEqual(
+            list(Item.objects.filter(pk__in=[item.pk for item in self.items[:2]]).values_list('discount_price', flat=True)),
+            [Decimal('9.00'), Decimal('9.90')],
+        )
+        self.assertNotEqual(catalog_version()['version'], version)
+        self.client.post(reverse('admin:core_item_changelist'), {
+            'action': 'remove_discount', '_selected_action': [self.items[1].pk],
+        })
+        self.assertIsNone(Item.objects.get(pk=self.items[1].pk).discount_price)
+
+
+class MoneyTests(TestCase):
+
+    def test_cents_round_trip(self):
+        # int(19.99 * 100) is 1998
+        self.assertEqual(to_cents(19.99), 1999)
+        self.assertEqual(to_cents(Decimal('0.105')), 11)
+        self.assertEqual(from_cents(1999), Decimal('19.99'))
+        self.assertEqual(to_decimal(0.1 + 0.2), Decimal('0.30'))
+
+    def test_totals_are_exact(self):
+        category = Category.objects.create(title='Category')
+        item = Item.objects.create(title='Item', price=Decimal('0.10'), category=category, label='P', slug='item')
+        user = get_user_model().objects.create_user(username='buyer')
+        for _ in range(3):
+            cart.add_item(user, item.slug)
+        order = Order.objects.get(user=user)
+        self.assertEqual(order.subtotal, Decimal('0.30'))
+        self.assertEqual(order.get_total(), Decimal('0.30'))
+
+
+@override_settings(
+    PAYMENT_GATEWAY='core.payments.FakeGateway',
+    PAYMENT_RETRY_DELAY=0,
+    BACKGROUND_TASKS_EAGER=True,
+)
+class PaymentTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        FakeGateway.reset()
+        self.order = self.fill_cart(3)
+        self.client.force_login(self.user)
+
+    def pay(self, token='tok_visa'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': token})
+        return response
+
+    def test_successful_charge_places_the_order(self):
+        response = self.pay()
+        payment = Payment.objects.get()
+        self.assertRedirects(response, reverse('core:payment-status', args=[payment.pk]), fetch_redirect_response=False)
+        self.assertEqual(payment.status, Payment.SUCCEEDED)
+        self.assertEqual(payment.idempotency_key, f'order-{self.order.pk}-1')
+        self.assertEqual(payment.source, '')
+        charge = FakeGateway.charges[payment.idempotency_key]
+        self.assertEqual(payment.stripe_charge_id, charge['id'])
+        self.assertEqual(charge['amount'], to_cents(self.order.get_total()))
+
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(self.order.payment, payment)
+        response = self.client.get(reverse('core:payment-status', args=[payment.pk]))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def test_order_changed_after_the_charge_started_is_not_placed(self):
+        payment = payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        # A line the charge does not cover, added behind the cart's back
+        line = OrderItem.objects.create(user=self.user, item=self.items[10], quantity=2)
+        self.order.items.add(line)
+        self.order.update_totals()
+        with self.assertLogs('core.payments', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            payments.process_payment(payment.pk)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.FAILED)
+        self.assertEqual(payment.error, payments.CHARGE_MISMATCH_ERROR)
+        self.assertTrue(payment.stripe_charge_id)
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.ordered)
+        self.assertFalse(OrderItem.objects.filter(ordered=True).exists())
+        # The charge is refunded once the failure has committed
+        refund = FakeGateway.refunds[f'{payment.idempotency_key}-refund']
+        self.assertEqual(refund['charge'], payment.stripe_charge_id)
+        self.assertEqual(payment.stripe_refund_id, refund['id'])
+
+    def test_failed_refund_is_sent_again(self):
+        payment = payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        self.order.items.add(OrderItem.objects.create(user=self.user, item=self.items[10], quantity=2))
+        self.order.update_totals()
+        with self.assertLogs('core.payments', 'ERROR') as logs:
+            with self.captureOnCommitCallbacks() as callbacks:
+                payments.process_payment(payment.pk)
+            FakeGateway.outages = 1
+            for callback in callbacks:
+                callback()
+        self.assertIn('Refunding payment', logs.output[-1])
+        self.assertEqual(payments.unrefunded_payment_ids(), [payment.pk])
+
+        out = StringIO()
+        call_command('process_payments', '--workers', '1', stdout=out)
+        self.assertIn('Refunded 1 payments.', out.getvalue())
+        payment.refresh_from_db()
+        self.assertEqual(payment.stripe_refund_id, FakeGateway.refunds[f'{payment.idempotency_key}-refund']['id'])
+        self.assertEqual(payments.unrefunded_payment_ids(), [])
+
+    def test_retry_does_not_hold_a_worker(self):
+        payment = payments.start_payment(self.user, 'tok_visa', enqueue=False)
+        FakeGateway.outages = 1
+        with mock.patch('core.payments.submit_later') as submit_later:
+            payments.process_payment(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.PENDING)
+        submit_later.assert_called_once_with(0, payments.process_payment, payment.pk)
+
+    @override_settings(BACKGROUND_TASKS_EAGER=False)
+    def test_submit_later(self):
+        done = threading.Event()
+        timer = tasks.submit_later(0.01, done.set)
+        self.assertTrue(timer.daemon)
+        self.assertTrue(done.wait(5))
+
+    def test_double_submit_charges_once(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            first = self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+            second = self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(Payment.objects.count(), 1)
+        # The charge is only sent once the request has committed
+        self.assertEqual(FakeGateway.charges, {})
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(FakeGateway.charges), 1)
+
+    def test_declined_card_keeps_the_cart(self):
+        self.pay(FakeGateway.DECLINED_SOURCE)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.status, Payment.FAILED)
+        self.assertEqual(payment.error, 'Your card was declined.')
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.ordered)
+
+        # A new attempt gets a new idempotency key
+        self.pay()
+        self.assertEqual(
+            list(self.order.payments.order_by('id').values_list('status', 'idempotency_key')),
+            [(Payment.FAILED, f'order-{self.order.pk}-1'), (Payment.SUCCEEDED, f'order-{self.order.pk}-2')],
+        )
+
+    def test_gateway_errors_are_retried(self):
+        FakeGateway.outages = 2
+        self.pay()
+        payment = Payment.objects.get()
+        self.assertEqual(payment.status, Payment.SUCCEEDED)
+        self.assertEqual(payment.attempts, 3)
+
+        FakeGateway.outages = MAX_ATTEMPTS
+        self.order = self.fill_cart(1)
+        self.pay()
+        payment = Payment.objects.latest('id')
+        self.assertEqual(payment.status, Payment.FAILED)
+        self.assertEqual(payment.error, 'Network error')
+
+    def test_status_polling(self):
+        with self.captureOnCommitCallbacks():
+            self.client.post(reverse('core:payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+        payment = Payment.objects.get()
+        url = reverse('core:payment-status', args=[payment.pk])
+        self.assertContains(self.client.get(url), 'Processing your payment')
+        self.assertEqual(self.client.get(url, {'format': 'json'}).json(), {'status': 'pending', 'error': ''})
+
+        other = get_user_model().objects.create_user(username='other', password='secret-password')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class FakeStripeServerTests(TestCase):
+
+    def setUp(self):
+        self.server = make_server(error_rate=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_stripe_gateway_against_fake_server(self):
+        with override_settings(STRIPE_API_BASE=server_url(self.server)):
+            gateway = StripeGateway()
+        try:
+            charge_id = gateway.charge(1999, 'usd', 'tok_visa', 'order-1-1')
+            self.assertTrue(charge_id.startswith('ch_'))
+            # Replayed, not charged again
+            self.assertEqual(gateway.charge(1999, 'usd', 'tok_visa', 'order-1-1'), charge_id)
+            self.assertEqual(self.server.charges, 1)
+            refund_id = gateway.refund(charge_id, 'order-1-1-refund')
+            self.assertTrue(refund_id.startswith('re_'))
+            self.assertEqual(gateway.refund(charge_id, 'order-1-1-refund'), refund_id)
+            self.assertEqual(self.server.charges, 1)
+            with self.assertRaisesMessage(PaymentDeclined, 'Your card was declined.'):
+                gateway.charge(1999, 'usd', 'tok_chargeDeclined', 'order-2-1')
+
+            self.server.error_rate = 1
+            with self.assertRaises(GatewayUnavailable):
+                gateway.charge(1999, 'usd', 'tok_visa', 'order-3-1')
+        finally:
+            stripe.api_base = 'https://api.stripe.com'
+
+    def test_async_charge_against_fake_server(self):
+        with override_settings(STRIPE_API_BASE=server_url(self.server)):
+            gateway = StripeGateway()
+
+        async def charge(source, key):
+            return await gateway.charge_async(1999, 'usd', source, key)
+
+        try:
+            charge_id = async_to_sync(charge)('tok_visa', 'order-1-1')
+            self.assertEqual(async_to_sync(charge)('tok_visa', 'order-1-1'), charge_id)
+            self.assertEqual(self.server.charges, 1)
+            with self.assertRaisesMessage(PaymentDeclined, 'Your card was declined.'):
+                async_to_sync(charge)('tok_chargeDeclined', 'order-2-1')
+            self.server.error_rate = 1
+            with self.assertRaises(GatewayUnavailable):
+                async_to_sync(charge)('tok_visa', 'order-3-1')
+        finally:
+            stripe.api_base = 'https://api.stripe.com'
+
+
+def async_request(user, method='get', data=None):
+    if method == 'post':
+        request = AsyncRequestFactory().post('/', urlencode(data or {}), content_type='application/x-www-form-urlencoded')
+    else:
+        # Django 3.2 ignores the data of AsyncRequestFactory.get()
+        request = AsyncRequestFactory().get(f'/?{urlencode(data or {})}')
+    request.user = user
+    request.session = SessionStore()
+    request._messages = FallbackStorage(request)
+    return request
+
+
+@override_settings(
+    PAYMENT_GATEWAY='core.payments.FakeGateway',
+    PAYMENT_RETRY_DELAY=0,
+    BACKGROUND_TASKS_EAGER=True,
+)
+class AsyncViewTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        FakeGateway.reset()
+
+    def make_request(self, method='get', data=None, user=None):
+        return async_request(user or self.user, method, data)
+
+    async def test_cart_views(self):
+        response = await async_views.add_to_card(self.make_request(), 'item-1')
+        self.assertEqual(response.url, reverse('core:order-summary'))
+        await async_views.add_to_card(self.make_request(), 'item-1')
+        line = await sync_to_async(OrderItem.objects.get)(user=self.user)
+        self.assertEqual(line.quantity, 2)
+
+        response = await async_views.order_summary(self.make_request())
+        self.assertContains(response, 'Item 1')
+
+        await async_views.remove_single_item_from_card(self.make_request(), 'item-1')
+        response = await async_views.remove_from_card(self.make_request(), 'item-1')
+        self.assertEqual(response.url, reverse('core:order-summary'))
+        self.assertFalse(await sync_to_async(OrderItem.objects.exists)())
+
+    async def test_login_required(self):
+        response = await async_views.payment(self.make_request(user=AnonymousUser()), 'stripe')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(reverse('account_login')))
+
+    async def test_anonymous_cart(self):
+        request = self.make_request(user=AnonymousUser())
+        request.anonymous_cart = cart.AnonymousCart()
+        response = await async_views.add_to_card(request, 'item-1')
+        self.assertEqual(response.url, reverse('core:order-summary'))
+        self.assertEqual(request.anonymous_cart.lines, {self.items[1].pk: 1})
+        self.assertFalse(await sync_to_async(OrderItem.objects.exists)())
+        response = await async_views.order_summary(request)
+        self.assertContains(response, 'Item 1')
+
+    async def test_payment_is_charged_on_the_event_loop(self):
+        order = await sync_to_async(self.fill_cart)(2)
+        request = self.make_request('post', {'stripeToken': 'tok_visa'})
+        response = await async_views.payment(request, 'stripe')
+        found = await sync_to_async(Payment.objects.get)()
+        self.assertEqual(response.url, reverse('core:payment-status', args=[found.pk]))
+        self.assertEqual(found.status, Payment.SUCCEEDED)
+        await sync_to_async(order.refresh_from_db)()
+        self.assertTrue(order.ordered)
+
+        response = await async_views.payment_status(self.make_request(), found.pk)
+        self.assertEqual(response.url, '/')
+
+    async def test_payment_status_answers_at_once(self):
+        await sync_to_async(self.fill_cart)(1)
+        found = await sync_to_async(payments.start_payment)(self.user, 'tok_visa', enqueue=False)
+        response = await async_views.payment_status(self.make_request(), found.pk)
+        self.assertContains(response, 'Processing your payment')
+
+
+@override_settings(PAYMENT_GATEWAY='core.payments.FakeGateway')
+class AsyncPaymentTaskTests(TransactionTestCase):
+    # The charge runs in a task on the event loop, whose ORM calls use their
+    # own connection and must see committed data
+
+    def setUp(self):
+        FakeGateway.reset()
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title='Item', price=10, category=category, label='P', slug='item')
+        ])
+        self.user = get_user_model().objects.create_user(username='shopper')
+        cart.add_item(self.user, 'item')
+
+    async def test_payment_status_reports_the_charge(self):
+        request = async_request(self.user, 'post', {'stripeToken': 'tok_visa'})
+        response = await async_views.payment(request, 'stripe')
+        pk = resolve(response.url).kwargs['pk']
+        # The status view answers at once, poll it like the status page does
+        for _ in range(50):
+            request = async_request(self.user, data={'format': 'json'})
+            response = await async_views.payment_status(request, pk)
+            status = json.loads(response.content)
+            if status['status'] in (Payment.SUCCEEDED, Payment.FAILED):
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(status, {'status': 'succeeded', 'error': ''})
+        self.assertEqual(len(FakeGateway.charges), 1)
+
+
+def reload_urls():
+    # core.urls picks the sync or async views when it is imported
+    importlib.reload(core_urls)
+    importlib.reload(ecommerce_urls)
+    clear_url_caches()
+
+
+@override_settings(PAYMENT_GATEWAY='core.payments.FakeGateway')
+class ASGICheckoutTests(TransactionTestCase):
+    # Through ecommerce.asgi.application and the whole MIDDLEWARE stack, as
+    # uvicorn serves it. A sync only middleware runs the async views on an
+    # event loop of their own, which cancels the charge task with the
+    # request.
+
+    def setUp(self):
+        FakeGateway.reset()
+        category = Category.objects.create(title='Category')
+        Item.objects.bulk_create([
+            Item(title='Item', price=10, category=category, label='P', slug='item')
+        ])
+        self.user = get_user_model().objects.create_user(username='shopper')
+        cart.add_item(self.user, 'item')
+        client = Client()
+        client.force_login(self.user)
+        self.cookies = SimpleCookie()
+        self.cookies[settings.SESSION_COOKIE_NAME] = client.cookies[settings.SESSION_COOKIE_NAME].value
+        with override_settings(ASYNC_VIEWS=True):
+            reload_urls()
+        self.addCleanup(reload_urls)
+        from ecommerce.asgi import application
+        self.application = application
+
+    async def request(self, method, path, data=None):
+        # Returns the status, the headers and the body of the response
+        path, _, query = path.partition('?')
+        headers = [
+            (b'host', b'testserver'),
+            (b'cookie', '; '.join(f'{key}={morsel.value}' for key, morsel in self.cookies.items()).encode()),
+        ]
+        if data is not None:
+            headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+        communicator = ApplicationCommunicator(self.application, {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': query.encode(), 'headers': headers,
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        })
+        await communicator.send_input({'type': 'http.request', 'body': urlencode(data or {}).encode()})
+        start = await communicator.receive_output(5)
+        body = b''
+        while True:
+            message = await communicator.receive_output(5)
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        await communicator.wait()
+        response_headers = {}
+        for name, value in start['headers']:
+            if name.lower() == b'set-cookie':
+                self.cookies.load(value.decode())
+            response_headers[name.decode().lower()] = value.decode()
+        return start['status'], response_headers, body
+
+    async def test_checkout_is_charged_after_the_response(self):
+        await self.request('GET', '/payment/stripe/')
+        status, headers, _ = await self.request('POST', '/payment/stripe/', {
+            'stripeToken': 'tok_visa',
+            'csrfmiddlewaretoken': self.cookies[settings.CSRF_COOKIE_NAME].value,
+        })
+        self.assertEqual(status, 302)
+        self.assertIn('/payment/status/', headers['location'])
+        for _ in range(50):
+            _, _, body = await self.request('GET', f'{headers["location"]}?format=json')
+            payment = json.loads(body)
+            if payment['status'] in (Payment.SUCCEEDED, Payment.FAILED):
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(payment, {'status': 'succeeded', 'error': ''})
+        self.assertEqual(len(FakeGateway.charges), 1)
+
+
+class FinalizeOrderTests(CatalogFixtureMixin, TestCase):
+
+    def large_cart(self, lines):
+        Item.objects.bulk_create([
+            Item(
+                title=f'Bulk {i}', price=2, discount_price=1.5 if i % 2 else None,
+                category=self.categories[0], label='P', slug=f'bulk-{lines}-{i}',
+            )
+            for i in range(lines)
+        ])
+        items = Item.objects.filter(slug__startswith=f'bulk-{lines}-')
+        # bulk_create skips OrderItem.save, which captures the prices
+        order_items = []
+        for item in items:
+            order_item = OrderItem(user=self.user, item=item, quantity=2)
+            order_item.capture_prices(item.price, item.discount_price)
+            order_items.append(order_item)
+        OrderItem.objects.bulk_create(order_items)
+        order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        order.items.set(OrderItem.objects.filter(item__slug__startswith=f'bulk-{lines}-'))
+        order.update_totals()
+        payment = Payment.objects.create(user=self.user, order=order, amount=order.get_total())
+        return order, payment
+
+    def finalize(self, order, payment):
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+            self.assertTrue(cart.finalize_order(order.pk, payment.pk))
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        small = self.finalize(*self.large_cart(10))
+        Order.objects.update(ordered=True)
+        large = self.finalize(*self.large_cart(1000))
+        self.assertEqual(small, large)
+
+    def test_lines_are_placed_with_price_snapshot(self):
+        order, payment = self.large_cart(1000)
+        total = order.get_total()
+        self.finalize(order, payment)
+
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment, payment)
+        self.assertFalse(order.items.filter(ordered=False).exists())
+        self.assertAlmostEqual(order.get_total(), total)
+        self.assertEqual(order.items.filter(unit_final_price=Decimal('1.50')).count(), 500)
+
+        # Later price changes do not rewrite what was paid
+        Item.objects.filter(slug__startswith='bulk-').update(price=50, discount_price=None)
+        line = order.items.select_related('item').first()
+        self.assertEqual(line.get_final_price(), 2 * line.unit_final_price)
+        call_command('reconcile_order_totals', '--all', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertAlmostEqual(order.get_total(), total)
+
+    def test_placed_order_is_not_finalized_twice(self):
+        order, payment = self.large_cart(3)
+        self.finalize(order, payment)
+        with transaction.atomic():
+            self.assertFalse(cart.finalize_order(order.pk, payment.pk))
+
+
+class PurgeStaleCartsTests(CatalogFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = get_user_model().objects.create_user(username='other')
+        StockLevel.objects.create(item=self.items[0], on_hand=10)
+
+    def age(self, order, days):
+        Order.objects.filter(pk=order.pk).update(updated=timezone.now() - timezone.timedelta(days=days))
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('purge_stale_carts', '--batch-size', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_stale_carts_are_deleted_with_their_lines_and_holds(self):
+        for user in (self.user, self.other):
+            cart.add_item(user, self.items[0].slug)
+            cart.add_item(user, self.items[1].slug)
+        stale = Order.objects.get(user=self.user)
+        self.age(stale, 40)
+        recent = Order.objects.get(user=self.other)
+        self.age(recent, 5)
+
+        out = self.purge()
+        self.assertIn('1 orders, 2 order lines, 2 order-line links, 1 stock holds', out)
+        self.assertEqual(list(Order.objects.all()), [recent])
+        self.assertEqual(OrderItem.objects.count(), 2)
+        self.assertEqual(StockLevel.objects.get(item=self.items[0]).reserved, 1)
+        self.assertIn('1 orders', self.purge('--days', '1'))
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_cart_changes_keep_the_cart(self):
+        cart.add_item(self.user, self.items[0].slug)
+        self.age(Order.objects.get(), 40)
+        cart.add_item(self.user, self.items[1].slug)
+        self.purge()
+        self.assertEqual(Order.objects.get().item_count, 2)
+
+    def test_paid_orders_and_charges_in_flight_are_kept(self):
+        paid = self.fill_cart(1)
+        Order.objects.filter(pk=paid.pk).update(ordered=True)
+        OrderItem.objects.update(ordered=True)
+        in_flight = Order.objects.create(user=self.other, ordered_date=timezone.now())
+        Payment.objects.create(user=self.other, order=in_flight, amount=10, status=Payment.PROCESSING)
+        for order in (paid, in_flight):
+            self.age(order, 40)
+        self.purge()
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(OrderItem.objects.count(), 1)
+
+    def test_orphaned_lines_and_unused_addresses(self):
+        order = self.fill_cart(1)
+        OrderItem.objects.create(user=self.user, item=self.items[2], unit_price=1, unit_final_price=1)
+        used = BillingAddress.objects.create(user=self.user, street_address='1 Main Street', country='US', zip='1')
+        BillingAddress.objects.create(user=self.user, street_address='2 Main Street', country='US', zip='2')
+        Order.objects.filter(pk=order.pk).update(billing_address=used)
+
+        out = self.purge()
+        self.assertIn('Reclaimed 2 rows', out)
+        self.assertIn('1 order lines', out)
+        self.assertIn('1 billing addresses', out)
+        self.assertEqual(list(order.items.all()), list(OrderItem.objects.all()))
+        self.assertEqual(list(BillingAddress.objects.all()), [used])
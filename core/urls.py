@@ -1,24 +1,53 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     HomeView, 
+    SearchView,
+    search_json,
+    search_autocomplete,
     OrderSummaryView, 
     CheckoutViews, 
     ItemDetailView, 
     add_to_card, 
     remove_from_card,
     remove_single_item_from_card,
-    PaymentViews
+    PaymentViews,
+    payment_status,
+    cache_stats
     )
 
+from . import async_views
+from .api import item_detail_api, items_api
+from .caching import cache_anonymous_page
+from .metrics import metrics_view
+
+
+def pick(sync_view, async_view):
+    # ASYNC_VIEWS serves the cart and payment pages from core.async_views
+    return async_view if settings.ASYNC_VIEWS else sync_view
+
+
 app_name = 'core'
 
 urlpatterns = [
-    path('', HomeView.as_view(), name='home'),
+    path('', cache_anonymous_page(HomeView.as_view()), name='home'),
+    path('search/', cache_anonymous_page(SearchView.as_view()), name='search'),
+    path('api/search/', search_json, name='search-json'),
+    path('api/items/', items_api, name='api-items'),
+    path('api/items/<slug>/', item_detail_api, name='api-item'),
+    path('api/search/autocomplete/', search_autocomplete, name='search-autocomplete'),
     path('checkout/', CheckoutViews.as_view(), name='checkout'),
-    path('order-summary/', OrderSummaryView.as_view(), name='order-summary'),
-    path('product/<slug>/', ItemDetailView.as_view(), name='product'),
-    path('add-to-card/<slug>', add_to_card, name='add-to-card'),
-    path('remove-from-card/<slug>', remove_from_card, name='remove-from-card'),
-    path('remove-item-from-card/<slug>', remove_single_item_from_card, name='remove-single-item-from-card'),
-    path('payment/<payment_option>/', PaymentViews.as_view(), name='payment')
+    path('order-summary/', pick(OrderSummaryView.as_view(), async_views.order_summary), name='order-summary'),
+    path('product/<slug>/', cache_anonymous_page(ItemDetailView.as_view()), name='product'),
+    path('add-to-card/<slug>', pick(add_to_card, async_views.add_to_card), name='add-to-card'),
+    path('remove-from-card/<slug>', pick(remove_from_card, async_views.remove_from_card), name='remove-from-card'),
+    path(
+        'remove-item-from-card/<slug>',
+        pick(remove_single_item_from_card, async_views.remove_single_item_from_card),
+        name='remove-single-item-from-card',
+    ),
+    path('payment/<payment_option>/', pick(PaymentViews.as_view(), async_views.payment), name='payment'),
+    path('payment/status/<int:pk>/', pick(payment_status, async_views.payment_status), name='payment-status'),
+    path('cache-stats/', cache_stats, name='cache-stats'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
@@ -1,45 +1,140 @@
-from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.shortcuts import render, get_object_or_404, redirect
-from .models import Item, OrderItem, Order, Category, BillingAddress, Payment
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from .models import Item, OrderItem, Order, BillingAddress, Payment
+from . import cart, payments
 from .forms import CheckoutForms
+from .pagination import paginate_keyset, parse_id
+from .search import get_backend as get_search_backend
+from .caching import cart_count_stats, catalog_version, get_categories
+from .inventory import OutOfStock
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
+from django.db import transaction
+from django.db.models import Prefetch
 
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
+# Cart lines joined with their item, loaded in a single query
+CART_LINES = Prefetch('items', queryset=OrderItem.objects.select_related('item'))
 
 class HomeView(ListView):
     model = Item
     paginate_by = 10
     template_name = 'home.html'
+
+    def get_queryset(self):
+        # The cards only need the category title, never the description
+        queryset = (
+            Item.objects
+            .select_related('category')
+            .defer('description')
+            .order_by('id')
+        )
+        self.category = self.get_category()
+        if self.category is not None:
+            queryset = queryset.filter(category=self.category)
+        return queryset
+
+    def get_category(self):
+        category_id = parse_id(self.request.GET.get('category'))
+        if category_id is None:
+            return None
+        for category in get_categories():
+            if category.pk == category_id:
+                return category
+        raise Http404('Unknown category')
+
+    def paginate_queryset(self, queryset, page_size):
+        # Cursor pagination: ?after=<id> / ?before=<id> instead of ?page=<n>
+        page = paginate_keyset(
+            queryset,
+            page_size,
+            after=parse_id(self.request.GET.get('after')),
+            before=parse_id(self.request.GET.get('before')),
+        )
+        return (None, page, page.object_list, page.has_other_pages())
+
     def get_context_data(self,**kwargs):
         context = super().get_context_data(**kwargs)
-        categories = Category.objects.all()
-        context['categories'] = categories
+        context['categories'] = get_categories()
+        context['current_category'] = self.category
+        context['catalog_version'] = catalog_version()['version']
         return context
 
-class OrderSummaryView(LoginRequiredMixin ,View):
+class SearchView(ListView):
+    template_name = 'home.html'
+    result_limit = 40
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        return get_search_backend().search(self.query, limit=self.result_limit)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['categories'] = get_categories()
+        context['search_query'] = self.query
+        context['catalog_version'] = catalog_version()['version']
+        return context
+
+def search_results(items):
+    return [
+        {
+            'title': item.title,
+            'slug': item.slug,
+            'category': item.category.title,
+            'price': item.discount_price or item.price,
+            'url': item.get_absolute_url(),
+        }
+        for item in items
+    ]
+
+def search_json(request):
+    query = request.GET.get('q', '')
+    items = get_search_backend().search(query, limit=min(parse_id(request.GET.get('limit')) or 20, 100))
+    return JsonResponse({'query': query, 'results': search_results(items)})
+
+def search_autocomplete(request):
+    query = request.GET.get('q', '')
+    items = get_search_backend().autocomplete(query, limit=8)
+    return JsonResponse({'query': query, 'results': search_results(items)})
+
+def order_summary_response(request):
+    if not request.user.is_authenticated:
+        if not request.anonymous_cart:
+            messages.error(request, "You do not have an active order")
+            return redirect('/')
+        return render(request, 'order_summary.html', {'object': request.anonymous_cart.as_order()})
+    try:
+        order = (
+            Order.objects
+            .prefetch_related(CART_LINES)
+            .get(user=request.user, ordered=False)
+        )
+        context = {
+            'object': order
+        }
+        return render(request, 'order_summary.html', context)
+    except ObjectDoesNotExist:
+        messages.error(request, "You do not have an active order")
+        return redirect ('/')
+
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            context = {
-                'object': order
-            }
-            return render(self.request, 'order_summary.html', context)
-        except ObjectDoesNotExist:
-            messages.error(self.request, "You do not have an active order")
-            return redirect ('/')
+        return order_summary_response(self.request)
         
 
 class ItemDetailView(DetailView):
-    model = Item
     template_name = 'product-page.html'
+    queryset = Item.objects.select_related('category')
 
-class CheckoutViews(View):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['catalog_version'] = catalog_version()['version']
+        return context
+
+class CheckoutViews(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         form = CheckoutForms()
         context = {
@@ -67,9 +162,12 @@ class CheckoutViews(View):
                     country = country,
                     zip = zip,
                 )
-                billing_address.save()
-                order.billing_address = billing_address
-                order.save()
+                # Together, or purge_stale_carts could take the address
+                # for an unused one
+                with transaction.atomic():
+                    billing_address.save()
+                    order.billing_address = billing_address
+                    order.save()
                 # TODO: add redirect to the selected payment option
                 if payment_option == 'S':
                     return redirect('core:payment', payment_option='stripe')
@@ -83,155 +181,122 @@ class CheckoutViews(View):
             messages.error(self.request, "You do not have an active order")
             return redirect ('core:oreder-summary')
 
-class PaymentViews(View):
+def payment_page_response(request):
+    order = (
+        Order.objects
+        .prefetch_related(CART_LINES)
+        .get(user=request.user, ordered=False)
+    )
+    context = {
+        'order':order
+    }
+    return render(request, 'payment.html', context)
+
+def out_of_stock_response(request):
+    messages.warning(request, 'Sorry, some items in your cart are no longer in stock')
+    return redirect('core:order-summary')
+
+def payment_started_response(request, payment):
+    if payment is None:
+        messages.error(request, "You do not have an active order")
+        return redirect("/")
+    return redirect('core:payment-status', pk=payment.pk)
+
+def payment_status_response(request, payment):
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'status': payment.status, 'error': payment.error})
+    if payment.status == Payment.SUCCEEDED:
+        messages.success(request, "Your order was successful!")
+        return redirect("/")
+    if payment.status == Payment.FAILED:
+        messages.error(request, payment.error or "Your payment failed. You were not charged")
+        return redirect("/")
+    return render(request, 'payment_status.html', {'payment': payment})
+
+def payment_in_progress_response(request):
+    messages.warning(request, 'Your payment is being processed, the cart cannot change until it is done')
+    return redirect('core:order-summary')
+
+def cart_added_response(request, status, slug):
+    if status == cart.PAYMENT_IN_PROGRESS:
+        return payment_in_progress_response(request)
+    if status == cart.OUT_OF_STOCK:
+        messages.warning(request, 'Sorry, this item is out of stock')
+        return redirect('core:product', slug=slug)
+    if status == cart.CART_FULL:
+        messages.warning(request, 'Your cart is full, log in to add more items')
+        return redirect('core:order-summary')
+    if status == cart.UPDATED:
+        messages.info(request, 'This item quantity was updated')
+    else:
+        messages.info(request, 'This item was added to your card')
+    return redirect('core:order-summary')
+
+def cart_removed_response(request, status, slug):
+    if status == cart.PAYMENT_IN_PROGRESS:
+        return payment_in_progress_response(request)
+    if status == cart.REMOVED:
+        messages.info(request, 'This item was remove from your cart.')
+        return redirect('core:order-summary')
+    elif status == cart.NOT_IN_CART:
+        messages.info(request, 'This item was not in your cart.')
+    else:
+        messages.info(request, 'You do not have an active order.')
+    return redirect('core:product', slug=slug)
+
+def cart_decreased_response(request, status, slug):
+    if status == cart.PAYMENT_IN_PROGRESS:
+        return payment_in_progress_response(request)
+    if status in (cart.UPDATED, cart.REMOVED):
+        messages.info(request, 'This item quantity was updated.')
+        return redirect('core:order-summary')
+    elif status == cart.NOT_IN_CART:
+        messages.info(request, 'This item was not in your cart.')
+    else:
+        messages.info(request, 'You do not have an active order.')
+    return redirect('core:product', slug=slug)
+
+class PaymentViews(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        #order
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        context = {
-            'order':order
-        }
-        return render(self.request, 'payment.html', context)
+        return payment_page_response(self.request)
 
     def post(self, *args, **kwargs):
         # `source` is obtained with Stripe.js; see https://stripe.com/docs/payments/accept-a-payment-charges#web-create-token
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        token = self.request.POST.get('stripeToken')
-        amount = int(order.get_total() * 100) # The value is in cents so we multiple it by 100
-
+        # The charge itself runs in a background worker, see core.payments
         try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                source=token,
-            )
-
-            # Create Payment
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            # Assign Payment to order
-            order.ordered = True
-            order.payment = payment
-            order.save()
-
-            messages.success(self.request, "Your order was successful!")
-            return redirect("/")
-
-        except stripe.error.CardError as e:
-            body = e.json_body
-            err = body.get('error', {})
-            messages.error(self.request, f"{err.get('message')}")
-            return redirect("/")
-
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.error(self.request, 'Rate limit error')
-            return redirect("/")
-
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.error(self.request, "Invalid parameters")
-            return redirect("/")
-
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.error(self.request, "Not Authenticated")
-            return redirect("/")
-
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.error(self.request, "Network error")
-            return redirect("/")
-
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.error(self.request, "Something went wrong, You were not charge. Please try again")
-            return redirect("/")
-
-        except Exception as e:
-            # Send email to ourselves
-            messages.error(self.request, "A serious error occurred. We have been notified")
-            return redirect("/")
+            payment = payments.start_payment(self.request.user, self.request.POST.get('stripeToken', ''))
+        except OutOfStock:
+            return out_of_stock_response(self.request)
+        return payment_started_response(self.request, payment)
 
 @login_required
+def payment_status(request, pk):
+    payment = get_object_or_404(Payment, pk=pk, user=request.user)
+    return payment_status_response(request, payment)
+
+# Anonymous visitors get a cookie cart, see core.cart.AnonymousCart
+
 def add_to_card(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item, 
-        user=request.user, 
-        ordered=False
-        )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # Check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, 'This item quantity was updated')
-            return redirect('core:order-summary')
-        else:
-            order.items.add(order_item)
-            messages.info(request, 'This item was added to your card')
-            return redirect('core:order-summary')
+    if request.user.is_authenticated:
+        status = cart.add_item(request.user, slug)
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        return redirect('core:order-summary')
+        status = request.anonymous_cart.add(slug)
+    return cart_added_response(request, status, slug)
 
-@login_required
 def remove_from_card(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # Check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, 
-                user=request.user, 
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            messages.info(request, 'This item was remove from your cart.')
-            return redirect('core:order-summary')
-        else:
-            messages.info(request, 'This item was not in your cart.')
-            return redirect('core:product', slug=slug)
+    if request.user.is_authenticated:
+        status = cart.remove_item(request.user, slug)
     else:
-        messages.info(request, 'You do not have an active order.') 
-        return redirect('core:product', slug=slug)
-    
-@login_required
+        status = request.anonymous_cart.remove(slug)
+    return cart_removed_response(request, status, slug)
+
 def remove_single_item_from_card(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # Check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, 
-                user=request.user, 
-                ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-            else:
-                order.items.remove(order_item)
-            order_item.save()
-            messages.info(request, 'This item quantity was updated.')
-            return redirect('core:order-summary')
-        else:
-            messages.info(request, 'This item was not in your cart.')
-            return redirect('core:product', slug=slug)
+    if request.user.is_authenticated:
+        status = cart.remove_single_item(request.user, slug)
     else:
-        messages.info(request, 'You do not have an active order.') 
-        return redirect('core:product', slug=slug)
-    
\ No newline at end of file
+        status = request.anonymous_cart.remove_single(slug)
+    return cart_decreased_response(request, status, slug)
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse({'cart_count': cart_count_stats()})
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+# Base classes of the commands that work through queued rows next to the
+# web workers: process_payments, process_image_jobs and
+# release_reservations. Work the web workers' task pool started is lost
+# when they restart, and is only picked up again by these commands.
+
+
+class WatchCommand(BaseCommand):
+    # Runs run_once, then again every --watch seconds
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--watch', type=float, metavar='SECONDS',
+            help='Keep going, pausing this long between passes.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(**options)
+            if options['watch'] is None:
+                break
+            time.sleep(options['watch'])
+
+    def run_once(self, **options):
+        raise NotImplementedError
+
+
+class QueueCommand(WatchCommand):
+    # Processes the pending rows of model, in a pool of --workers threads.
+    # Rows left in the running status by a worker that died are pending
+    # again after --stale-after minutes.
+    model = None
+    pending = running = None
+    noun = 'rows'
+    workers = 2
+    stale_after = 10
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--workers', type=int, default=self.workers)
+        parser.add_argument('--limit', type=int, help=f'Process at most this many {self.noun} per pass.')
+        parser.add_argument(
+            '--stale-after', type=int, default=self.stale_after, metavar='MINUTES',
+            help=f'Requeue {self.noun} whose worker died this long ago.',
+        )
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as self.executor:
+            super().handle(*args, **options)
+
+    def run_once(self, **options):
+        self.requeue_stale(options['stale_after'])
+        pks = self.pending_ids(options['limit'])
+        if options['workers'] > 1:
+            list(self.executor.map(self.run, pks))
+        else:
+            for pk in pks:
+                self.process(pk)
+        if pks:
+            self.stdout.write(f'Processed {len(pks)} {self.noun}.')
+
+    def run(self, pk):
+        try:
+            self.process(pk)
+        finally:
+            close_old_connections()
+
+    def requeue_stale(self, minutes):
+        self.model.objects.filter(
+            status=self.running,
+            updated__lt=timezone.now() - timedelta(minutes=minutes),
+        ).update(status=self.pending)
+
+    def pending_ids(self, limit):
+        raise NotImplementedError
+
+    def process(self, pk):
+        raise NotImplementedError
@@ -10,9 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import copy
 from pathlib import Path
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -28,6 +31,17 @@ STRIPE_PUBLIC_KEY = "pk_test_51HgdCFEdlzSI8jLlVMsuvHiD8mAXddYT7nRNuqUXswyLKdrz2D
 
 # STRIPE_SECRET_KEY = os.environ.get('STRIPE_TEST_SECRET_KEY')
 STRIPE_SECRET_KEY = "sk_test_51HgdCFEdlzSI8jLlgRxCcAYtHNmsUsN0MzRYak18s0b1W0sTmygC0aBnALml1W2cxc6VOCpcsSKVc7CUz1UyupHk00LLEC4wL0"
+# Set to the URL of `manage.py fake_stripe` for load tests
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')
+
+# Payment gateway used by core.payments; FakeGateway charges nothing
+PAYMENT_GATEWAY = os.environ.get('PAYMENT_GATEWAY', 'core.payments.StripeGateway')
+# Seconds before the first retry of a charge that hit a gateway error,
+# doubled for each further attempt
+PAYMENT_RETRY_DELAY = 0.5
+
+# How long a cart line holds stock (core.inventory), in seconds
+STOCK_RESERVATION_TTL = 15 * 60
 
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -55,11 +69,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'core.routers.StickyPrimaryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.cart.AnonymousCartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -68,7 +85,8 @@ ROOT_URLCONF = 'ecommerce.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render timing for core.metrics
+        'BACKEND': 'core.metrics.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -91,10 +109,139 @@ WSGI_APPLICATION = 'ecommerce.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+# SQLite tuned for concurrent writers, see core/backends/sqlite3. IMMEDIATE
+# transactions queue for the write lock up to the busy timeout, and
+# connections are kept between requests. SQLITE_TUNING=0 gives Django's
+# defaults, for comparison in `manage.py bench_sqlite`.
+#
+# SQLITE_WAL=1 also switches the database to WAL, which lets readers run
+# alongside the writer. It is opt-in because the switch is written to the
+# database file and stays there, and the db.sqlite3 checked in must keep
+# its rollback journal. Turn it on for a database of your own
+# (SQLITE_PATH) in production.
+if os.environ.get('SQLITE_TUNING', '1') == '1':
+    DATABASES['default'].update({
+        'ENGINE': 'core.backends.sqlite3',
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+        'OPTIONS': {
+            # Busy timeout, in seconds
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'pragmas': {
+                # Durable at each checkpoint rather than each commit
+                'synchronous': 'normal',
+                'mmap_size': 256 * 1024 * 1024,
+                # Negative means KiB, so 64MB of page cache per connection
+                'cache_size': -64000,
+                'temp_store': 'memory',
+            },
+        },
+    })
+    if os.environ.get('SQLITE_WAL') == '1':
+        DATABASES['default']['OPTIONS']['pragmas']['journal_mode'] = 'wal'
+
+# Read replicas for catalog pages, see core.routers. SQLITE_REPLICAS is a
+# comma separated list of files, kept in sync with `manage.py sync_replica`.
+DATABASE_REPLICAS = []
+for number, path in enumerate(filter(None, os.environ.get('SQLITE_REPLICAS', '').split(',')), 1):
+    replica = copy.deepcopy(DATABASES['default'])
+    replica['NAME'] = path
+    replica['TEST'] = {'MIRROR': 'default'}
+    if 'pragmas' in replica.get('OPTIONS', {}):
+        replica['OPTIONS']['pragmas']['query_only'] = 1
+    DATABASES[f'replica_{number}'] = replica
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+# How long a user reads from the primary after writing
+REPLICA_STICKY_SECONDS = 5
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+# Page, fragment and cart badge caches must be shared by every worker process
+# in production: set CACHE_BACKEND to "file", "memcached" (needs pymemcache,
+# MEMCACHED_LOCATION defaults to 127.0.0.1:11211) or "db" (run
+# `manage.py createcachetable`). CART_CACHE_BACKEND overrides it for the
+# cart badge counts.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+CART_CACHE_BACKEND = os.environ.get('CART_CACHE_BACKEND', CACHE_BACKEND)
+
+# Django's backends, counting hits and misses for core.metrics
+def cache_backend(backend, name):
+    return {
+        'locmem': {
+            'BACKEND': 'core.metrics.LocMemCache',
+            'LOCATION': name,
+        },
+        'file': {
+            'BACKEND': 'core.metrics.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache', name),
+        },
+        'memcached': {
+            'BACKEND': 'core.metrics.PyMemcacheCache',
+            'LOCATION': os.environ.get('MEMCACHED_LOCATION', '127.0.0.1:11211'),
+            'KEY_PREFIX': name,
+        },
+        'db': {
+            'BACKEND': 'core.metrics.DatabaseCache',
+            'LOCATION': f'core_{name}_cache',
+        },
+    }[backend]
+
+CACHES = {
+    'default': cache_backend(CACHE_BACKEND, 'default'),
+    'cart': cache_backend(CART_CACHE_BACKEND, 'cart'),
+}
+
+CART_COUNT_CACHE_ALIAS = 'cart'
+
+# Catalog pages, fragments and API bodies (core.caching) are keyed on a
+# catalog version kept in the default cache. On the per-process locmem cache
+# a change reaches only the process that made it, so there the version is
+# renewed every CATALOG_VERSION_TIMEOUT seconds, which bounds how stale the
+# other processes get. Shared caches keep it until the catalog changes.
+CATALOG_VERSION_TIMEOUT = 30 if CACHE_BACKEND == 'locmem' else None
+
+# Sessions and messages
+# https://docs.djangoproject.com/en/3.2/topics/http/sessions/
+
+# Every request of a signed-in user loads their session. "cached_db" reads
+# it from the sessions cache and writes through to the database, "cache"
+# keeps it in the cache alone (lost when the cache is), "db" is Django's
+# default. The sessions cache must be shared by the worker processes, or a
+# logout would not reach them all, and must not be the database, or it
+# saves no query: the cached stores need SESSION_CACHE_BACKEND (or
+# CACHE_BACKEND) set to "file" or "memcached". Otherwise the store is "db".
+SESSION_CACHE_BACKENDS = ('file', 'memcached')
+SESSION_CACHE_BACKEND = os.environ.get('SESSION_CACHE_BACKEND', CACHE_BACKEND)
+SESSION_STORE = os.environ.get(
+    'SESSION_STORE', 'cached_db' if SESSION_CACHE_BACKEND in SESSION_CACHE_BACKENDS else 'db'
+)
+if SESSION_STORE in ('cache', 'cached_db') and SESSION_CACHE_BACKEND not in SESSION_CACHE_BACKENDS:
+    raise ImproperlyConfigured(
+        f'SESSION_STORE={SESSION_STORE} needs SESSION_CACHE_BACKEND "file" or "memcached", '
+        f'not "{SESSION_CACHE_BACKEND}"'
+    )
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_STORE}'
+CACHES['sessions'] = cache_backend(SESSION_CACHE_BACKEND, 'sessions')
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Flash messages in a signed cookie, so they never load or save the session
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# Request metrics (core.metrics): Prometheus text at /metrics for these
+# addresses, a Server-Timing header on every response, and a log of the
+# SQL of sampled requests slower than SLOW_REQUEST_SECONDS
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+SERVER_TIMING = True
+SLOW_REQUEST_SECONDS = 0.5
+SLOW_REQUEST_SAMPLE_RATE = 0.1
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -138,7 +285,7 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_in_env')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static_root/')
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media_root/')
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', os.path.join(BASE_DIR, 'media_root/'))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -159,4 +306,14 @@ SITE_ID = 1
 
 LOGIN_REDIRECT_URL = '/'
 
-CRISPY_TEMPLATE_PACK = 'bootstrap4'
\ No newline at end of file
+CRISPY_TEMPLATE_PACK = 'bootstrap4'
+
+# Background tasks (core.tasks), e.g. image renditions and charges. They
+# live in the web process: what a restart interrupts stays queued in the
+# database for `manage.py process_payments --watch` and
+# `process_image_jobs --watch`, which must run next to the web workers
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 2))
+BACKGROUND_TASKS_EAGER = False
+
+# Async cart and checkout views (core.async_views), on by default under ASGI
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
\ No newline at end of file